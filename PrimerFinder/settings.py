@@ -20,6 +20,57 @@ STATICFILES_DIRS = [
 ]
 TEMPLATE_URL = '/entropy/templates/entropy/'
 
+# Prebuilt outgroup indexes, keyed by content; see entropy/cache.py
+PRIMER_FINDER_OUTGROUP_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'outgroups')
+PRIMER_FINDER_OUTGROUP_CACHE_BYTES = 4 * 1024 ** 3
+
+# identify_primers results per alignment and primer parameters
+PRIMER_FINDER_CANDIDATE_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'candidates')
+PRIMER_FINDER_CANDIDATE_CACHE_BYTES = 1024 ** 3
+# candidate tables held in memory per process for the re-filter endpoint
+PRIMER_FINDER_TABLE_CACHE_SIZE = 16
+
+# Largest alignment (sequences x columns, one byte each) a search may load
+PRIMER_FINDER_MAX_ALIGNMENT_BYTES = 8 * 1024 ** 3
+
+# Worker processes per request for the entropy scan; 1 runs it in-process
+PRIMER_FINDER_WORKERS = 1
+# Bases of outgroup per screening task when PRIMER_FINDER_WORKERS > 1
+PRIMER_FINDER_OUTGROUP_CHUNK = 1 << 22
+
+# Run searches as background jobs (see entropy/jobs.py) instead of inside the
+# request. Submitting starts a worker unless PRIMER_FINDER_SPAWN_WORKER is off,
+# e.g. when a long-lived 'manage.py run_primer_jobs' is already running.
+PRIMER_FINDER_ASYNC_JOBS = True
+PRIMER_FINDER_SPAWN_WORKER = True
+PRIMER_FINDER_JOB_DIR = os.path.join(BASE_DIR, 'jobs')
+# Most workers running jobs at once, spawned or long-lived; more jobs wait in
+# the queue
+PRIMER_FINDER_JOB_WORKERS = 1
+# A running job's worker refreshes its heartbeat every PRIMER_FINDER_JOB_HEARTBEAT
+# seconds; a job whose heartbeat is PRIMER_FINDER_JOB_TIMEOUT seconds old is
+# queued again, and failed after PRIMER_FINDER_JOB_ATTEMPTS workers have died on it
+PRIMER_FINDER_JOB_HEARTBEAT = 30
+PRIMER_FINDER_JOB_TIMEOUT = 300
+PRIMER_FINDER_JOB_ATTEMPTS = 3
+# Embed the whole plotly figure in result pages instead of the D3 chart that
+# reads the profile range by range from api/profile
+PRIMER_FINDER_EMBED_PLOT = False
+
+# Every search logs a run report (time, CPU and peak memory per stage, and
+# counters of windows, candidates, pairs and outgroup screens) at INFO. Show
+# it with the results too (also per request with ?report=1), and measure
+# each stage's own allocations instead of the process's high-water mark
+# (slower).
+PRIMER_FINDER_SHOW_REPORT = False
+PRIMER_FINDER_TRACE_MEMORY = False
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'console': {'class': 'logging.StreamHandler'}},
+    'loggers': {'entropy': {'handlers': ['console'], 'level': 'INFO'}},
+}
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
 
@@ -0,0 +1,228 @@
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+from .primer_finder_classes import (GAP, GapProfile, SequenceAlignment, PrimerTable, PrimerFinder,
+                                    OutgroupIndex, OutgroupScreenCache)
+
+#Benchmarks of the search pipeline on synthetic data, stage by stage, over a
+#range of alignment sizes (manage.py benchmark_primers). Results are plain
+#JSON so runs on different commits can be compared with compare().
+
+#the stages run_stages times, in pipeline order
+STAGES = ["SequenceAlignment", "_kmer_entropy", "_find_min_entropy_positions",
+          "Primer construction", "identify_pairs", "outgroup index", "_outgroup_distance",
+          "html_plot"]
+
+#identify_pairs arguments of a benchmark run; loose enough that most
+#candidates pair up, so the later stages have work to do
+PAIR_PARAMETERS = {'amp_min': 50, 'amp_max': 300, 'max_degeneracy': 6,
+                   'min_melting_temp': 0, 'max_melting_temp': 100, 'min_gc': 0, 'max_gc': 1,
+                   'select_gc_clamp': False, 'omit_gc_clamp': False, 'max_edit_dist': 2}
+
+
+#n_seqs sequences of an alignment `length` columns wide, all descended from
+#one random ancestor. diversity: fraction of variable columns, where each
+#sequence has a random base one time in ten; degeneracy: fraction of columns
+#with a second base carried by about half of the sequences. Both make the
+#columns' consensus degenerate, independently of the number of sequences;
+#gap_rate: chance of an indel starting at each column, a gap run (mean
+#length 3) shared by a random part of the sequences, as in a real alignment.
+def synthetic_alignment(n_seqs, length, diversity=0.05, gap_rate=0.005, degeneracy=0.02, seed=0):
+    rng = np.random.default_rng(seed)
+    ancestor = rng.integers(0, 4, length, dtype=np.uint8)
+    codes = np.repeat(ancestor[None, :], n_seqs, axis=0)
+    polymorphic = np.flatnonzero(rng.random(length) < degeneracy)
+    carriers = rng.random((n_seqs, len(polymorphic))) < 0.5
+    codes[:, polymorphic] = np.where(carriers, (ancestor[polymorphic] + 1) % 4, ancestor[polymorphic])
+    variable = np.flatnonzero(rng.random(length) < diversity)
+    substituted = rng.random((n_seqs, len(variable))) < 0.1
+    codes[:, variable] = np.where(substituted, rng.integers(0, 4, substituted.shape, dtype=np.uint8),
+                                  codes[:, variable])
+    for start in np.flatnonzero(rng.random(length) < gap_rate):
+        carriers = rng.random(n_seqs) < rng.random() / 2
+        codes[carriers, start:start + rng.geometric(1/3)] = GAP
+    return [seq.tobytes().decode("ascii") for seq in np.frombuffer(b"ACGT-", dtype=np.uint8)[codes]]
+
+
+#n_seqs random sequences of `length` bases, with a `related` fraction of
+#them cut from the alignment's first sequence (mutated at rate 0.05), so
+#the outgroup screen finds some primers near and has to reject others.
+def synthetic_outgroup(alignment, n_seqs, length, related=0.2, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    source = alignment[0].replace("-", "")
+    sequences = []
+    for i in range(n_seqs):
+        if i < related * n_seqs:
+            size = min(length, len(source))
+            start = rng.integers(0, len(source) - size + 1)
+            seq = np.frombuffer(source[start:start + size].encode("ascii"), dtype=np.uint8).copy()
+            mutated = rng.random(size) < 0.05
+            seq[mutated] = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, int(mutated.sum()))]
+        else:
+            seq = np.frombuffer(b"ACGT", dtype=np.uint8)[rng.integers(0, 4, length)]
+        sequences.append(seq.tobytes().decode("ascii"))
+    return sequences
+
+
+def write_fasta(path, sequences):
+    with open(path, "w") as f:
+        for i, seq in enumerate(sequences):
+            f.write(">seq%d\n%s\n" % (i, seq))
+
+
+#Runs fn, returning (result, seconds, peak bytes allocated while it ran, or
+#None unless trace_memory). Tracing slows Python code down, so timings and
+#memory are best measured in separate runs.
+def measure(fn, trace_memory=False):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+#The pipeline of identify_primers/identify_pairs/html_plot on one alignment,
+#split into STAGES. Returns ({stage: (seconds, peak bytes)}, {counter: n}).
+def run_stages(msa_file, outgroup_file, min_primer_length=18, max_primer_length=21,
+               trace_memory=False, pair_parameters=PAIR_PARAMETERS):
+    finder = PrimerFinder(screen_cache=OutgroupScreenCache())
+    stages = {}
+
+    def stage(name, fn):
+        result, seconds, peak = measure(fn, trace_memory)
+        stages[name] = (seconds, peak)
+        return result
+
+    alignment = stage("SequenceAlignment", lambda: SequenceAlignment(msa_file))
+    matrix = alignment.matrix
+    entropies_by_k = stage("_kmer_entropy", lambda: finder._kmer_entropy_range(
+        matrix, min_primer_length, max_primer_length))
+
+    def find_minima():
+        found = []
+        for k in range(min_primer_length, max_primer_length):
+            for i in finder._find_min_entropy_positions(entropies_by_k[k]):
+                found.append((k, i))
+        return found
+    minima = stage("_find_min_entropy_positions", find_minima)
+
+    def build_primers():
+        peaks = [entropies_by_k[k][i] for k, i in minima]
+        return PrimerTable([seq for entropy, seq in peaks], [i for k, i in minima], 0.05,
+                           [entropy for entropy, seq in peaks],
+                           [matrix.window_degeneracy(i, i + k + 1) for k, i in minima])
+    primers = stage("Primer construction", build_primers)
+    pairs = stage("identify_pairs", lambda: finder.identify_pairs(primers, **pair_parameters))
+    pairs = [] if pairs == -1 else pairs
+
+    with open(outgroup_file) as f:
+        outgroup = stage("outgroup index", lambda: OutgroupIndex.from_fasta(f))
+    unique = {}
+    for pair in pairs:
+        unique.setdefault(pair.forward.seq, pair.forward)
+        unique.setdefault(pair.reverse.seq, pair.reverse)
+    #the screen that replaced _outgroup_distance, on a cold cache
+    near = stage("_outgroup_distance", lambda: OutgroupScreenCache().within_many(
+        outgroup, unique.values(), pair_parameters['max_edit_dist'] - 1))
+
+    finder.primer_pairs = [pair for pair in pairs if near[pair.forward.seq] or near[pair.reverse.seq]]
+    finder.gaps = GapProfile.from_matrix(matrix)
+    if finder.primer_pairs:
+        stage("html_plot", finder.html_plot)
+
+    counts = {"sequences": alignment.n_sequences, "distinct_sequences": matrix.n_seqs,
+              "columns": matrix.n_cols, "windows": sum(len(e) for e in entropies_by_k.values()),
+              "candidates": len(primers), "pairs": len(pairs),
+              "screened_primers": len(unique), "kept_pairs": len(finder.primer_pairs)}
+    return stages, counts
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+#Benchmarks every (n_seqs, length) size: the best of `repeat` timed runs of
+#each stage, and the peak memory of one more traced run. Every stage also
+#gets a scaling curve, its seconds against alignment cells, with the
+#log-log slope (1 is linear in the alignment size).
+def run_benchmark(sizes, directory, repeat=3, trace_memory=True, seed=0, diversity=0.05,
+                  gap_rate=0.005, degeneracy=0.02, outgroup_seqs=50, outgroup_length=2000,
+                  min_primer_length=18, max_primer_length=21, progress=print):
+    runs = []
+    for n_seqs, length in sizes:
+        alignment = synthetic_alignment(n_seqs, length, diversity, gap_rate, degeneracy, seed)
+        msa_file = os.path.join(directory, "msa-%d-%d.fa" % (n_seqs, length))
+        outgroup_file = os.path.join(directory, "outgroup-%d-%d.fa" % (n_seqs, length))
+        write_fasta(msa_file, alignment)
+        write_fasta(outgroup_file, synthetic_outgroup(alignment, outgroup_seqs, outgroup_length,
+                                                      seed=seed))
+        best = {}
+        for r in range(repeat):
+            stages, counts = run_stages(msa_file, outgroup_file, min_primer_length,
+                                        max_primer_length)
+            for name, (seconds, peak) in stages.items():
+                best[name] = min(best.get(name, seconds), seconds)
+        peaks = {}
+        if trace_memory:
+            stages, counts = run_stages(msa_file, outgroup_file, min_primer_length,
+                                        max_primer_length, trace_memory=True)
+            peaks = {name: peak for name, (seconds, peak) in stages.items()}
+        run = {"n_seqs": n_seqs, "length": length, "cells": n_seqs * length, "counts": counts,
+               "stages": {name: {"seconds": best[name], "peak_bytes": peaks.get(name)}
+                          for name in STAGES if name in best}}
+        runs.append(run)
+        if progress:
+            progress("%d x %d: %s" % (n_seqs, length, ", ".join(
+                "%s %.3fs" % (name, stage["seconds"]) for name, stage in run["stages"].items())))
+
+    curves = {}
+    for name in STAGES:
+        points = [(run["cells"], run["stages"][name]["seconds"]) for run in runs
+                  if name in run["stages"]]
+        curve = {"cells": [p[0] for p in points], "seconds": [p[1] for p in points],
+                 "slope": None}
+        if len({cells for cells, seconds in points}) > 1 and all(s > 0 for c, s in points):
+            curve["slope"] = float(np.polyfit(np.log([p[0] for p in points]),
+                                              np.log([p[1] for p in points]), 1)[0])
+        curves[name] = curve
+
+    return {"commit": _git_commit(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count(),
+            "parameters": {"seed": seed, "repeat": repeat, "diversity": diversity,
+                           "gap_rate": gap_rate, "degeneracy": degeneracy,
+                           "outgroup_seqs": outgroup_seqs, "outgroup_length": outgroup_length,
+                           "min_primer_length": min_primer_length,
+                           "max_primer_length": max_primer_length},
+            "runs": runs, "curves": curves}
+
+
+#{(n_seqs, length): {stage: new seconds / old seconds}} for the sizes and
+#stages both results have; below 1 is faster.
+def compare(old, new):
+    old_runs = {(run["n_seqs"], run["length"]): run for run in old["runs"]}
+    ratios = {}
+    for run in new["runs"]:
+        size = (run["n_seqs"], run["length"])
+        if size not in old_runs:
+            continue
+        ratios[size] = {}
+        for name, stage in run["stages"].items():
+            before = old_runs[size]["stages"].get(name)
+            if before and before["seconds"] > 0:
+                ratios[size][name] = stage["seconds"] / before["seconds"]
+    return ratios
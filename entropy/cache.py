@@ -0,0 +1,363 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from Bio import SeqIO
+from django.conf import settings
+from .primer_finder_classes import GapProfile, OutgroupIndex, PrimerTable, ProfilePyramid
+
+
+class DiskStore():
+    #A directory of cache entries, one sub-directory per key, kept under
+    #max_bytes. Entries are written into a temporary directory and renamed into
+    #place, so a reader (or a second worker writing the same key) never sees a
+    #half written entry. Reading an entry touches it; when the store grows past
+    #its cap the least recently used entries are removed first.
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def has(self, key):
+        return os.path.isdir(self.entry_path(key))
+
+    def touch(self, key):
+        try:
+            os.utime(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    #writer(directory) fills a fresh directory with the entry's files.
+    def write(self, key, writer):
+        path = self.entry_path(key)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+        try:
+            writer(tmp)
+        except BaseException:
+            #a half written entry is never renamed into place, or left behind
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            #someone else stored the same key first; theirs is as good as ours
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not self.has(key):
+                raise
+        self.evict(keep=key)
+        return path
+
+    #Keys that eviction must leave alone.
+    def pinned(self):
+        return set()
+
+    #Removes old entries until the store fits its cap again; `keep` (usually the
+    #entry just written) survives even if it alone is over the cap.
+    def evict(self, keep=None):
+        entries = []
+        total = 0
+        pinned = self.pinned() | {keep}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            try:
+                size = self._size(path)
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            total += size
+            if name not in pinned:
+                entries.append((mtime, size, name))
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total -= size
+
+    @staticmethod
+    def _size(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+class OutgroupIndexStore(DiskStore):
+    #Prebuilt OutgroupIndexes keyed by the fingerprint of their content, so the
+    #same outgroup uploaded under any name is indexed once and memory-mapped
+    #afterwards. Named references map a label to a fingerprint and are never
+    #evicted.
+    REFERENCES = ".references.json"
+
+    def __init__(self, directory, max_bytes, q=12):
+        super().__init__(directory, max_bytes)
+        self.q = q
+        self.lock = threading.Lock()
+
+    def from_fasta(self, file):
+        return self.from_sequences([str(x.seq) for x in SeqIO.parse(file, "fasta")])
+
+    def from_sequences(self, sequences):
+        text, record_starts, record_ends = OutgroupIndex.concatenate(sequences)
+        key = self.key(OutgroupIndex.fingerprint_of(text, record_ends))
+        if self.has(key):
+            try:
+                return self.load(key)
+            except (OSError, ValueError):
+                #entry evicted or damaged under us, rebuild it below
+                shutil.rmtree(self.entry_path(key), ignore_errors=True)
+        index = OutgroupIndex(text, record_starts, record_ends, self.q)
+        self.write(key, index.save)
+        return self.load(key)
+
+    def key(self, fingerprint):
+        return "%s-q%d" % (fingerprint, self.q)
+
+    #Entries saved in an older OutgroupIndex format are built again from
+    #their own text, so registered references carry on working.
+    def load(self, key):
+        self.touch(key)
+        index = OutgroupIndex.load(self.entry_path(key))
+        if index.format < OutgroupIndex.FORMAT:
+            index = OutgroupIndex(np.array(index.text), index.record_starts, index.record_ends,
+                                  index.q, fingerprint=index.fingerprint)
+            stale = tempfile.mkdtemp(prefix=".tmp-", dir=self.directory)
+            try:
+                os.rename(self.entry_path(key), os.path.join(stale, key))
+            except OSError:
+                #another process got to it first
+                pass
+            shutil.rmtree(stale, ignore_errors=True)
+            self.write(key, index.save)
+            index = OutgroupIndex.load(self.entry_path(key))
+        return index
+
+    def references(self):
+        try:
+            with open(os.path.join(self.directory, self.REFERENCES)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def reference(self, name):
+        references = self.references()
+        if name not in references:
+            raise ValueError("Unknown reference outgroup: %s" % name)
+        if not self.has(references[name]):
+            raise ValueError("Reference outgroup %s is missing from the cache, register it again" % name)
+        return self.load(references[name])
+
+    def register(self, name, file):
+        index = self.from_fasta(file)
+        key = self.key(index.fingerprint)
+        with self.lock:
+            references = self.references()
+            references[name] = key
+            self._write_references(references)
+        return index
+
+    def unregister(self, name):
+        with self.lock:
+            references = self.references()
+            references.pop(name, None)
+            self._write_references(references)
+
+    def _write_references(self, references):
+        with tempfile.NamedTemporaryFile("w", dir=self.directory, prefix=".tmp-",
+                                         delete=False) as f:
+            json.dump(references, f, indent=1, sort_keys=True)
+        os.replace(f.name, os.path.join(self.directory, self.REFERENCES))
+
+    def pinned(self):
+        return set(self.references().values())
+
+
+class CandidateStore(DiskStore):
+    #identify_primers results (the unfiltered PrimerTable plus the entropy
+    #profile and gap counts the plot needs), keyed by the alignment's content
+    #and the parameters that change them. Reruns that only move the pair
+    #filters skip the entropy scan entirely.
+    #options: other identify_primers arguments that change the result (the
+    #approximate mode's), left out of the key when not used
+    #FORMAT is part of every key, so entries laid out differently by an older
+    #version are never read (2: gap coverage counts deduplicated sequences,
+    #3: gap counts instead of the gap mask, 4: calibrated approximate intervals)
+    FORMAT = 4
+
+    def key(self, msa_file, min_primer_length, max_primer_length, na_conc, ragged_ends,
+            weights=None, options=None):
+        digest = hashlib.sha256()
+        digest.update(b"format %d" % self.FORMAT)
+        digest.update(json.dumps([min_primer_length, max_primer_length, na_conc,
+                                  bool(ragged_ends)]).encode("ascii"))
+        if weights is not None:
+            digest.update(json.dumps(sorted(weights.items())).encode("utf-8"))
+        if options:
+            digest.update(json.dumps(options, sort_keys=True).encode("ascii"))
+        if isinstance(msa_file, str):
+            with open(msa_file, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+        else:
+            #an open (upload) file, read through once and rewound for parsing
+            while True:
+                chunk = msa_file.read(1 << 20)
+                if not chunk:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                digest.update(chunk)
+            msa_file.seek(0)
+        return digest.hexdigest()
+
+    #(primers, entropy values, entropy peaks, GapProfile, entropy intervals)
+    #or None; the intervals are None unless the profile was approximate
+    def get(self, key):
+        if not self.has(key):
+            return None
+        self.touch(key)
+        directory = self.entry_path(key)
+        try:
+            primers = PrimerTable.load(directory)
+            gaps = GapProfile.load(directory)
+            with np.load(os.path.join(directory, "profile.npz")) as profile:
+                intervals = None
+                if "interval_low" in profile:
+                    intervals = (profile["interval_low"], profile["interval_high"])
+                return (primers, profile["entropy_values"], profile["entropy_peaks"], gaps,
+                        intervals)
+        except (OSError, ValueError, KeyError):
+            #evicted while we were reading it
+            return None
+
+    #The PrimerTable of an entry alone, or None
+    def primers(self, key):
+        if not self.has(key):
+            return None
+        self.touch(key)
+        try:
+            return PrimerTable.load(self.entry_path(key))
+        except (OSError, ValueError, KeyError):
+            #evicted while we were reading it
+            return None
+
+    def put(self, key, primers, entropy_values, entropy_peaks, gaps, intervals=None,
+            profiles=None):
+        def writer(directory):
+            primers.save(directory)
+            gaps.save(directory)
+            if profiles is not None:
+                np.savez(os.path.join(directory, "profiles.npz"),
+                         **{"k%d" % k: values for k, values in profiles.items()})
+            extra = {}
+            if intervals is not None:
+                extra = {"interval_low": intervals[0], "interval_high": intervals[1]}
+            np.savez(os.path.join(directory, "profile.npz"), entropy_values=entropy_values,
+                     entropy_peaks=entropy_peaks, **extra)
+            ProfilePyramid.from_profile(entropy_values, gaps, intervals).save(directory)
+        if not self.has(key):
+            self.write(key, writer)
+
+    #{k: entropy of every window} of an entry, or None
+    def profiles(self, key):
+        try:
+            with np.load(os.path.join(self.entry_path(key), "profiles.npz")) as arrays:
+                return {int(name[1:]): arrays[name] for name in arrays.files}
+        except (OSError, ValueError):
+            return None
+
+    #(k, entropy of every window) of an entry, one k at a time as they are
+    #consumed, or None
+    def iter_profiles(self, key):
+        try:
+            arrays = np.load(os.path.join(self.entry_path(key), "profiles.npz"))
+        except (OSError, ValueError):
+            return None
+
+        def profiles():
+            with arrays:
+                for name in arrays.files:
+                    yield int(name[1:]), arrays[name]
+        return profiles()
+
+    #The ProfilePyramid of an entry, or None once it has been evicted
+    def pyramid(self, key):
+        if not self.has(key):
+            return None
+        self.touch(key)
+        try:
+            return ProfilePyramid.load(self.entry_path(key))
+        except FileNotFoundError:
+            #an entry from before pyramids were stored
+            cached = self.get(key)
+            if cached is None:
+                return None
+            return ProfilePyramid.from_profile(cached[1], cached[3], cached[4])
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+class TableCache():
+    #Candidate tables kept in memory for re-filtering, most recently used
+    #last, each with its sorted threshold index built. Misses load just the
+    #table from the candidate store, not the rest of its entry.
+    def __init__(self, store, maxsize=16):
+        self.store = store
+        self.maxsize = maxsize
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+
+    #the PrimerTable stored under key, or None once it has been evicted
+    def get(self, key):
+        with self._lock:
+            if key in self._tables:
+                self._tables.move_to_end(key)
+                return self._tables[key]
+        table = self.store.primers(key)
+        if table is None:
+            return None
+        table.build_index()
+        with self._lock:
+            self._tables[key] = table
+            while len(self._tables) > self.maxsize:
+                self._tables.popitem(last=False)
+        return table
+
+
+_outgroup_store = None
+_candidate_store = None
+_table_cache = None
+
+#The store configured in settings, shared by every request of this process.
+def outgroup_store():
+    global _outgroup_store
+    if _outgroup_store is None:
+        _outgroup_store = OutgroupIndexStore(
+            getattr(settings, 'PRIMER_FINDER_OUTGROUP_CACHE_DIR',
+                    os.path.join(settings.BASE_DIR, 'cache', 'outgroups')),
+            getattr(settings, 'PRIMER_FINDER_OUTGROUP_CACHE_BYTES', 4 * 1024 ** 3))
+    return _outgroup_store
+
+
+def candidate_store():
+    global _candidate_store
+    if _candidate_store is None:
+        _candidate_store = CandidateStore(
+            getattr(settings, 'PRIMER_FINDER_CANDIDATE_CACHE_DIR',
+                    os.path.join(settings.BASE_DIR, 'cache', 'candidates')),
+            getattr(settings, 'PRIMER_FINDER_CANDIDATE_CACHE_BYTES', 1024 ** 3))
+    return _candidate_store
+
+
+def table_cache():
+    global _table_cache
+    if _table_cache is None:
+        _table_cache = TableCache(candidate_store(),
+                                  getattr(settings, 'PRIMER_FINDER_TABLE_CACHE_SIZE', 16))
+    return _table_cache
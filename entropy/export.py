@@ -0,0 +1,153 @@
+import csv
+import io
+import json
+import math
+
+#Streaming exports of a run's primer pairs and entropy profiles. Rows are
+#produced by generators and written out in batches, so a download is sent
+#while it is being generated and never held in memory whole. Parquet and
+#Arrow need pyarrow, which is only imported when one of them is asked for.
+
+#(name, pyarrow type) of every column
+_PRIMER_COLUMNS = [('seq', 'string'), ('pos', 'int64'), ('length', 'int64'),
+                   ('degeneracy', 'int64'), ('entropy', 'float64'),
+                   ('min_melting_temp', 'float64'), ('max_melting_temp', 'float64'),
+                   ('min_gc', 'float64'), ('max_gc', 'float64'),
+                   ('good_gc_clamp', 'bool_'), ('bad_gc_clamp', 'bool_')]
+PAIR_COLUMNS = [('pair', 'int64'), ('amplicon_length', 'int64')] + [
+    ('%s_%s' % (side, name), kind) for side in ('forward', 'reverse')
+    for name, kind in _PRIMER_COLUMNS]
+
+PROFILE_COLUMNS = [('k', 'int64'), ('position', 'int64'), ('entropy', 'float64')]
+
+#format: (content type, file extension)
+FORMATS = {'csv': ('text/csv', 'csv'),
+           'tsv': ('text/tab-separated-values', 'tsv'),
+           'jsonl': ('application/x-ndjson', 'jsonl'),
+           'parquet': ('application/vnd.apache.parquet', 'parquet'),
+           'arrow': ('application/vnd.apache.arrow.stream', 'arrows')}
+
+
+def _primer_values(primer):
+    melting_temps = primer.get('melting_temps') or [None, None]
+    gc = primer.get('gc') or [None, None]
+    return [primer['seq'], primer['pos'], primer.get('length', len(primer['seq'])),
+            primer['degeneracy'], primer.get('entropy'), melting_temps[0], melting_temps[1],
+            gc[0], gc[1], primer.get('good_gc_clamp'), primer.get('bad_gc_clamp')]
+
+
+#One row per pair record (jobs.pair_record), in PAIR_COLUMNS order.
+def pair_rows(records):
+    for n, record in enumerate(records, 1):
+        yield ([n, record['amplicon_length']] + _primer_values(record['forward'])
+               + _primer_values(record['reverse']))
+
+
+#One row per window of every primer length of (k, entropies) pairs; a window
+#that has a gap has no entropy.
+def profile_rows(profiles):
+    for k, values in profiles:
+        for position, value in enumerate(values.tolist()):
+            yield [k, position, None if math.isnan(value) else value]
+
+
+def _batches(rows, batch_rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_rows:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _delimited(columns, rows, delimiter, batch_rows):
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter=delimiter, lineterminator='\n')
+    writer.writerow([name for name, kind in columns])
+    for batch in _batches(rows, batch_rows):
+        writer.writerows(batch)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+
+def _jsonl(columns, rows, batch_rows):
+    columns = [name for name, kind in columns]
+    for batch in _batches(rows, batch_rows):
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in batch)
+
+
+class _Sink():
+    #Write-only file for pyarrow whose contents are taken away after every
+    #batch, so the written bytes can be streamed out.
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _columnar(columns, rows, fmt, batch_rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([(name, getattr(pa, kind)()) for name, kind in columns])
+    sink = _Sink()
+    if fmt == 'parquet':
+        writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+    else:
+        writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+    for batch in _batches(rows, batch_rows):
+        values = list(zip(*batch))
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(values[i], type=field.type) for i, field in enumerate(schema)],
+            schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+#The rows as a stream of str (csv, tsv, jsonl) or bytes (parquet, arrow)
+#chunks of batch_rows rows each; columns are (name, pyarrow type) pairs.
+#Unknown formats, and columnar ones without pyarrow, raise ValueError before
+#anything is generated.
+def stream(columns, rows, fmt, batch_rows=10000):
+    if fmt not in FORMATS:
+        raise ValueError('Unknown export format: %s' % fmt)
+    if fmt == 'csv':
+        return _delimited(columns, rows, ',', batch_rows)
+    if fmt == 'tsv':
+        return _delimited(columns, rows, '\t', batch_rows)
+    if fmt == 'jsonl':
+        return _jsonl(columns, rows, batch_rows)
+    try:
+        import pyarrow
+    except ImportError:
+        raise ValueError('%s export needs pyarrow, which is not installed' % fmt)
+    return _columnar(columns, rows, fmt, batch_rows)
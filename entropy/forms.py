@@ -3,6 +3,8 @@ from django.forms import ModelForm, Form
 from django import forms
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Layout, Submit, Row, Column, Field
+from .cache import outgroup_store
+from .primer_finder_classes import AlignmentMatrix
 
 class ParameterForm(ModelForm):
     class Meta:
@@ -32,17 +34,36 @@ class PrimerForm(Form):
     max_gc = forms.FloatField(widget=forms.NumberInput(attrs={'step': '0.00001', 'placeholder': 'Max GC - 0.6', 'class': 'form-control'}))
     find_gc_clamp = forms.BooleanField()
     filter_gc_clamp = forms.BooleanField()
+    ragged_ends = forms.BooleanField(required=False, label='Allow ragged ends')
+    sequence_weights = forms.FileField(required=False, label='Sequence weights (id,weight per line)')
+    approximate_rows = forms.IntegerField(required=False, min_value=2, label='Approximate: sample this many sequences',
+                                          widget=forms.NumberInput(attrs={'placeholder': 'Sampled Sequences - 1000', 'class': 'form-control'}))
     max_edit_distance = forms.IntegerField(widget=forms.NumberInput(attrs={'placeholder': 'Max Edit Distance - 1', 'class': 'form-control'}))
     outgroup_text = forms.CharField(required=False, widget=forms.TextInput(attrs={'placeholder':'Outgroup Text', 'class': 'form-control'}))
-    #outgroup_file = forms.FileField(required=False)
-    outgroup_file = forms.FileField()
+    outgroup_file = forms.FileField(required=False)
+    reference_outgroup = forms.ChoiceField(required=False, label='Or a reference outgroup')
+
+    #an upload without a single sequence is turned away here rather than
+    #failing the run
+    def clean_msa_file(self):
+        msa_file = self.cleaned_data['msa_file']
+        try:
+            AlignmentMatrix.check_fasta(msa_file.file)
+        except ValueError as e:
+            raise forms.ValidationError(str(e))
+        return msa_file
 
     #we only need one or the other of file/text for seq data
     def clean(self):
         cleaned_data = super().clean()
+        if not cleaned_data.get('outgroup_file') and not cleaned_data.get('reference_outgroup'):
+            raise forms.ValidationError('Upload an outgroup file or pick a reference outgroup')
+        return cleaned_data
         #
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.fields['reference_outgroup'].choices = [('', '---------')] + [
+            (name, name) for name in sorted(outgroup_store().references())]
         self.helper = FormHelper(self)
         self.helper.form_method = 'post'
         self.helper.form_show_errors = True
@@ -72,17 +93,21 @@ class PrimerForm(Form):
             Row(
                 Column('find_gc_clamp', css_class='form-group col-lg-3 col-sm-6 mb-2'),
                 Column('filter_gc_clamp', css_class='form-group col-lg-3 col-sm-6 mb-2'),
+                Column('ragged_ends', css_class='form-group col-lg-3 col-sm-6 mb-2'),
+                Column('sequence_weights', css_class='form-group col-lg-3 col-sm-6 mb-2'),
                 css_class='form-row'
             ),
             Row(
                 Column('max_edit_distance', css_class='form-group col-lg-4 mb-2'),
-                Column('outgroup_text', css_class='form-group col-lg-8 mb-2'),
+                Column('approximate_rows', css_class='form-group col-lg-4 mb-2'),
+                Column('outgroup_text', css_class='form-group col-lg-4 mb-2'),
                 css_class='form-row'
             ),
             Row(
-                Column(css_class='form-group col-lg-4 col-md-4 col-sm-4 col-xs-4 mb-2'),
+                Column(css_class='form-group col-lg-2 col-md-2 col-sm-2 col-xs-2 mb-2'),
                 Column('outgroup_file', css_class='form-group col-lg-4 col-md-4 col-sm-4 col-xs-4 text-center mb-2'),
-                Column(css_class='form-group col-lg-4 col-md-4 col-sm-4 col-xs-4 mb-2'),
+                Column('reference_outgroup', css_class='form-group col-lg-4 col-md-4 col-sm-4 col-xs-4 text-center mb-2'),
+                Column(css_class='form-group col-lg-2 col-md-2 col-sm-2 col-xs-2 mb-2'),
                 css_class='form-row'
             ),
             #CustomSubmitButton('SUBMIT')
@@ -94,3 +119,28 @@ class PrimerForm(Form):
             )
             
         )
+
+
+#Overrides for the re-filter endpoint; anything left out keeps the value of
+#the run being refined.
+class RefilterForm(Form):
+    amplicon_lower = forms.IntegerField(required=False)
+    amplicon_upper = forms.IntegerField(required=False)
+    max_degeneracy = forms.IntegerField(required=False)
+    min_melting_temp = forms.FloatField(required=False)
+    max_melting_temp = forms.FloatField(required=False)
+    min_gc = forms.FloatField(required=False)
+    max_gc = forms.FloatField(required=False)
+    find_gc_clamp = forms.NullBooleanField(required=False)
+    filter_gc_clamp = forms.NullBooleanField(required=False)
+    max_edit_distance = forms.IntegerField(required=False)
+    offset = forms.IntegerField(required=False, min_value=0)
+    limit = forms.IntegerField(required=False, min_value=0)
+
+
+#Column range and resolution of an entropy profile request.
+class ProfileForm(Form):
+    start = forms.IntegerField(required=False, min_value=0)
+    stop = forms.IntegerField(required=False, min_value=0)
+    points = forms.IntegerField(required=False, min_value=1, max_value=10000)
+    primers = forms.IntegerField(required=False, min_value=0, max_value=10000)
@@ -0,0 +1,409 @@
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import timedelta
+try:
+    import fcntl
+except ImportError:
+    #Unix only; without it the number of workers is not limited
+    fcntl = None
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import PrimerJob
+from .primer_finder_classes import PrimerFinder
+from .cache import outgroup_store, candidate_store, table_cache
+from . import export
+
+logger = logging.getLogger(__name__)
+
+#Background primer searches. Submitting the form stores the uploads in a
+#directory per job and a queued PrimerJob row in the database; a worker
+#process (manage.py run_primer_jobs) claims queued jobs one at a time, runs
+#the pipeline, reports each stage on the row and writes the results next to
+#the inputs. No broker: the database is the queue. A running job's worker
+#refreshes its heartbeat; if the worker dies, the job is queued again once
+#the heartbeat is stale, up to PRIMER_FINDER_JOB_ATTEMPTS times. At most
+#PRIMER_FINDER_JOB_WORKERS workers run at once: each holds the lock of one
+#worker slot file for as long as it lives.
+
+#stages PrimerFinder reports, in order
+STAGES = ["alignment", "entropy", "pairing", "outgroup", "plot"]
+
+#form fields that are parameters of the search
+PARAMETERS = ['min_primer_len', 'max_primer_len', 'na_conc', 'amplicon_lower',
+              'amplicon_upper', 'max_degeneracy', 'min_melting_temp', 'max_melting_temp',
+              'min_gc', 'max_gc', 'find_gc_clamp', 'filter_gc_clamp', 'ragged_ends',
+              'max_edit_distance', 'approximate_rows']
+
+
+def jobs_root():
+    return getattr(settings, 'PRIMER_FINDER_JOB_DIR', os.path.join(settings.BASE_DIR, 'jobs'))
+
+
+def job_directory(job_id):
+    return os.path.join(jobs_root(), str(job_id))
+
+
+def new_finder(progress=None, workers=None):
+    if workers is None:
+        workers = getattr(settings, 'PRIMER_FINDER_WORKERS', 1)
+    return PrimerFinder(workers=workers,
+                        outgroup_chunk=getattr(settings, 'PRIMER_FINDER_OUTGROUP_CHUNK', 1 << 22),
+                        progress=progress, candidate_store=candidate_store(),
+                        max_alignment_bytes=getattr(settings, 'PRIMER_FINDER_MAX_ALIGNMENT_BYTES', None),
+                        trace_memory=getattr(settings, 'PRIMER_FINDER_TRACE_MEMORY', False))
+
+
+#identify_pairs keyword arguments for a set of form parameters
+def pair_arguments(parameters):
+    return {'amp_min': parameters['amplicon_lower'],
+            'amp_max': parameters['amplicon_upper'],
+            'max_degeneracy': parameters['max_degeneracy'],
+            'min_melting_temp': parameters['min_melting_temp'],
+            'max_melting_temp': parameters['max_melting_temp'],
+            'min_gc': parameters['min_gc'],
+            'max_gc': parameters['max_gc'],
+            'select_gc_clamp': parameters['find_gc_clamp'],
+            'omit_gc_clamp': parameters['filter_gc_clamp'],
+            'max_edit_dist': parameters['max_edit_distance']}
+
+
+#The whole search for one set of form parameters. Returns the pairs (-1 when
+#there are none) and the plot html, which is only made when the settings ask
+#for it (PRIMER_FINDER_EMBED_PLOT); otherwise the results page draws the
+#profile from api/profile. The finder's run report is logged at the end,
+#also when a stage fails.
+def run_pipeline(finder, parameters, msa_file, outgroup, weights=None):
+    try:
+        primers = finder.identify_primers(filename=msa_file,
+                                          min_primer_length=parameters['min_primer_len'],
+                                          max_primer_length=parameters['max_primer_len'],
+                                          na_conc=parameters['na_conc'],
+                                          ragged_ends=parameters['ragged_ends'],
+                                          weights=weights,
+                                          approximate=parameters.get('approximate_rows'))
+        primerpairs = finder.identify_pairs(primers=primers, outgroup=outgroup,
+                                            **pair_arguments(parameters))
+        plot = None
+        if primerpairs != -1 and getattr(settings, 'PRIMER_FINDER_EMBED_PLOT', False):
+            plot = finder.html_plot()
+    finally:
+        finder.report.stop()
+        finder.report.log()
+    return primerpairs, plot
+
+
+def _primer_record(primer):
+    return {'seq': primer.seq, 'pos': int(primer.pos), 'length': int(primer.length),
+            'degeneracy': int(primer.degeneracy), 'entropy': float(primer.entropy),
+            'melting_temps': [float(t) for t in primer.melting_temps],
+            'gc': [float(g) for g in primer.gc],
+            'good_gc_clamp': bool(primer.good_gc_clamp), 'bad_gc_clamp': bool(primer.bad_gc_clamp)}
+
+
+def pair_record(pair):
+    return {'forward': _primer_record(pair.forward), 'reverse': _primer_record(pair.reverse),
+            'amplicon_length': int(pair.amplicon_length)}
+
+
+def _save_upload(upload, path):
+    with open(path, 'wb') as out:
+        for chunk in upload.chunks():
+            out.write(chunk)
+
+
+#text, or an iterable of str chunks, written to a temporary name first, so a
+#reader never sees half a file
+def _write_atomic(path, text):
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as out:
+        out.writelines([text] if isinstance(text, str) else text)
+    os.replace(out.name, path)
+
+
+def submit_job(form_data, files):
+    parameters = {name: form_data.get(name) for name in PARAMETERS}
+    job = PrimerJob(parameters=json.dumps(parameters),
+                    reference_outgroup=form_data.get('reference_outgroup') or '')
+    directory = job_directory(job.id)
+    os.makedirs(directory)
+    _save_upload(files['msa_file'], os.path.join(directory, 'msa.fa'))
+    if not job.reference_outgroup:
+        _save_upload(files['outgroup_file'], os.path.join(directory, 'outgroup.fa'))
+    if files.get('sequence_weights'):
+        _save_upload(files['sequence_weights'], os.path.join(directory, 'weights.csv'))
+    job.save()
+    if getattr(settings, 'PRIMER_FINDER_SPAWN_WORKER', True):
+        spawn_worker()
+    return job
+
+
+#Start a worker that drains the queue and exits, unless every worker slot
+#is taken, in which case the running workers will get to the queued jobs.
+#The slot is locked here and handed to the worker, so calls in quick
+#succession never start more workers than there are slots. Returns whether
+#a worker was started.
+def spawn_worker():
+    slot = acquire_worker_slot()
+    if slot is None:
+        return False
+    with slot, open(os.path.join(jobs_root(), 'worker.log'), 'ab') as log:
+        subprocess.Popen([sys.executable, os.path.join(settings.BASE_DIR, 'manage.py'),
+                          'run_primer_jobs', '--until-empty', '--slot-fd', str(slot.fileno())],
+                         stdout=log, stderr=subprocess.STDOUT, start_new_session=True,
+                         pass_fds=[slot.fileno()])
+    return True
+
+
+#An open, locked worker slot file, or None when all PRIMER_FINDER_JOB_WORKERS
+#are taken. The lock goes with the file, including copies of it inherited by
+#a child process, and is released when the last of them is closed, so a
+#worker that dies frees its slot.
+def acquire_worker_slot():
+    os.makedirs(jobs_root(), exist_ok=True)
+    for i in range(getattr(settings, 'PRIMER_FINDER_JOB_WORKERS', 1)):
+        slot = open(os.path.join(jobs_root(), 'worker-%d.lock' % i), 'a')
+        if fcntl is None:
+            return slot
+        try:
+            fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return slot
+        except OSError:
+            slot.close()
+    return None
+
+
+#The oldest queued job, marked running, or None. The conditional update is
+#what makes a claim exclusive between workers. Jobs whose worker has died
+#are queued again first.
+def claim_next_job():
+    requeue_stale_jobs()
+    for job_id in PrimerJob.objects.filter(status=PrimerJob.QUEUED).order_by('created') \
+                                   .values_list('id', flat=True)[:20]:
+        now = timezone.now()
+        claimed = PrimerJob.objects.filter(pk=job_id, status=PrimerJob.QUEUED) \
+                                   .update(status=PrimerJob.RUNNING, started=now, heartbeat=now,
+                                           attempts=F('attempts') + 1)
+        if claimed:
+            return PrimerJob.objects.get(pk=job_id)
+    return None
+
+
+#Running jobs whose heartbeat is older than PRIMER_FINDER_JOB_TIMEOUT
+#seconds: their worker has died. Each goes back to the queue, or fails once
+#it has been tried PRIMER_FINDER_JOB_ATTEMPTS times, since it may be what
+#kills its workers. Returns how many were queued again.
+def requeue_stale_jobs():
+    timeout = getattr(settings, 'PRIMER_FINDER_JOB_TIMEOUT', 300)
+    attempts = getattr(settings, 'PRIMER_FINDER_JOB_ATTEMPTS', 3)
+    cutoff = timezone.now() - timedelta(seconds=timeout)
+    stale = PrimerJob.objects.filter(Q(heartbeat__lt=cutoff) | Q(heartbeat=None, started__lt=cutoff),
+                                     status=PrimerJob.RUNNING)
+    requeued = 0
+    for job in stale:
+        #only if no other worker has touched it since it was read
+        same = PrimerJob.objects.filter(pk=job.pk, status=PrimerJob.RUNNING, heartbeat=job.heartbeat)
+        if job.attempts >= attempts:
+            same.update(status=PrimerJob.FAILED, finished=timezone.now(),
+                        message='Gave up after %d workers stopped responding while running '
+                                'this job' % job.attempts)
+        else:
+            requeued += same.update(status=PrimerJob.QUEUED, stage='', progress=0, started=None,
+                                    heartbeat=None)
+    return requeued
+
+
+#Refreshes a running job's heartbeat every PRIMER_FINDER_JOB_HEARTBEAT
+#seconds, from a thread of its own, until stopped.
+class _Heartbeat():
+    def __init__(self, job):
+        self.job = job
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        interval = getattr(settings, 'PRIMER_FINDER_JOB_HEARTBEAT', 30)
+        try:
+            while not self.stopped.wait(interval):
+                PrimerJob.objects.filter(pk=self.job.pk, status=PrimerJob.RUNNING) \
+                                 .update(heartbeat=timezone.now())
+        finally:
+            #the thread's own database connection
+            connection.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def run_job(job):
+    directory = job_directory(job.id)
+    parameters = json.loads(job.parameters)
+
+    def progress(stage):
+        PrimerJob.objects.filter(pk=job.pk).update(
+            stage=stage, progress=STAGES.index(stage) / len(STAGES), heartbeat=timezone.now())
+
+    try:
+        with _Heartbeat(job):
+            if job.reference_outgroup:
+                outgroup = outgroup_store().reference(job.reference_outgroup)
+            else:
+                with open(os.path.join(directory, 'outgroup.fa')) as outgroup_file:
+                    outgroup = outgroup_store().from_fasta(outgroup_file)
+            weights = os.path.join(directory, 'weights.csv')
+            finder = new_finder(progress)
+            primerpairs, plot = run_pipeline(finder, parameters, os.path.join(directory, 'msa.fa'),
+                                             outgroup, weights if os.path.exists(weights) else None)
+            pairs = [] if primerpairs == -1 else primerpairs
+            #one pair record per line, so exports can read them back one at a time
+            _write_atomic(os.path.join(directory, 'pairs.jsonl'),
+                          (json.dumps(pair_record(pair)) + '\n' for pair in pairs))
+            _write_atomic(os.path.join(directory, 'pairs.json'), json.dumps(
+                {'refilter': refilter_state(finder, outgroup, parameters),
+                 'report': finder.report.as_dict()}))
+            if plot is not None:
+                _write_atomic(os.path.join(directory, 'plot.html'), plot)
+            PrimerJob.objects.filter(pk=job.pk).update(
+                status=PrimerJob.DONE, stage='', progress=1, n_pairs=len(pairs),
+                finished=timezone.now())
+    except Exception as e:
+        #the traceback stays in the worker log; the page shows what went wrong
+        #with the input, as the form would
+        logger.exception("job %s failed", job.id)
+        PrimerJob.objects.filter(pk=job.pk).update(
+            status=PrimerJob.FAILED, message=job_error_message(e), finished=timezone.now())
+
+
+#What a failed job's page says: the message of a ValueError, raised for
+#unusable input, and nothing of the server's internals otherwise.
+def job_error_message(error):
+    if isinstance(error, ValueError):
+        return str(error)
+    return 'The search failed with an internal error (%s)' % type(error).__name__
+
+
+def _job_output(job):
+    with open(os.path.join(job_directory(job.id), 'pairs.json')) as f:
+        return json.load(f)
+
+
+def job_results(job):
+    return list(iter_job_results(job))
+
+
+#The pair records of a job, read as they are consumed. Jobs run before the
+#records had a file of their own keep them in pairs.json.
+def iter_job_results(job):
+    path = os.path.join(job_directory(job.id), 'pairs.jsonl')
+    if not os.path.exists(path):
+        yield from _job_output(job)['pairs']
+        return
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def job_refilter_state(job):
+    return _job_output(job).get('refilter')
+
+
+#RunReport.as_dict() of the job's search; None for jobs run before reports
+def job_report(job):
+    return _job_output(job).get('report')
+
+
+#Whether a request shows the run report: PRIMER_FINDER_SHOW_REPORT, or
+#?report=1 on the request
+def show_report(request):
+    if request.GET.get('report') is not None:
+        return request.GET['report'] not in ('', '0', 'false')
+    return getattr(settings, 'PRIMER_FINDER_SHOW_REPORT', False)
+
+
+#What the re-filter endpoint needs to find a run's candidates and outgroup
+#again; kept in the session of whoever looked at the results.
+def refilter_state(finder, outgroup, parameters):
+    return {'candidates': finder.candidate_key,
+            'outgroup': outgroup_store().key(outgroup.fingerprint),
+            'parameters': {name: parameters.get(name) for name in PARAMETERS}}
+
+
+#identify_pairs again over the cached candidates of a run, with some of the
+#filters changed. Returns None when the candidates have been evicted. With
+#lazy the pairs come from a generator (PrimerFinder.iter_pairs) instead of a
+#list.
+def refilter(state, overrides, lazy=False):
+    primers = table_cache().get(state['candidates'])
+    if primers is None or not outgroup_store().has(state['outgroup']):
+        return None
+    parameters = dict(state['parameters'])
+    parameters.update((name, value) for name, value in overrides.items() if value is not None)
+    outgroup = outgroup_store().load(state['outgroup'])
+    if lazy:
+        return new_finder().iter_pairs(primers=primers, outgroup=outgroup,
+                                       **pair_arguments(parameters))
+    primerpairs = new_finder().identify_pairs(primers=primers, outgroup=outgroup,
+                                              **pair_arguments(parameters))
+    return [] if primerpairs == -1 else primerpairs
+
+
+#The profile of a run between columns start and stop at about max_points
+#buckets, with its best max_primers candidates there. None when the run's
+#candidates have been evicted.
+def profile_range(state, start, stop, max_points, max_primers):
+    pyramid = candidate_store().pyramid(state['candidates'])
+    primers = table_cache().get(state['candidates'])
+    if pyramid is None or primers is None:
+        return None
+    stop = pyramid.n_cols if stop is None else stop
+    summary = pyramid.query(start, stop, max_points)
+    rows = primers.rows_in_range(start, stop)
+    profile = {'n_cols': pyramid.n_cols, 'n_rows': pyramid.n_rows, 'n_primers': len(rows),
+               'primers': [{'seq': primers.seqs[i], 'pos': int(primers.positions[i]),
+                            'length': int(primers.lengths[i]),
+                            'entropy': float(primers.entropies[i]),
+                            'degeneracy': int(primers.degeneracy[i])}
+                           for i in rows[:max_primers]]}
+    for name, values in summary.items():
+        if isinstance(values, np.ndarray):
+            #NaN (no window) is not JSON
+            values = [None if v != v else v for v in values.tolist()]
+        profile[name] = values
+    return profile
+
+
+#The rows of an export (export.PAIR_COLUMNS or PROFILE_COLUMNS) of a run, or
+#None when its candidates have been evicted. A job's pairs are read back from
+#its results; a session run's are found again by re-filtering with no
+#changes, which only screens the outgroup again if the screen cache forgot.
+#Everything is read or made as the rows are consumed: the pairs one at a
+#time and the profile one k at a time.
+def export_rows(state, what, records=None):
+    if what == 'profile':
+        profiles = candidate_store().iter_profiles(state['candidates'])
+        return None if profiles is None else export.profile_rows(profiles)
+    if records is None:
+        primerpairs = refilter(state, {}, lazy=True)
+        if primerpairs is None:
+            return None
+        records = (pair_record(pair) for pair in primerpairs)
+    return export.pair_rows(records)
+
+
+def job_plot(job):
+    try:
+        with open(os.path.join(job_directory(job.id), 'plot.html')) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,61 @@
+import json
+import tempfile
+from django.core.management.base import BaseCommand, CommandError
+from entropy.benchmark import run_benchmark, compare
+
+
+def _ints(text):
+    return [int(value) for value in text.split(",") if value]
+
+
+class Command(BaseCommand):
+    help = ("Time each stage of the search on synthetic alignments of several sizes and "
+            "write the results as JSON")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seqs", type=_ints, default=[100, 200, 400, 800],
+                            help="comma separated sequence counts")
+        parser.add_argument("--lengths", type=_ints, default=[2000],
+                            help="comma separated alignment lengths; every count is run at every length")
+        parser.add_argument("--repeat", type=int, default=3, help="timed runs per size, best kept")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--diversity", type=float, default=0.05)
+        parser.add_argument("--gap-rate", type=float, default=0.005)
+        parser.add_argument("--degeneracy", type=float, default=0.02)
+        parser.add_argument("--outgroup-seqs", type=int, default=50)
+        parser.add_argument("--outgroup-length", type=int, default=2000)
+        parser.add_argument("--min-primer-len", type=int, default=18)
+        parser.add_argument("--max-primer-len", type=int, default=21)
+        parser.add_argument("--no-memory", action="store_true",
+                            help="skip the traced run that measures peak memory")
+        parser.add_argument("--out", help="JSON file for the results (default: stdout)")
+        parser.add_argument("--compare", help="earlier results to compare the timings with")
+
+    def handle(self, *args, **options):
+        sizes = [(n, length) for length in options["lengths"] for n in options["seqs"]]
+        if not sizes:
+            raise CommandError("no sizes to run")
+        with tempfile.TemporaryDirectory(prefix="primer-benchmark-") as directory:
+            results = run_benchmark(
+                sizes, directory, repeat=options["repeat"], trace_memory=not options["no_memory"],
+                seed=options["seed"], diversity=options["diversity"],
+                gap_rate=options["gap_rate"], degeneracy=options["degeneracy"],
+                outgroup_seqs=options["outgroup_seqs"], outgroup_length=options["outgroup_length"],
+                min_primer_length=options["min_primer_len"],
+                max_primer_length=options["max_primer_len"],
+                progress=lambda line: self.stderr.write(line))
+        if options["out"]:
+            with open(options["out"], "w") as out:
+                json.dump(results, out, indent=1)
+        else:
+            self.stdout.write(json.dumps(results, indent=1))
+
+        for name, curve in results["curves"].items():
+            if curve["slope"] is not None:
+                self.stderr.write("%-28s scales as cells^%.2f" % (name, curve["slope"]))
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                ratios = compare(json.load(f), results)
+            for (n_seqs, length), stages in ratios.items():
+                self.stderr.write("%d x %d: %s" % (n_seqs, length, ", ".join(
+                    "%s x%.2f" % (name, ratio) for name, ratio in stages.items())))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from entropy.cache import outgroup_store
+
+
+class Command(BaseCommand):
+    help = "Index an outgroup FASTA once and make it selectable by name in the form"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name")
+        parser.add_argument("fasta", nargs="?")
+        parser.add_argument("--remove", action="store_true", help="forget the named reference")
+
+    def handle(self, *args, **options):
+        store = outgroup_store()
+        if options["remove"]:
+            store.unregister(options["name"])
+            return
+        if not options["fasta"]:
+            raise CommandError("a FASTA file is required to register %s" % options["name"])
+        with open(options["fasta"]) as fasta:
+            index = store.register(options["name"], fasta)
+        self.stdout.write("%s -> %s (%d records, %d bases)" % (
+            options["name"], index.fingerprint[:12], len(index.record_ends), len(index.text)))
@@ -0,0 +1,98 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management.base import BaseCommand, CommandError
+from entropy.cache import outgroup_store
+from entropy.utils import batch_job_id, run_batch_job
+
+
+class Command(BaseCommand):
+    help = ("Run every search of a JSONL manifest (msa, outgroup, optional weights and id, "
+            "and the form's parameters per line) and append one JSONL result per search")
+
+    def add_arguments(self, parser):
+        parser.add_argument("manifest")
+        parser.add_argument("results", help="JSONL file results are appended to")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                            help="searches run at once")
+        parser.add_argument("--rerun", action="store_true",
+                            help="run entries again even if the results already have them done")
+
+    def handle(self, *args, **options):
+        entries = self.read_manifest(options["manifest"])
+        done = set() if options["rerun"] else self.completed(options["results"])
+        pending = [entry for entry in entries if batch_job_id(entry) not in done]
+        self.stdout.write("%d searches, %d already done" % (len(entries), len(entries) - len(pending)))
+        if not pending:
+            return
+        self.index_outgroups(pending)
+
+        with open(options["results"], "a") as results:
+            #a line cut short by a crash must not swallow the next one
+            if results.tell() and not self.ends_with_newline(options["results"]):
+                results.write("\n")
+            with ProcessPoolExecutor(max_workers=options["workers"]) as pool:
+                futures = [pool.submit(run_batch_job, entry) for entry in pending]
+                for future in as_completed(futures):
+                    result = future.result()
+                    results.write(json.dumps(result) + "\n")
+                    results.flush()
+                    os.fsync(results.fileno())
+                    self.stdout.write("%s %s in %.1fs" % (result["id"], result["status"],
+                                                          result["timings"]["total"]))
+
+    def read_manifest(self, path):
+        entries = []
+        ids = set()
+        with open(path) as manifest:
+            for n, line in enumerate(manifest, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError as e:
+                    raise CommandError("%s line %d: %s" % (path, n, e))
+                for name in ("msa", "outgroup"):
+                    if name not in entry:
+                        raise CommandError("%s line %d has no %s" % (path, n, name))
+                if batch_job_id(entry) in ids:
+                    raise CommandError("%s line %d repeats id %s" % (path, n, batch_job_id(entry)))
+                ids.add(batch_job_id(entry))
+                entries.append(entry)
+        return entries
+
+    #ids that finished in an earlier run
+    def completed(self, path):
+        done = set()
+        if not os.path.exists(path):
+            return done
+        with open(path) as results:
+            for line in results:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get("status") == "done":
+                    done.add(result["id"])
+        return done
+
+    @staticmethod
+    def ends_with_newline(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    #Every outgroup FASTA is indexed into the shared store here, once, before
+    #the workers start; they then only memory-map the stored indexes.
+    def index_outgroups(self, entries):
+        store = outgroup_store()
+        references = store.references()
+        for path in sorted({entry["outgroup"] for entry in entries}):
+            if path in references:
+                continue
+            try:
+                with open(path) as outgroup_file:
+                    store.from_fasta(outgroup_file)
+            except OSError as e:
+                #reported by the searches that use it
+                self.stderr.write("cannot index outgroup %s: %s" % (path, e))
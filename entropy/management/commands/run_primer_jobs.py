@@ -0,0 +1,42 @@
+import os
+import time
+from django.core.management.base import BaseCommand
+from entropy.jobs import acquire_worker_slot, claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = "Run queued primer jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--until-empty", action="store_true",
+                            help="exit once the queue is empty instead of polling it")
+        parser.add_argument("--poll", type=float, default=2.0,
+                            help="seconds between checks of an empty queue")
+        parser.add_argument("--slot-fd", type=int,
+                            help="worker slot already locked for this worker (see spawn_worker)")
+
+    def handle(self, *args, **options):
+        #held until the worker exits
+        if options["slot_fd"] is not None:
+            slot = os.fdopen(options["slot_fd"], "a")
+        else:
+            slot = acquire_worker_slot()
+            while slot is None:
+                if options["until_empty"]:
+                    self.stdout.write("every worker slot is taken")
+                    return
+                time.sleep(options["poll"])
+                slot = acquire_worker_slot()
+        with slot:
+            self.run_jobs(options)
+
+    def run_jobs(self, options):
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if options["until_empty"]:
+                    return
+                time.sleep(options["poll"])
+                continue
+            self.stdout.write("running job %s" % job.id)
+            run_job(job)
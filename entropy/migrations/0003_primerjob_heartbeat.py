@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('entropy', '0002_primerjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='primerjob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='primerjob',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+    ]
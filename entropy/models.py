@@ -1,3 +1,4 @@
+import uuid
 from django.db import models
 
 #TODO defaults
@@ -24,3 +25,31 @@ class UserInput(models.Model):
     outgroup_file = models.FileField()
 
     # # # # # # # # # # # # #
+
+
+#A primer search submitted from the form and run by a worker process
+#(manage.py run_primer_jobs). Its inputs and results live in a directory of
+#their own, see entropy/jobs.py.
+class PrimerJob(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    stage = models.CharField(max_length=32, blank=True)
+    progress = models.FloatField(default=0)
+    message = models.TextField(blank=True)
+    #form parameters as JSON
+    parameters = models.TextField()
+    reference_outgroup = models.CharField(max_length=200, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    n_pairs = models.IntegerField(null=True, blank=True)
+    #refreshed by the worker while the job runs; a running job whose
+    #heartbeat stops is given to another worker (see jobs.requeue_stale_jobs)
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    attempts = models.IntegerField(default=0)
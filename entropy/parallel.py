@@ -0,0 +1,133 @@
+import math
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+import numpy as np
+from .primer_finder_classes import AlignmentMatrix, KmerEntropyEngine, OutgroupIndex
+
+#Process-pool version of KmerEntropyEngine.entropies_range. The alignment
+#codes are copied once into shared memory and every worker maps them, so no
+#worker ever receives a pickled copy of the alignment; the small per-column
+#indexes travel with the pool initializer. Work is split into column blocks
+#(and optionally into chunks of primer lengths); a block reads its windows'
+#tails past its own end straight from the shared matrix.
+
+#state of the current worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(name, shape, column_index, weights, ragged_ends):
+    shm = shared_memory.SharedMemory(name=name)
+    codes = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    matrix = AlignmentMatrix(codes, weights=weights)
+    matrix.set_column_index(column_index)
+    _worker["shm"] = shm
+    _worker["engine"] = KmerEntropyEngine(matrix, ragged_ends)
+
+
+def _entropy_task(task):
+    min_k, max_k, start, stop = task
+    return _worker["engine"].entropies_range(min_k, max_k, start, stop)
+
+
+#(min_k, max_k, start, stop) tasks in the order their results are merged:
+#k chunks outermost, then column blocks left to right.
+def entropy_tasks(n_starts, min_k, max_k, block_columns, k_chunk=None):
+    k_chunk = k_chunk or max(max_k - min_k, 1)
+    tasks = []
+    for k_lo in range(min_k, max_k, k_chunk):
+        k_hi = min(k_lo + k_chunk, max_k)
+        for lo in range(0, n_starts, block_columns):
+            tasks.append((k_lo, k_hi, lo, min(lo + block_columns, n_starts)))
+    return tasks
+
+
+#Same result as KmerEntropyEngine(alignment, ragged_ends).entropies_range(min_k,
+#max_k), including the order of every dictionary. block_columns defaults to
+#about four blocks per worker.
+def parallel_entropies_range(alignment, min_k, max_k, ragged_ends=False, workers=None,
+                             block_columns=None, k_chunk=None):
+    workers = workers or os.cpu_count()
+    results = {k: {} for k in range(min_k, max_k)}
+    if not results:
+        return results
+    n_starts = max(KmerEntropyEngine(alignment, ragged_ends).scan_columns() - min_k, 0)
+    if block_columns is None:
+        block_columns = max(64, math.ceil(n_starts / (4*workers)))
+    tasks = entropy_tasks(n_starts, min_k, max_k, block_columns, k_chunk)
+
+    codes = alignment.codes
+    shm = shared_memory.SharedMemory(create=True, size=max(codes.nbytes, 1))
+    try:
+        np.ndarray(codes.shape, dtype=np.uint8, buffer=shm.buf)[:] = codes
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(shm.name, codes.shape, alignment.column_index(),
+                                           alignment.weights, ragged_ends)) as pool:
+            #map yields in task order, so each k's positions come back sorted
+            for part in pool.map(_entropy_task, tasks):
+                for k, entropies in part.items():
+                    results[k].update(entropies)
+    finally:
+        shm.close()
+        shm.unlink()
+    return results
+
+
+#Outgroup screening over a process pool. The outgroup text is cut into shards
+#of chunk_size bases and every worker memory-maps the saved OutgroupIndex,
+#so a shard task carries only its bounds and the primer sequences still
+#undecided. A primer is decided as soon as one shard finds it near; new
+#shards are only given the rest, and screening stops once nothing is left.
+
+def _init_screen_worker(directory):
+    _worker["index"] = OutgroupIndex.load(directory)
+
+
+def _screen_task(task):
+    lo, hi, seqs, max_dist = task
+    index = _worker["index"]
+    return {seq for seq in seqs if index.seq_within(seq, max_dist, lo, hi)}
+
+
+#The subset of seqs with a window of the outgroup within max_dist, the same
+#as screening each with index.seq_within. An index that is not on disk yet
+#is saved to a temporary directory for the workers.
+def parallel_screen(index, seqs, max_dist, workers=None, chunk_size=1 << 22):
+    workers = workers or os.cpu_count()
+    n = len(index.text)
+    chunk_size = max(1, min(chunk_size, math.ceil(n / workers)))
+    shards = iter([(lo, min(lo + chunk_size, n)) for lo in range(0, n, chunk_size)])
+    near = set()
+    undecided = list(seqs)
+    tmp = None
+    directory = index.directory
+    if directory is None:
+        tmp = directory = tempfile.mkdtemp(prefix="outgroup-")
+        index.save(directory)
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_screen_worker,
+                               initargs=(directory,))
+    try:
+        running = set()
+        while True:
+            undecided = [seq for seq in undecided if seq not in near]
+            if not undecided:
+                break
+            while len(running) < 2*workers:
+                shard = next(shards, None)
+                if shard is None:
+                    break
+                running.add(pool.submit(_screen_task, (shard[0], shard[1], undecided, max_dist)))
+            if not running:
+                break
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                near |= future.result()
+    finally:
+        #shards still running when everything is decided are not waited for,
+        #unless their index lives in the temporary directory removed below
+        pool.shutdown(wait=tmp is not None, cancel_futures=True)
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return near
@@ -1,46 +1,710 @@
 from scipy.signal import find_peaks
 from scipy.stats import entropy
+from scipy.special import entr
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from Bio import SeqIO, AlignIO, Seq
 import itertools as it
 from math import log
-from collections import Counter
+from collections import Counter, OrderedDict
+import functools
+import hashlib
+import threading
 import Levenshtein as Lev
+from Bio.Data import IUPACData
 import tempfile
 import csv
 import os
+import json
+import zlib
+import lzma
+import bz2
+import logging
+import sys
+import time
+import tracemalloc
+try:
+    import resource
+except ImportError:
+    #Unix only; without it stage memory is only known when traced
+    resource = None
 #import cProfilelog
-import matplotlib, random
 import plotly.graph_objects as go
 from plotly.io._html import to_html
 
+logger = logging.getLogger(__name__)
+
+# Alignments are stored as one uint8 code per cell. The four nucleotides come
+# first so that a code can index straight into per-base lookup tables; rows
+# shorter than the alignment are padded with MISSING.
+NUCLEOTIDES = "ACGT"
+GAP = 4
+MISSING = 5
+INVALID = 255
+
+_CHAR_TO_CODE = np.full(256, INVALID, dtype=np.uint8)
+for _code, _char in enumerate(NUCLEOTIDES):
+    _CHAR_TO_CODE[ord(_char)] = _code
+    _CHAR_TO_CODE[ord(_char.lower())] = _code
+_CHAR_TO_CODE[ord("-")] = GAP
+_CODE_TO_CHAR = np.frombuffer(b"ACGT-?", dtype=np.uint8)
+
+# A/C/G/T presence bits of each code, and the IUPAC symbol for every
+# combination of presence bits (A=1, C=2, G=4, T=8).
+_CODE_TO_BIT = np.array([1, 2, 4, 8, 0, 0], dtype=np.uint8)
+_MASK_TO_IUPAC = np.frombuffer(b"-ACMGRSVTWYHKDBN", dtype=np.uint8)
+# Degeneracy of each IUPAC symbol: one less than the number of bases it allows.
+_MASK_DEGENERACY = np.array([0, 0, 0, 1, 0, 1, 1, 2, 0, 1, 1, 2, 1, 2, 2, 3], dtype=np.int64)
+_IUPAC_DEGENERACY = {chr(symbol): int(deg) for symbol, deg in zip(_MASK_TO_IUPAC, _MASK_DEGENERACY)}
+
+
+class AlignmentMatrix():
+    #weights, if given, count each row that many times in every k-mer count
+    #(deduplicated rows, or user supplied sequence weights); None is all ones.
+    def __init__(self, codes, ids=None, weights=None):
+        self.codes = np.ascontiguousarray(codes, dtype=np.uint8)
+        self.ids = list(ids) if ids is not None else []
+        self.weights = None if weights is None else np.asarray(weights)
+        self._gap_prefix = None
+        self._missing_prefix = None
+        self._row_lengths = None
+        self._column_masks = None
+        self._consensus = None
+        self._degeneracy_prefix = None
+
+    @classmethod
+    def from_sequences(cls, sequences, ids=None):
+        sequences = [str(seq) for seq in sequences]
+        width = max([len(seq) for seq in sequences], default=0)
+        codes = np.full((len(sequences), width), MISSING, dtype=np.uint8)
+        for i, seq in enumerate(sequences):
+            row = _CHAR_TO_CODE[np.frombuffer(seq.encode("ascii"), dtype=np.uint8)]
+            if (row == INVALID).any():
+                bad = seq[int(np.argmax(row == INVALID))]
+                raise ValueError("Sequence {0} contains unsupported character {1!r}".format(i, bad))
+            codes[i, :len(seq)] = row
+        return cls(codes, ids)
+
+    #Streaming FASTA reader. The file is read in chunks of chunk_size bytes,
+    #decompressed on the fly when it starts with a gzip, xz or bzip2 magic
+    #number, and each record is encoded straight into a growing code matrix,
+    #so only one record is ever held as text. Characters outside the
+    #alignment alphabet, and sequences whose length differs from the first
+    #one (unless allow_ragged), are reported as soon as the record is read.
+    #max_bytes bounds the size of the matrix.
+    @classmethod
+    def from_fasta(cls, source, allow_ragged=False, chunk_size=1 << 20, max_bytes=None):
+        if isinstance(source, str):
+            with open(source, "rb") as stream:
+                return cls.from_fasta(stream, allow_ragged, chunk_size, max_bytes)
+        builder = _MatrixBuilder(allow_ragged, max_bytes)
+        pending = bytearray()
+        for chunk in _decompressed_chunks(source, chunk_size):
+            if not builder.ids and not pending:
+                chunk = chunk.lstrip()
+                if chunk and not chunk.startswith(b">"):
+                    raise ValueError("Alignment is not in FASTA format")
+            pending += chunk
+            #every record but the last one in the buffer is complete
+            start = 0
+            end = pending.find(b"\n>")
+            while end >= 0:
+                builder.add(pending[start:end])
+                start = end + 1
+                end = pending.find(b"\n>", start)
+            del pending[:start]
+        if pending.strip():
+            builder.add(pending)
+        return builder.matrix()
+
+    #Raises the ValueError from_fasta would for a file without a single
+    #sequence (empty, or headers only), reading no further than the first
+    #sequence line, then rewinds the file. For checking uploads before they
+    #are queued.
+    @staticmethod
+    def check_fasta(source, chunk_size=1 << 16):
+        header = False
+        for chunk in _decompressed_chunks(source, chunk_size):
+            pos = 0
+            while pos < len(chunk):
+                end = chunk.find(b"\n", pos)
+                if end < 0:
+                    end = len(chunk)
+                if header or chunk.startswith(b">", pos):
+                    header = end == len(chunk)
+                elif chunk[pos:end].strip():
+                    source.seek(0)
+                    return
+                pos = end + 1
+        source.seek(0)
+        raise ValueError("alignment contains no sequences")
+
+    #One row per distinct sequence, weighted by the summed weight of its
+    #copies, in order of first appearance; rows of weight zero are dropped.
+    #Every k-mer count, and so every entropy, is unchanged. Rows are matched
+    #by a digest and confirmed byte for byte. When no row goes, this matrix
+    #is returned as it is. in_place moves the kept rows up within this
+    #matrix's codes instead of copying them, so no second matrix is ever
+    #allocated, and leaves this matrix unusable.
+    def deduplicate(self, in_place=False):
+        weights = self.weights if self.weights is not None else np.ones(self.n_seqs, dtype=np.int64)
+        first = {}
+        keep = []
+        inverse = np.empty(self.n_seqs, dtype=np.int64)
+        for i in range(self.n_seqs):
+            if weights[i] == 0:
+                inverse[i] = -1
+                continue
+            row = self.codes[i]
+            key = hashlib.blake2b(row, digest_size=16).digest()
+            j = first.get(key)
+            if j is None or not np.array_equal(self.codes[keep[j]], row):
+                if j is not None:
+                    #digest collision: keep the rows apart
+                    key = (key, i)
+                j = first[key] = len(keep)
+                keep.append(i)
+            inverse[i] = j
+        if len(keep) == self.n_seqs:
+            return self
+        kept = inverse >= 0
+        unique_weights = np.bincount(inverse[kept], weights=weights[kept], minlength=len(keep))
+        if np.issubdtype(weights.dtype, np.integer):
+            unique_weights = unique_weights.astype(np.int64)
+        if in_place:
+            #keep is increasing, so a row only ever moves onto one already
+            #moved or dropped
+            codes = self.codes
+            for j, i in enumerate(keep):
+                if i != j:
+                    codes[j] = codes[i]
+            codes = codes[:len(keep)]
+        else:
+            codes = self.codes[keep]
+        return AlignmentMatrix(codes, [self.ids[i] for i in keep] if self.ids else None,
+                               unique_weights)
+
+    #A reproducible sample of n sequences, drawn with replacement in
+    #proportion to the row weights, for estimating k-mer entropies. The
+    #sample keeps this matrix's column indexes, so gaps, consensus and
+    #degeneracy still describe every sequence; only the counts are sampled.
+    def subsample(self, n, seed=0):
+        rng = np.random.default_rng(seed)
+        p = None
+        if self.weights is not None:
+            p = self.weights/self.weights.sum()
+        counts = np.bincount(rng.choice(self.n_seqs, size=n, p=p), minlength=self.n_seqs)
+        rows = np.flatnonzero(counts)
+        index = self.column_index()
+        index["row_lengths"] = self.row_lengths[rows]
+        sample = AlignmentMatrix(self.codes[rows], [self.ids[i] for i in rows] if self.ids else None,
+                                 counts[rows])
+        sample.set_column_index(index)
+        return sample
+
+    #A copy weighted by {sequence id: weight}; every sequence needs a weight.
+    def with_weights(self, weights_by_id):
+        missing = [seq_id for seq_id in self.ids if seq_id not in weights_by_id]
+        if missing:
+            raise ValueError("No weight given for sequence {0}".format(missing[0]))
+        weights = np.array([weights_by_id[seq_id] for seq_id in self.ids], dtype=np.float64)
+        if (weights < 0).any() or not np.isfinite(weights).all():
+            raise ValueError("Sequence weights must be finite and not negative")
+        return AlignmentMatrix(self.codes, self.ids, weights)
+
+    @property
+    def n_seqs(self):
+        return self.codes.shape[0]
+
+    @property
+    def n_cols(self):
+        return self.codes.shape[1]
+
+    #views below share the underlying buffer, nothing is copied.
+    def row(self, i):
+        return self.codes[i]
+
+    def column(self, j):
+        return self.codes[:, j]
+
+    def window(self, start, end):
+        return self.codes[:, start:end]
+
+    #Column-level gap and missing-data index, built once on first use. The
+    #prefix sums make "does window [start, end) contain a gap?" a constant
+    #time lookup; row lengths give where each (possibly ragged) row ends.
+    def _build_index(self):
+        gaps = (self.codes == GAP).any(axis=0)
+        missing = self.codes == MISSING
+        self._gap_prefix = np.concatenate(([0], np.cumsum(gaps)))
+        self._missing_prefix = np.concatenate(([0], np.cumsum(missing.any(axis=0))))
+        #rows are only ever padded at the end
+        self._row_lengths = self.n_cols - np.argmin(missing[:, ::-1], axis=1)
+        self._row_lengths[missing.all(axis=1)] = 0
+
+    @property
+    def gap_prefix(self):
+        if self._gap_prefix is None:
+            self._build_index()
+        return self._gap_prefix
+
+    @property
+    def missing_prefix(self):
+        if self._missing_prefix is None:
+            self._build_index()
+        return self._missing_prefix
+
+    @property
+    def row_lengths(self):
+        if self._row_lengths is None:
+            self._build_index()
+        return self._row_lengths
+
+    def window_has_gap(self, start, end):
+        return self.gap_prefix[end] - self.gap_prefix[start] > 0
+
+    def window_has_missing(self, start, end):
+        return self.missing_prefix[end] - self.missing_prefix[start] > 0
+
+    #index of the first column any sequence is missing, or n_cols
+    def first_missing_column(self):
+        return int(np.searchsorted(self.missing_prefix, 1)) - 1
+
+    #Per-column IUPAC index, built once on first use: the A/C/G/T presence
+    #mask of every column, its IUPAC symbol, and prefix sums of the symbols'
+    #degeneracy. A window's consensus is then a slice of one string and its
+    #degeneracy a subtraction.
+    def _build_iupac_index(self):
+        masks = np.zeros(self.n_cols, dtype=np.uint8)
+        for lo in range(0, self.n_seqs, 1024):
+            masks |= np.bitwise_or.reduce(_CODE_TO_BIT[self.codes[lo:lo + 1024]], axis=0)
+        self._column_masks = masks
+        self._consensus = _MASK_TO_IUPAC[masks].tobytes().decode("ascii")
+        self._degeneracy_prefix = np.concatenate(([0], np.cumsum(_MASK_DEGENERACY[masks])))
+
+    @property
+    def column_masks(self):
+        if self._column_masks is None:
+            self._build_iupac_index()
+        return self._column_masks
+
+    @property
+    def consensus(self):
+        if self._consensus is None:
+            self._build_iupac_index()
+        return self._consensus
+
+    def window_consensus(self, start, end):
+        return self.consensus[start:end]
+
+    def window_degeneracy(self, start, end):
+        if self._degeneracy_prefix is None:
+            self._build_iupac_index()
+        return int(self._degeneracy_prefix[end] - self._degeneracy_prefix[start])
+
+    #Every per-column index, so a copy of the matrix in another process can
+    #take them over instead of rebuilding them.
+    def column_index(self):
+        return {"gap_prefix": self.gap_prefix, "missing_prefix": self.missing_prefix,
+                "row_lengths": self.row_lengths, "column_masks": self.column_masks,
+                "consensus": self.consensus, "degeneracy_prefix": self._degeneracy_prefix}
+
+    def set_column_index(self, index):
+        for name, value in index.items():
+            setattr(self, "_" + name, value)
+
+    def row_string(self, i):
+        row = self.codes[i]
+        return _CODE_TO_CHAR[row[row != MISSING]].tobytes().decode("ascii")
+
+    def to_dataframe(self):
+        chars = _CODE_TO_CHAR[self.codes].view("S1").astype(str).astype(object)
+        chars[self.codes == MISSING] = None
+        return pd.DataFrame(chars)
+
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_XZ_MAGIC = b"\xfd7zXZ\x00"
+_BZIP2_MAGIC = b"BZh"
+
+
+#Raw chunks of a (possibly compressed) file, decompressed incrementally,
+#none longer than chunk_size however well the file compresses. Text streams
+#are read as latin-1 so that every character maps to a byte.
+def _decompressed_chunks(stream, chunk_size):
+    def raw_chunks():
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                return
+            if isinstance(chunk, str):
+                chunk = chunk.encode("latin-1")
+            yield chunk
+
+    chunks = raw_chunks()
+    first = next(chunks, b"")
+    if first.startswith(_GZIP_MAGIC):
+        new_decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif first.startswith(_XZ_MAGIC):
+        new_decompressor = lzma.LZMADecompressor
+    elif first.startswith(_BZIP2_MAGIC):
+        new_decompressor = bz2.BZ2Decompressor
+    else:
+        if first:
+            yield first
+        yield from chunks
+        return
+    decompressor = new_decompressor()
+    for data in it.chain([first], chunks):
+        while True:
+            if decompressor.eof:
+                #concatenated members (cat a.gz b.gz) each start a new stream
+                data = decompressor.unused_data + data
+                if not data:
+                    break
+                decompressor = new_decompressor()
+            chunk = decompressor.decompress(data, chunk_size)
+            if chunk:
+                yield chunk
+            if hasattr(decompressor, "unconsumed_tail"):
+                #zlib hands back the input it has not got to (which past the
+                #end of a stream is unused_data as well), and may hold output
+                #back when it filled the chunk
+                data = b"" if decompressor.eof else decompressor.unconsumed_tail
+                more = bool(data) or len(chunk) == chunk_size
+            else:
+                #bz2 and lzma keep it, and say whether they want more
+                data = b""
+                more = not decompressor.needs_input
+            if not more and not decompressor.eof:
+                break
+    if hasattr(decompressor, "flush"):
+        yield decompressor.flush()
+    if not decompressor.eof:
+        raise ValueError("Compressed alignment is truncated")
+
+
+#Row-by-row construction of an AlignmentMatrix whose final size is unknown.
+#Rows are over-allocated by half again whenever they run out, and trimmed at
+#the end; both are done in place unless a longer (ragged) row widens the
+#matrix.
+class _MatrixBuilder():
+    def __init__(self, allow_ragged, max_bytes):
+        self.allow_ragged = allow_ragged
+        self.max_bytes = max_bytes
+        self.ids = []
+        self.codes = np.empty((0, 0), dtype=np.uint8)
+
+    def add(self, record):
+        header, _, body = bytes(record).partition(b"\n")
+        name = header[1:].split(None, 1)
+        name = name[0].decode("latin-1") if name else ""
+        row = _CHAR_TO_CODE[np.frombuffer(body.translate(None, b" \t\r\n"), dtype=np.uint8)]
+        if (row == INVALID).any():
+            bad = int(np.argmax(row == INVALID))
+            raise ValueError("Sequence {0} contains unsupported character {1!r} at position {2}"
+                             .format(name, chr(body.translate(None, b" \t\r\n")[bad]), bad + 1))
+        n = len(self.ids)
+        width = self.codes.shape[1]
+        if n == 0:
+            width = len(row)
+        elif len(row) != width and not self.allow_ragged:
+            raise ValueError("Sequence {0} has length {1} but the alignment has length {2}; "
+                             "allow ragged ends to accept sequences of different lengths"
+                             .format(name, len(row), width))
+        width = max(width, len(row))
+        rows = self.codes.shape[0]
+        if n == rows:
+            rows = max(16, n + n//2)
+        if rows != self.codes.shape[0] or width != self.codes.shape[1]:
+            self._grow(n, rows, width)
+        self.codes[n, :len(row)] = row
+        self.codes[n, len(row):] = MISSING
+        self.ids.append(name)
+
+    def _grow(self, n, rows, width):
+        if self.max_bytes is not None and (n + 1)*width > self.max_bytes:
+            raise ValueError("Alignment is larger than the {0} byte limit".format(self.max_bytes))
+        if self.max_bytes is not None:
+            rows = min(rows, self.max_bytes // max(width, 1))
+        if width == self.codes.shape[1]:
+            #in place (realloc), so growing never holds two copies of the matrix
+            self.codes.resize((rows, width), refcheck=False)
+            return
+        codes = np.full((rows, width), MISSING, dtype=np.uint8)
+        codes[:n, :self.codes.shape[1]] = self.codes[:n]
+        self.codes = codes
+
+    def matrix(self):
+        if not self.ids or not self.codes.shape[1]:
+            raise ValueError("alignment contains no sequences")
+        self.codes.resize((len(self.ids), self.codes.shape[1]), refcheck=False)
+        return AlignmentMatrix(self.codes, self.ids)
+
+
+#{sequence id: weight} from lines of "id,weight" (or tab/space separated),
+#read from a path or an open text or binary file.
+def read_sequence_weights(source):
+    if isinstance(source, str):
+        with open(source, "rb") as stream:
+            return read_sequence_weights(stream)
+    weights = {}
+    for number, line in enumerate(source, 1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.replace(",", " ").split()
+        try:
+            weights[fields[0]] = float(fields[1])
+        except (IndexError, ValueError):
+            raise ValueError("Line {0} of the weights file is not 'id,weight'".format(number))
+    return weights
+
+
 class SequenceAlignment():
-    def __init__(self, fasta_file):
-        self.data = self._fasta_to_df(fasta_file)
+    #The matrix has one weighted row per distinct sequence (see
+    #AlignmentMatrix.deduplicate); weights maps sequence ids to user weights.
+    def __init__(self, fasta_file, allow_ragged=True, max_bytes=None, weights=None):
+        matrix = AlignmentMatrix.from_fasta(fasta_file, allow_ragged, max_bytes=max_bytes)
+        self.n_sequences = matrix.n_seqs
+        if weights is not None:
+            matrix = matrix.with_weights(weights)
+        #the matrix read is not kept, so its rows can be compacted
+        self.matrix = matrix.deduplicate(in_place=True)
+        self._data = None
+
+    #DataFrame of single characters, only built for callers that still need it.
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.matrix.to_dataframe()
+        return self._data
+
+
+
+
+# Upper bound on the number of k-mer hashes held in memory at once while
+# scanning a block of window start positions.
+_ENGINE_BLOCK_CELLS = 1 << 22
+
+
+#counts are sorted high to low, the order pd.value_counts returned them in,
+#and the arithmetic is scipy.stats.entropy's, so the value is identical to
+#the original pandas loop without paying scipy's per-call overhead.
+@functools.lru_cache(maxsize=1 << 16)
+def _entropy_from_counts(counts):
+    kmer_counts = np.asarray(counts)
+    kmer_probs = kmer_counts/kmer_counts.sum()
+    kmer_probs = kmer_probs/np.sum(kmer_probs)
+    return float(np.sum(entr(kmer_probs)))
+
+
+#Sampling error of the plug-in entropy of counts drawn from n = sum(counts)
+#sequences: its Miller-Madow bias, (distinct k-mers - 1) / 2n, and its
+#delta-method variance, (sum p ln(p)^2 - H^2) / n.
+@functools.lru_cache(maxsize=1 << 16)
+def _entropy_error_from_counts(counts):
+    kmer_counts = np.asarray(counts, dtype=np.float64)
+    kmer_counts = kmer_counts[kmer_counts > 0]
+    n = kmer_counts.sum()
+    if n == 0:
+        return (float("nan"), float("nan"))
+    p = kmer_counts/n
+    log_p = np.log(p)
+    h = -np.sum(p*log_p)
+    return ((len(kmer_counts) - 1)/(2*n), max(float((np.sum(p*log_p*log_p) - h*h)/n), 0.0))
 
-    def _charwise_split(self, word):
-        return [char for char in word]
 
-    def _fasta_to_df(self,file):
-        fasta = SeqIO.parse(file, "fasta")
-        sample_data = []
-        for seq in fasta:
-            c = self._charwise_split(seq.seq)
-            sample_data.append(c)
-        return pd.DataFrame(sample_data)
+#Windows of an approximate profile whose exact entropy is computed from the
+#whole alignment to calibrate the intervals of the rest (_conformal_bounds)
+_CALIBRATION_WINDOWS = 200
 
 
+#Split conformal bounds for an approximate profile: scores are the
+#calibration windows' (exact - estimate) / scale, and estimate + scale*bound
+#then covers the exact entropy of a window drawn like them with probability
+#confidence, whatever the bias of the sample's estimate. The normal interval
+#of the delta-method variance alone misses the k-mers a sample never sees
+#and covered ~80% of windows at a nominal 95%. With too few scores for the
+#quantiles the most extreme ones are used; with none, the bounds are nan.
+def _conformal_bounds(scores, confidence):
+    scores = np.sort(np.asarray(scores, dtype=np.float64))
+    m = len(scores)
+    if m == 0:
+        return (float("nan"), float("nan"))
+    #ranks rounded outwards, less a margin for 1 - confidence not being exact
+    alpha = (1 - confidence)/2
+    low = int(np.floor((m + 1)*alpha + 1e-9)) - 1
+    high = int(np.ceil((m + 1)*(1 - alpha) - 1e-9)) - 1
+    return (float(scores[min(max(low, 0), m - 1)]), float(scores[min(max(high, 0), m - 1)]))
+
+
+class KmerEntropyEngine():
+    #with_errors: also record the sampling error of every window's entropy,
+    #(bias, variance) in self.errors[k][start], for a row sample (subsample()).
+    def __init__(self, alignment, ragged_ends=False, block_cells=_ENGINE_BLOCK_CELLS,
+                 with_errors=False):
+        self.alignment = alignment
+        self.ragged_ends = ragged_ends
+        self.block_cells = block_cells
+        self.with_errors = with_errors
+        self.errors = {}
+
+    #Entropy and IUPAC consensus of every window of k+1 columns (the window
+    #width the original df.loc[:, start:end] slice produced), keyed by start.
+    #Windows with gaps map to (None, None). By default the scan stops at the
+    #first window with missing data; with ragged_ends, sequences that end
+    #before a window ends are left out of that window's k-mer counts instead
+    #and the scan carries on to the end of the longest sequence.
+    def entropies(self, k, start=0, stop=None):
+        return self.entropies_range(k, k + 1, start, stop)[k]
+
+    #Same as entropies() for every k in range(min_k, max_k), in one sweep.
+    #The sequences of each start position are partitioned by their k-mer at
+    #the shortest length, and every longer length refines that partition by
+    #one more column instead of hashing and sorting the alignment again.
+    def entropies_range(self, min_k, max_k, start=0, stop=None):
+        results = {k: {} for k in range(min_k, max_k)}
+        widths = [k + 1 for k in results]
+        if not widths:
+            return results
+        n_cols = self.scan_columns()
+        limits = {}
+        for width in widths:
+            n_windows = max(n_cols - width + 1, 0)
+            limits[width] = n_windows if stop is None else min(stop, n_windows)
+
+        block = max(1, self.block_cells // max(self.alignment.n_seqs, 1))
+        for lo in range(start, limits[widths[0]], block):
+            hi = min(lo + block, limits[widths[0]])
+            self._block_entropies(lo, hi, widths, limits, results)
+        return results
+
+    #Columns the scan covers: all of them with ragged ends, otherwise up to
+    #the first missing value.
+    def scan_columns(self):
+        if self.ragged_ends:
+            return self.alignment.n_cols
+        return self.alignment.first_missing_column()
+
+    def _block_entropies(self, lo, hi, widths, limits, results):
+        window = self.alignment.window(lo, hi + widths[-1] - 1)
+        labels = None
+        for width in widths:
+            n_starts = min(hi, limits[width]) - lo
+            if n_starts <= 0:
+                break
+            if labels is None:
+                labels = self._partition(window[:, :n_starts + width - 1], width)
+            else:
+                bases = np.ascontiguousarray(window[:, width - 1:width - 1 + n_starts].T) & 3
+                labels = labels[:n_starts]*4 + bases
+            row_weights = self.alignment.weights
+            if self.ragged_ends:
+                ends = np.arange(lo + width, lo + width + n_starts)
+                covered = self.alignment.row_lengths[None, :] >= ends[:, None]
+                row_weights = covered if row_weights is None else covered*row_weights
+            labels, group_sizes = self._relabel(labels, row_weights)
+            counts, offsets = self._run_counts(group_sizes)
+            entropies = results[width - 1]
+            errors = self.errors.setdefault(width - 1, {})
+            for i in range(n_starts):
+                pos = lo + i
+                if self.alignment.window_has_gap(pos, pos + width):
+                    entropies[pos] = (None, None)
+                    continue
+                kmer_counts = tuple(counts[offsets[i]:offsets[i+1]])
+                entropies[pos] = (_entropy_from_counts(kmer_counts),
+                                  self.alignment.window_consensus(pos, pos + width))
+                if self.with_errors:
+                    errors[pos] = _entropy_error_from_counts(kmer_counts)
+
+    #Hash every sequence's k-mer at every start position of the window and
+    #label the sequences of each start by their distinct k-mer.
+    def _partition(self, window, width):
+        cols = np.ascontiguousarray((window & 3).T, dtype=np.uint64)
+        n_starts = cols.shape[0] - width + 1
+        #2 bits per base, so one word holds 32 bases exactly; wider windows
+        #are keyed on several words
+        n_words = -(-width // 32)
+        tail = width - 32*(n_words - 1)
+        words = []
+        if n_words > 1:
+            full = self._rolling_hash(cols, 32)
+            words = [full[32*j:32*j + n_starts] for j in range(n_words - 1)]
+        tail_hashes = self._rolling_hash(cols, tail)
+        words.append(tail_hashes[32*(n_words - 1):32*(n_words - 1) + n_starts])
+
+        if len(words) == 1:
+            order = np.argsort(words[0], axis=1)
+        else:
+            order = np.lexsort(words[::-1], axis=-1)
+        new_kmer = np.zeros(order.shape, dtype=bool)
+        new_kmer[:, 0] = True
+        for word in words:
+            word = np.take_along_axis(word, order, axis=1)
+            new_kmer[:, 1:] |= word[:, 1:] != word[:, :-1]
+        labels = np.empty(order.shape, dtype=np.int64)
+        np.put_along_axis(labels, order, np.cumsum(new_kmer, axis=1) - 1, axis=1)
+        return labels
+
+    #Renumber each start's labels densely from 0 and count the sequences in
+    #each group. A longer k-mer only refines the groups of a shorter one, so
+    #extending by a column is labels*4 + base followed by this linear pass.
+    #Sequences with zero weight are not counted; they share the label of a
+    #counted group, or 0, which never counts them later either since a
+    #sequence that has ended stays ended at every longer k.
+    def _relabel(self, keys, row_weights=None):
+        n_bins = int(keys.max()) + 1
+        flat = keys + np.arange(keys.shape[0])[:, None]*n_bins
+        if row_weights is not None:
+            row_weights = np.broadcast_to(row_weights, keys.shape).ravel()
+        group_sizes = np.bincount(flat.ravel(), weights=row_weights,
+                                  minlength=keys.shape[0]*n_bins)
+        group_sizes = group_sizes.reshape(keys.shape[0], n_bins)
+        #an uncounted key below every counted one would get rank -1
+        ranks = np.maximum(np.cumsum(group_sizes > 0, axis=1) - 1, 0)
+        return np.take_along_axis(ranks, keys, axis=1), group_sizes
+
+    #Non-empty group sizes of every start, each start's sizes sorted high to
+    #low, and the offsets of each start into them.
+    def _run_counts(self, group_sizes):
+        present = group_sizes > 0
+        counts = group_sizes[present]
+        rows = np.nonzero(present)[0]
+        counts = counts[np.lexsort((-counts, rows))]
+        offsets = np.concatenate(([0], np.cumsum(present.sum(axis=1))))
+        return counts.tolist(), offsets
+
+    #Rolling 2-bit packing of every run of `width` columns, one row per start.
+    def _rolling_hash(self, cols, width):
+        mask = np.uint64((1 << 2*width) - 1)
+        shift = np.uint64(2)
+        hashes = np.empty((cols.shape[0] - width + 1, cols.shape[1]), dtype=np.uint64)
+        h = np.zeros(cols.shape[1], dtype=np.uint64)
+        for j in range(cols.shape[0]):
+            h <<= shift
+            h |= cols[j]
+            h &= mask
+            if j >= width - 1:
+                hashes[j - width + 1] = h
+        return hashes
 
 
 class Primer():
-    def __init__(self, seq, pos, na_conc=None, entropy=0, entropy_peak=0):
+    #degeneracy can be passed in when it is already known, e.g. from the
+    #alignment's per-column index.
+    def __init__(self, seq, pos, na_conc=None, entropy=0, entropy_peak=0, degeneracy=None):
         self.seq = seq
         self.pos = pos
         self.na_conc = na_conc
         self.length = len(seq)
-        self.degeneracy = self._count_degeneracy(seq)
+        if degeneracy is None:
+            degeneracy = self._count_degeneracy(seq)
+        self.degeneracy = degeneracy
 
         min_gc, max_gc = self._get_gc_minmax(seq)
         self.melting_temps = self._get_melting_temp(min_gc, max_gc, na_conc)
@@ -53,6 +717,24 @@ class Primer():
         self.entropy=entropy
         self.entropy_peak=entropy_peak 
         
+    #Build a primer from attributes that were already computed, e.g. by a
+    #PrimerTable, without recounting anything.
+    @classmethod
+    def from_attributes(cls, seq, pos, na_conc, degeneracy, melting_temps, gc,
+                        good_gc_clamp, bad_gc_clamp, entropy=0, entropy_peak=0):
+        primer = cls.__new__(cls)
+        primer.seq = seq
+        primer.pos = pos
+        primer.na_conc = na_conc
+        primer.length = len(seq)
+        primer.degeneracy = degeneracy
+        primer.melting_temps = melting_temps
+        primer.gc = gc
+        primer.good_gc_clamp = good_gc_clamp
+        primer.bad_gc_clamp = bad_gc_clamp
+        primer.entropy = entropy
+        primer.entropy_peak = entropy_peak
+        return primer
 
     def _get_melting_temp(self, min_gc, max_gc, na_conc):
         min_seq = Counter(min_gc)
@@ -69,26 +751,15 @@ class Primer():
         #IF no [Na+], use basic measure.
         else:
             min_temp = (
-            64.9 + 41*(min_seq['G']+min_seq['C']-16.4)/(len(seq))
+            64.9 + 41*(min_seq['G']+min_seq['C']-16.4)/(len(min_gc))
             )
             max_temp = (
-            64.9 + 41*(max_seq['G']+max_seq['C']-16.4)/(len(seq))
+            64.9 + 41*(max_seq['G']+max_seq['C']-16.4)/(len(max_gc))
             )
         return((min_temp, max_temp))
 
     def _count_degeneracy(self,seq):
-        deg = 0
-        one_deg = set(['R', 'M', 'W', 'S', 'K', 'Y'])
-        two_deg = set(['V', 'D', 'H', 'B'])
-        three_deg = set(['N'])
-        for char in seq:
-            if char in one_deg:
-                deg += 1
-            elif char in two_deg:
-                deg += 2
-            elif char in three_deg:
-                deg += 3
-        return deg
+        return sum([_IUPAC_DEGENERACY.get(char, 0) for char in seq])
 
     def _get_gc_percent(self, min_gc, max_gc):
         min_chars = Counter(min_gc)
@@ -154,13 +825,253 @@ class Primer():
 
 
     def expand_sequence(self):
-        d = Seq.IUPAC.IUPACData.ambiguous_dna_values
+        d = IUPACData.ambiguous_dna_values
         return  list(map("".join, it.product(*map(d.get, self.seq))))
 
     def __str__(self):
         return self.seq
 
 
+# Per-symbol lookups used by PrimerTable. A symbol counts towards the lowest
+# GC content if it can only be G or C, and towards the highest if it can be
+# G or C at all (the same choices as Primer._get_gc_minmax).
+_SYMBOL_MIN_GC = np.zeros(256, dtype=np.int64)
+_SYMBOL_MAX_GC = np.zeros(256, dtype=np.int64)
+_SYMBOL_CLAMP_GC = np.zeros(256, dtype=np.int64)
+_SYMBOL_DEGENERACY = np.zeros(256, dtype=np.int64)
+for _symbol in "GCS":
+    _SYMBOL_MIN_GC[ord(_symbol)] = 1
+    _SYMBOL_CLAMP_GC[ord(_symbol)] = 1
+for _symbol in "GCRMSKYVDHBN":
+    _SYMBOL_MAX_GC[ord(_symbol)] = 1
+for _symbol, _deg in _IUPAC_DEGENERACY.items():
+    _SYMBOL_DEGENERACY[ord(_symbol)] = _deg
+
+
+class PrimerTable():
+    #Structure-of-arrays view of many candidate primers. Tm, GC, degeneracy
+    #and clamp flags are computed for every candidate at once; Primer objects
+    #are only built for the rows that are actually looked at.
+    def __init__(self, seqs, positions, na_conc=None, entropies=None, degeneracy=None):
+        self.seqs = np.empty(len(seqs), dtype=object)
+        self.seqs[:] = list(seqs)
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.na_conc = na_conc
+        self.lengths = np.array([len(seq) for seq in self.seqs], dtype=np.int64)
+        if entropies is None:
+            entropies = np.zeros(len(self.seqs))
+        self.entropies = np.asarray(entropies, dtype=np.float64)
+
+        symbols = np.frombuffer("".join(self.seqs).encode("ascii"), dtype=np.uint8)
+        ends = np.cumsum(self.lengths)
+        starts = ends - self.lengths
+
+        def window_sums(table, starts):
+            prefix = np.concatenate(([0], np.cumsum(table[symbols])))
+            return prefix[ends] - prefix[starts]
+
+        if degeneracy is None:
+            degeneracy = window_sums(_SYMBOL_DEGENERACY, starts)
+        self.degeneracy = np.asarray(degeneracy, dtype=np.int64)
+        min_gc = window_sums(_SYMBOL_MIN_GC, starts)
+        max_gc = window_sums(_SYMBOL_MAX_GC, starts)
+        self.min_melting_temps = self._melting_temps(min_gc)
+        self.max_melting_temps = self._melting_temps(max_gc)
+        self.min_gc = min_gc/self.lengths
+        self.max_gc = max_gc/self.lengths
+
+        #Ideally, the last 5 bases of the 3' end will have 1-2 G's or C's.
+        clamp_gc = window_sums(_SYMBOL_CLAMP_GC, np.maximum(ends - 5, starts))
+        self.good_gc_clamp = (clamp_gc == 1) | (clamp_gc == 2)
+        self.bad_gc_clamp = clamp_gc > 3
+
+        self._primers = {}
+        self._sorted = None
+
+    #The constructor inputs are enough to rebuild the table, see load().
+    def save(self, directory):
+        np.savez(os.path.join(directory, "primers.npz"),
+                 seqs=self.seqs.astype("S"), positions=self.positions,
+                 entropies=self.entropies, degeneracy=self.degeneracy)
+        with open(os.path.join(directory, "primers.json"), "w") as meta:
+            json.dump({"na_conc": self.na_conc}, meta)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, "primers.json")) as meta:
+            meta = json.load(meta)
+        with np.load(os.path.join(directory, "primers.npz")) as arrays:
+            return cls(arrays["seqs"].astype(str), arrays["positions"], meta["na_conc"],
+                       arrays["entropies"], arrays["degeneracy"])
+
+    #Rows of the candidates starting in columns [start, stop), the lowest
+    #entropy first, at most limit of them.
+    def rows_in_range(self, start, stop, limit=None):
+        rows = np.flatnonzero((self.positions >= start) & (self.positions < stop))
+        rows = rows[np.argsort(self.entropies[rows], kind="stable")]
+        return rows[:limit]
+
+    @classmethod
+    def from_primers(cls, primers):
+        primers = list(primers)
+        na_conc = primers[0].na_conc if primers else None
+        return cls([p.seq for p in primers], [p.pos for p in primers], na_conc,
+                   [p.entropy for p in primers], [p.degeneracy for p in primers])
+
+    #Same formulas as Primer._get_melting_temp, applied to every row.
+    def _melting_temps(self, gc_counts):
+        if self.na_conc:
+            return ((self.lengths - gc_counts)*2 + gc_counts*4
+                    - 16.6*log(0.05, 10) + 16.6*log(self.na_conc, 10))
+        return 64.9 + 41*(gc_counts - 16.4)/self.lengths
+
+    #Rows that pass the attribute filters of PrimerFinder.identify_pairs.
+    _INDEXED = ("degeneracy", "min_melting_temps", "max_melting_temps", "min_gc", "max_gc")
+
+    #Sorted copies of the threshold columns, so that attribute_mask can find
+    #the rows passing each threshold with a binary search. Worth building for
+    #a table that is filtered over and over with new thresholds.
+    def build_index(self):
+        if self._sorted is None:
+            self._sorted = {}
+            for name in self._INDEXED:
+                values = getattr(self, name)
+                order = np.argsort(values, kind="stable")
+                #NaNs sort last and never pass a threshold
+                n_valid = len(values) - int(np.count_nonzero(np.isnan(values[order])))
+                self._sorted[name] = (values[order], order, n_valid)
+        return self
+
+    #Rows with lo <= column (or column <= hi), from the sorted index.
+    def _rows_within(self, name, lo=None, hi=None):
+        values, order, n_valid = self._sorted[name]
+        if lo is not None:
+            return order[np.searchsorted(values[:n_valid], lo, side="left"):n_valid]
+        return order[:np.searchsorted(values[:n_valid], hi, side="right")]
+
+    #counts, if given, is filled with the number of rows that pass each
+    #filter on its own, and of those that pass them all ("all").
+    def attribute_mask(self, max_degeneracy, min_melting_temp, max_melting_temp,
+                       min_gc, max_gc, select_gc_clamp, omit_gc_clamp, counts=None):
+        if self._sorted is None:
+            passed = [("degeneracy", self.degeneracy <= max_degeneracy),
+                      ("max_melting_temp", self.max_melting_temps <= max_melting_temp),
+                      ("min_melting_temp", self.min_melting_temps >= min_melting_temp),
+                      ("min_gc", self.min_gc >= min_gc),
+                      ("max_gc", self.max_gc <= max_gc)]
+            mask = functools.reduce(np.logical_and, [test for name, test in passed])
+            if counts is not None:
+                counts.update((name, int(np.count_nonzero(test))) for name, test in passed)
+        else:
+            #start from the most selective threshold and test only its rows
+            within = [("degeneracy", self._rows_within("degeneracy", hi=max_degeneracy)),
+                      ("max_melting_temp", self._rows_within("max_melting_temps", hi=max_melting_temp)),
+                      ("min_melting_temp", self._rows_within("min_melting_temps", lo=min_melting_temp)),
+                      ("min_gc", self._rows_within("min_gc", lo=min_gc)),
+                      ("max_gc", self._rows_within("max_gc", hi=max_gc))]
+            rows = min([rows for name, rows in within], key=len)
+            keep = ((self.degeneracy[rows] <= max_degeneracy)
+                    & (self.max_melting_temps[rows] <= max_melting_temp)
+                    & (self.min_melting_temps[rows] >= min_melting_temp)
+                    & (self.min_gc[rows] >= min_gc)
+                    & (self.max_gc[rows] <= max_gc))
+            mask = np.zeros(len(self.seqs), dtype=bool)
+            mask[rows[keep]] = True
+            if counts is not None:
+                counts.update((name, len(rows)) for name, rows in within)
+        if select_gc_clamp:
+            mask &= self.good_gc_clamp
+        if omit_gc_clamp:
+            mask &= ~self.bad_gc_clamp
+        if counts is not None:
+            if select_gc_clamp:
+                counts["select_gc_clamp"] = int(np.count_nonzero(self.good_gc_clamp))
+            if omit_gc_clamp:
+                counts["omit_gc_clamp"] = int(np.count_nonzero(~self.bad_gc_clamp))
+            counts["all"] = int(np.count_nonzero(mask))
+        return mask
+
+    #Every (forward, reverse) pair of the given rows whose amplicon length,
+    #reverse.pos - (forward.pos + forward.length), is within [amp_min, amp_max].
+    #Rows are swept in position order and each forward primer's reverse
+    #partners are found by binary search, so the work grows with the number
+    #of pairs rather than the square of the number of rows.
+    def pair_indices(self, rows, amp_min, amp_max):
+        rows, lo, hi = self._pair_ranges(rows, amp_min, amp_max)
+        return self._expand_pairs(rows, lo, hi)
+
+    #pair_indices in batches of about batch_pairs pairs, in the same order,
+    #so the pairs of a large table need not be held at once.
+    def iter_pair_indices(self, rows, amp_min, amp_max, batch_pairs=1 << 16):
+        rows, lo, hi = self._pair_ranges(rows, amp_min, amp_max)
+        totals = np.cumsum(hi - lo)
+        start = 0
+        while start < len(rows):
+            before = totals[start - 1] if start else 0
+            stop = max(int(np.searchsorted(totals, before + batch_pairs, side="right")), start + 1)
+            yield self._expand_pairs(rows, lo[start:stop], hi[start:stop], start)
+            start = stop
+
+    #The rows that are in at least one of the pairs of pair_indices, without
+    #making the pairs.
+    def paired_rows(self, rows, amp_min, amp_max):
+        rows, lo, hi = self._pair_ranges(rows, amp_min, amp_max)
+        index = np.arange(len(rows))
+        #a row is never paired with itself
+        itself = (lo <= index) & (index < hi)
+        partners = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.add.at(partners, lo, 1)
+        np.add.at(partners, hi, -1)
+        as_reverse = np.cumsum(partners)[:-1] - itself
+        as_forward = hi - lo - itself
+        return rows[(as_forward > 0) | (as_reverse > 0)]
+
+    #rows in (position, length) order, and for each the range [lo, hi) of
+    #that order its reverse partners fall in
+    def _pair_ranges(self, rows, amp_min, amp_max):
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = rows[np.lexsort((self.lengths[rows], self.positions[rows]))]
+        positions = self.positions[rows]
+        ends = positions + self.lengths[rows]
+        lo = np.searchsorted(positions, ends + amp_min, side="left")
+        hi = np.searchsorted(positions, ends + amp_max, side="right")
+        return rows, lo, np.maximum(hi, lo)
+
+    #the pairs of the forward rows first, first+1, ... whose ranges are lo, hi
+    def _expand_pairs(self, rows, lo, hi, first=0):
+        counts = hi - lo
+        forward = np.repeat(np.arange(first, first + len(counts)), counts)
+        #lo[f], lo[f]+1, ..., hi[f]-1 for every forward primer f
+        reverse = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - lo, counts)
+        distinct = forward != reverse
+        return rows[forward[distinct]], rows[reverse[distinct]]
+
+    def primer(self, i):
+        i = int(i)
+        if i not in self._primers:
+            self._primers[i] = Primer.from_attributes(
+                seq=self.seqs[i],
+                pos=int(self.positions[i]),
+                na_conc=self.na_conc,
+                degeneracy=int(self.degeneracy[i]),
+                melting_temps=(float(self.min_melting_temps[i]), float(self.max_melting_temps[i])),
+                gc=(float(self.min_gc[i]), float(self.max_gc[i])),
+                good_gc_clamp=bool(self.good_gc_clamp[i]),
+                bad_gc_clamp=bool(self.bad_gc_clamp[i]),
+                entropy=float(self.entropies[i]))
+        return self._primers[i]
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def __getitem__(self, i):
+        return self.primer(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.primer(i)
+
+
 class PrimerPair():
     def __init__(self, forward, reverse):
         self.forward = forward
@@ -197,83 +1108,714 @@ Reverse:
         return out
 
 
+# Outgroup text is matched case-sensitively, as Lev.distance compares it, so
+# only upper-case bases take part in exact seeds.
+_OUTGROUP_CODE = np.full(256, INVALID, dtype=np.uint8)
+for _code, _char in enumerate(NUCLEOTIDES):
+    _OUTGROUP_CODE[ord(_char)] = _code
+
+
+class IUPACMatcher():
+    #Bounded edit-distance matching of a degenerate primer, treating each
+    #IUPAC symbol as the class of bases it stands for. This gives the same
+    #distances as taking the best of Primer.expand_sequence(), without
+    #expanding: a text base matches a primer position if it is in its class.
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.length = len(pattern)
+        self.classes = [IUPACData.ambiguous_dna_values[char] for char in pattern]
+        #peq[c] has bit i set if text byte c matches pattern position i
+        self.peq = [0]*256
+        for i, bases in enumerate(self.classes):
+            for base in bases:
+                self.peq[ord(base)] |= 1 << i
+
+    #Myers' bit-vector algorithm. Yields every position j in text[start:stop]
+    #(an index into text) at which some substring ending at j is within
+    #max_dist edits of the whole pattern. One pass, whatever the degeneracy.
+    def search(self, text, max_dist, start=0, stop=None):
+        stop = len(text) if stop is None else stop
+        m = self.length
+        if m == 0:
+            return
+        mask = (1 << m) - 1
+        high = 1 << (m - 1)
+        pv = mask
+        mv = 0
+        score = m
+        peq = self.peq
+        for j in range(start, stop):
+            eq = peq[text[j]]
+            xv = eq | mv
+            xh = (((eq & pv) + pv) ^ pv) | eq
+            ph = mv | (~(xh | pv) & mask)
+            mh = pv & xh
+            if ph & high:
+                score += 1
+            elif mh & high:
+                score -= 1
+            ph = (ph << 1) & mask
+            mh = (mh << 1) & mask
+            pv = mh | (~(xv | ph) & mask)
+            mv = ph & xv
+            if score <= max_dist:
+                yield j
+
+    #Edit distance between the pattern and a window of the same length, or
+    #max_dist + 1 as soon as it is certain to exceed max_dist. Only the band
+    #of cells within max_dist of the diagonal can stay under the bound.
+    def window_distance(self, window, max_dist):
+        m = self.length
+        n = len(window)
+        over = max_dist + 1
+        if abs(m - n) > max_dist:
+            return over
+        previous = [j if j <= max_dist else over for j in range(n + 1)]
+        for i in range(1, m + 1):
+            bases = self.classes[i - 1]
+            lo = max(1, i - max_dist)
+            hi = min(n, i + max_dist)
+            current = [over]*(n + 1)
+            current[0] = i if i <= max_dist else over
+            best = current[0] if lo == 1 else over
+            for j in range(lo, hi + 1):
+                cost = previous[j - 1] + (window[j - 1] not in bases)
+                if previous[j] + 1 < cost:
+                    cost = previous[j] + 1
+                if current[j - 1] + 1 < cost:
+                    cost = current[j - 1] + 1
+                if cost > over:
+                    cost = over
+                current[j] = cost
+                if cost < best:
+                    best = cost
+            if best > max_dist:
+                return over
+            previous = current
+        return previous[n]
+
+
+# Seeds are only looked up while a piece expands to at most this many exact
+# strings; more degenerate primers are found with one IUPACMatcher pass.
+_MAX_SEED_VARIANTS = 64
+
+
+class OutgroupIndex():
+    #q-gram index over the concatenated outgroup sequences. Every position is
+    #keyed by the 2-bit packed q bases starting there, together with how many
+    #of those bases are valid (A/C/G/T before any other character or the end
+    #of the sequence). Sorting the keys turns "where does this short string
+    #occur?" into a binary search, for any string of up to q bases.
+    def __init__(self, text, record_starts, record_ends, q=12, keys=None, positions=None,
+                 valid_lengths=None, fingerprint=None):
+        self.text = text
+        self.record_starts = np.asarray(record_starts, dtype=np.int64)
+        self.record_ends = np.asarray(record_ends, dtype=np.int64)
+        self.q = q
+        if keys is None:
+            keys, positions, valid_lengths = self._build(text, self.record_ends, q)
+        self.keys = keys
+        self.positions = positions
+        self.valid_lengths = valid_lengths
+        if fingerprint is None:
+            fingerprint = self.fingerprint_of(text, self.record_ends)
+        self.fingerprint = fingerprint
+        #where the index was loaded from, if it lives on disk, and the format
+        #it was saved in
+        self.directory = None
+        self.format = self.FORMAT
+
+    #Content hash identifying the outgroup, independent of file names.
+    @staticmethod
+    def fingerprint_of(text, record_ends):
+        digest = hashlib.sha256()
+        digest.update(np.asarray(record_ends, dtype="<i8").tobytes())
+        digest.update(np.asarray(text).tobytes())
+        return digest.hexdigest()
+
+    @classmethod
+    def from_sequences(cls, sequences, q=12):
+        text, record_starts, record_ends = cls.concatenate(sequences)
+        return cls(text, record_starts, record_ends, q)
+
+    #The text and record boundaries an index over `sequences` is built from.
+    @staticmethod
+    def concatenate(sequences):
+        sequences = [str(seq) for seq in sequences]
+        lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        record_ends = np.cumsum(lengths)
+        text = np.frombuffer("".join(sequences).encode("latin-1"), dtype=np.uint8)
+        return text, record_ends - lengths, record_ends
+
+    @classmethod
+    def from_fasta(cls, file, q=12):
+        return cls.from_sequences([str(x.seq) for x in SeqIO.parse(file, "fasta")], q)
+
+    _ARRAYS = ("text", "record_starts", "record_ends", "keys", "positions", "valid_lengths")
+    #saved indexes of an older format have to be built again (2: seeds may
+    #start at the first base of a sequence)
+    FORMAT = 2
+
+    #One .npy file per array, so a saved index can be memory-mapped back.
+    def save(self, directory):
+        for name in self._ARRAYS:
+            np.save(os.path.join(directory, name + ".npy"), getattr(self, name))
+        with open(os.path.join(directory, "index.json"), "w") as meta:
+            json.dump({"q": self.q, "fingerprint": self.fingerprint, "format": self.FORMAT}, meta)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        with open(os.path.join(directory, "index.json")) as meta:
+            meta = json.load(meta)
+        arrays = {name: np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode)
+                  for name in cls._ARRAYS}
+        index = cls(q=meta["q"], fingerprint=meta["fingerprint"], **arrays)
+        index.directory = directory
+        index.format = meta.get("format", 1)
+        return index
+
+    def _build(self, text, record_ends, q):
+        n = len(text)
+        codes = _OUTGROUP_CODE[text]
+        barrier = codes == INVALID
+        starts = np.arange(n)
+        barrier_at = np.where(barrier, starts, n)
+        next_barrier = np.minimum.accumulate(barrier_at[::-1])[::-1]
+        #no seed spans two sequences: each position is also cut off at the
+        #end of its own record
+        own_end = record_ends[np.searchsorted(record_ends, starts, side="right")] if n else starts
+        valid_lengths = np.minimum(np.minimum(next_barrier, own_end) - starts, q).astype(np.uint8)
+
+        padded = np.concatenate((np.where(barrier, 0, codes), np.zeros(q, dtype=np.uint8)))
+        keys = np.zeros(n, dtype=np.uint32)
+        for j in range(q):
+            keys |= padded[j:j + n].astype(np.uint32) << np.uint32(2*(q - 1 - j))
+        order = np.argsort(keys, kind="stable")
+        position_type = np.uint32 if n < 2**32 else np.int64
+        return keys[order], order.astype(position_type), valid_lengths[order]
+
+    #Positions where `piece` (A/C/G/T only) occurs exactly.
+    def occurrences(self, piece):
+        length = len(piece)
+        prefix = piece[:self.q]
+        key = 0
+        for char in prefix:
+            key = key*4 + NUCLEOTIDES.index(char)
+        key <<= 2*(self.q - len(prefix))
+        lo = np.searchsorted(self.keys, key, side="left")
+        hi = np.searchsorted(self.keys, key + (1 << 2*(self.q - len(prefix))), side="left")
+        found = self.positions[lo:hi][self.valid_lengths[lo:hi] >= len(prefix)].astype(np.int64)
+        if length > self.q and len(found):
+            #check the rest of the piece directly against the text
+            rest = np.frombuffer(piece[self.q:].encode("ascii"), dtype=np.uint8)
+            found = found[found + length <= self._record_end(found)]
+            tails = self.text[found[:, None] + np.arange(self.q, length)]
+            found = found[(tails == rest).all(axis=1)]
+        return found
+
+    def _record_end(self, positions):
+        return self.record_ends[np.searchsorted(self.record_ends, positions, side="right")]
+
+    #Does any window of the outgroup have edit distance <= max_dist to the
+    #primer? Windows are the same ones PrimerFinder._outgroup_distance scans:
+    #every length-k substring of a sequence except the one ending at its last
+    #base. Split into max_dist+1 pieces, an alignment with at most max_dist
+    #edits leaves one piece untouched, so only windows around exact piece
+    #occurrences (shifted by at most max_dist) need to be verified. Primers
+    #too degenerate to seed are located with one IUPACMatcher pass instead.
+    def within(self, primer, max_dist):
+        return self.seq_within(primer.seq, max_dist)
+
+    #within() for a primer sequence, looking only at windows starting in
+    #[lo, hi) of the concatenated text, so the outgroup can be screened in
+    #independent shards.
+    def seq_within(self, seq, max_dist, lo=0, hi=None):
+        k = len(seq)
+        if hi is None:
+            hi = len(self.text)
+        if max_dist < 0:
+            return False
+        if max_dist >= k:
+            first = np.maximum(self.record_starts, lo)
+            return bool((first < np.minimum(self.record_ends - k, hi)).any())
+        matcher = IUPACMatcher(seq)
+        checked = set()
+        for starts in self._candidate_starts(matcher, max_dist, lo, hi):
+            for start in starts:
+                if start in checked or start < lo or start >= hi:
+                    continue
+                checked.add(start)
+                window = self.text[start:start + k].tobytes().decode("latin-1")
+                if matcher.window_distance(window, max_dist) <= max_dist:
+                    return True
+        return False
+
+    #Batches of window starts that may be within max_dist of the pattern.
+    def _candidate_starts(self, matcher, max_dist, lo, hi):
+        k = matcher.length
+        n_pieces = max_dist + 1
+        bounds = [k*j//n_pieces for j in range(n_pieces + 1)]
+        piece_variants = []
+        for offset, end in zip(bounds[:-1], bounds[1:]):
+            n_variants = np.prod([len(bases) for bases in matcher.classes[offset:end]])
+            if n_variants > _MAX_SEED_VARIANTS:
+                yield from self._scan_starts(matcher, max_dist, lo, hi)
+                return
+            piece_variants.append((offset, map("".join, it.product(*matcher.classes[offset:end]))))
+        for offset, pieces in piece_variants:
+            for piece in pieces:
+                found = self.occurrences(piece)
+                #a piece starts between offset - max_dist and offset + max_dist
+                #bases into any window it can anchor
+                found = found[(found >= lo + offset - max_dist) & (found < hi + offset + max_dist)]
+                if len(found):
+                    yield self._valid_starts(found - offset, found, max_dist, k)
+
+    #One Myers pass per sequence overlapping the shard. A window within
+    #max_dist ends at most max_dist bases after the end of the best matching
+    #substring.
+    def _scan_starts(self, matcher, max_dist, lo, hi):
+        k = matcher.length
+        for rec_start, rec_end in zip(self.record_starts.tolist(), self.record_ends.tolist()):
+            if rec_end <= lo or rec_start >= hi:
+                continue
+            seg_start = max(rec_start, lo)
+            seg_end = min(rec_end, hi + k + max_dist)
+            record = self.text[seg_start:seg_end].tobytes()
+            ends = np.fromiter(matcher.search(record, max_dist), dtype=np.int64) + seg_start
+            if len(ends):
+                yield self._valid_starts(ends - k + 1 + max_dist, ends, max_dist, k)
+
+    #Starts within max_dist of the anchors whose window lies inside the same
+    #sequence as the matching position that produced the anchor.
+    def _valid_starts(self, anchors, matched, max_dist, k):
+        starts = (anchors[:, None] + np.arange(-max_dist, max_dist + 1)).ravel()
+        record = np.searchsorted(self.record_ends, np.repeat(matched, 2*max_dist + 1), side="right")
+        keep = (starts >= self.record_starts[record]) & (starts + k < self.record_ends[record])
+        return np.unique(starts[keep]).tolist()
+
+
+class OutgroupScreenCache():
+    #Bounded LRU of outgroup screening results keyed by (primer sequence,
+    #outgroup fingerprint). Each entry keeps the largest edit bound the primer
+    #is known to be outside of and the smallest it is known to be within, so
+    #a later query with a different max_dist is often answered without
+    #screening again.
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def within(self, index, primer, max_dist):
+        known = self.lookup(index, primer.seq, max_dist)
+        if known is not None:
+            return known
+        result = index.within(primer, max_dist)
+        self.record(index, primer.seq, max_dist, result)
+        return result
+
+    #within() for many primers at once. Primers the cache cannot answer are
+    #handed to screen(seqs), which returns the set of those within max_dist;
+    #by default each is screened in turn. counts, if given, gets the number
+    #of primers answered from the cache ("cache_hits") and screened
+    #against the outgroup ("screened").
+    def within_many(self, index, primers, max_dist, screen=None, counts=None):
+        results = {}
+        pending = []
+        for primer in primers:
+            results[primer.seq] = self.lookup(index, primer.seq, max_dist)
+            if results[primer.seq] is None:
+                pending.append(primer)
+        if counts is not None:
+            counts["cache_hits"] = len(results) - len(pending)
+            counts["screened"] = len(pending)
+        if screen is None:
+            near = {primer.seq for primer in pending if index.within(primer, max_dist)}
+        else:
+            near = screen([primer.seq for primer in pending])
+        for primer in pending:
+            results[primer.seq] = primer.seq in near
+            self.record(index, primer.seq, max_dist, results[primer.seq])
+        return results
+
+    #True/False when the stored bounds decide the query, otherwise None.
+    def lookup(self, index, seq, max_dist):
+        key = (seq, index.fingerprint)
+        with self._lock:
+            far, near = self._entries.get(key, (-1, None))
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            if max_dist <= far or (near is not None and max_dist >= near):
+                self.hits += 1
+                return near is not None and max_dist >= near
+            self.misses += 1
+        return None
+
+    def record(self, index, seq, max_dist, result):
+        key = (seq, index.fingerprint)
+        with self._lock:
+            far, near = self._entries.get(key, (-1, None))
+            if result:
+                near = max_dist if near is None else min(near, max_dist)
+            else:
+                far = max(far, max_dist)
+            self._entries[key] = (far, near)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by every PrimerFinder in the process, so repeated runs against the
+# same outgroup reuse each other's screening.
+default_screen_cache = OutgroupScreenCache()
+
+
+#Start index of each of at most n_buckets equal runs of range(n).
+def _bucket_starts(n, n_buckets):
+    m = max(min(n, n_buckets), 1)
+    return np.unique(np.arange(m) * n // m)
+
+
+#Decimates the curve (x, y) to at most about 2*n_buckets points, keeping the
+#position of the lowest and of the highest value in each bucket (keep="min"
+#or "max" for only one of them), in order, so no peak or trough is lost. A
+#bucket with no values keeps one NaN, which still breaks the line.
+def _minmax_decimate(x, y, n_buckets, keep="both"):
+    y = np.asarray(y, dtype=np.float64)
+    if len(y) <= n_buckets:
+        return np.asarray(x), y
+    starts = _bucket_starts(len(y), n_buckets)
+    valid = np.flatnonzero(~np.isnan(y))
+    bucket = np.searchsorted(starts, valid, side="right") - 1
+    order = np.lexsort((y[valid], bucket))
+    valid = valid[order]
+    bucket = bucket[order]
+    picked = [starts[np.bincount(bucket, minlength=len(starts)) == 0]]
+    if keep in ("both", "min"):
+        picked.append(valid[np.r_[True, bucket[1:] != bucket[:-1]]])
+    if keep in ("both", "max"):
+        picked.append(valid[np.r_[bucket[1:] != bucket[:-1], True]])
+    positions = np.unique(np.concatenate(picked))
+    return np.asarray(x)[positions], y[positions]
+
+
+#The position with the lowest y in each of n_buckets buckets of range(n).
+def _bucket_minima(positions, y, n, n_buckets):
+    if len(positions) <= n_buckets:
+        return positions
+    bucket = np.searchsorted(_bucket_starts(n, n_buckets), positions, side="right") - 1
+    order = np.lexsort((y[positions], bucket))
+    bucket = bucket[order]
+    return np.sort(positions[order][np.r_[True, bucket[1:] != bucket[:-1]]])
+
+
+class GapProfile():
+    #All the entropy profile and the plot need of an alignment's gaps, so
+    #neither has to keep the alignment: the number of sequences with a gap in
+    #each column, and the same on a grid of at most ROWS row buckets by
+    #COLUMNS column buckets for the heatmap. A deduplicated row counts as
+    #every sequence it stands for (see AlignmentMatrix.weights).
+    ROWS = 200
+    COLUMNS = 1000
+
+    #n_sequences: the summed row weights, what gap counts are out of
+    def __init__(self, column_counts, n_sequences, n_rows, row_starts, row_weights, col_starts,
+                 grid):
+        self.column_counts = column_counts
+        self.n_sequences = n_sequences
+        self.n_rows = n_rows
+        self.n_cols = len(column_counts)
+        self.row_starts = row_starts
+        self.row_weights = row_weights
+        self.col_starts = col_starts
+        self.grid = grid
+
+    #Counted block_rows rows at a time, so only a block of the gap mask is
+    #ever held.
+    @classmethod
+    def from_matrix(cls, matrix, rows=ROWS, columns=COLUMNS, block_rows=1024):
+        weights = matrix.weights
+        if weights is None:
+            weights = np.ones(matrix.n_seqs, dtype=np.int64)
+        weights = np.asarray(weights)
+        row_starts = _bucket_starts(matrix.n_seqs, rows)
+        col_starts = _bucket_starts(matrix.n_cols, columns)
+        row_bucket = np.searchsorted(row_starts, np.arange(matrix.n_seqs), side="right") - 1
+        dtype = np.result_type(weights, np.int64)
+        column_counts = np.zeros(matrix.n_cols, dtype=dtype)
+        grid = np.zeros((len(row_starts), len(col_starts)), dtype=dtype)
+        for lo in range(0, matrix.n_seqs, block_rows):
+            gaps = matrix.codes[lo:lo + block_rows] == GAP
+            block_weights = weights[lo:lo + block_rows]
+            column_counts += block_weights @ gaps
+            np.add.at(grid, row_bucket[lo:lo + block_rows],
+                      np.add.reduceat(gaps, col_starts, axis=1, dtype=np.int64)
+                      * block_weights[:, None])
+        return cls(column_counts, weights.sum(), matrix.n_seqs, row_starts,
+                   np.add.reduceat(weights, row_starts), col_starts, grid)
+
+    #Row and column buckets of a heatmap of at most rows by columns cells,
+    #their first row or column and size, and the percentage of each cell's
+    #sequences with a gap there. Buckets are whole buckets of the stored
+    #grid, so asking for more than it has gives the grid itself.
+    def heatmap(self, rows, columns):
+        def merged(starts, n, n_buckets):
+            group = np.searchsorted(_bucket_starts(n, n_buckets), starts, side="right") - 1
+            return np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+        r = merged(self.row_starts, self.n_rows, rows)
+        c = merged(self.col_starts, self.n_cols, columns)
+        gap_counts = np.add.reduceat(np.add.reduceat(self.grid, r, axis=0), c, axis=1)
+        row_starts = self.row_starts[r]
+        col_starts = self.col_starts[c]
+        row_sizes = np.diff(np.append(row_starts, self.n_rows))
+        col_sizes = np.diff(np.append(col_starts, self.n_cols))
+        cells = np.outer(np.add.reduceat(self.row_weights, r), col_sizes)
+        gap_percent = np.rint(100*gap_counts / np.where(cells > 0, cells, 1)).astype(np.uint8)
+        return row_starts, row_sizes, col_starts, col_sizes, gap_percent
+
+    _ARRAYS = ("column_counts", "row_starts", "row_weights", "col_starts", "grid")
+
+    def save(self, directory):
+        np.savez(os.path.join(directory, "gaps.npz"), n_sequences=self.n_sequences,
+                 n_rows=self.n_rows, **{name: getattr(self, name) for name in self._ARRAYS})
+
+    @classmethod
+    def load(cls, directory):
+        with np.load(os.path.join(directory, "gaps.npz")) as arrays:
+            return cls(n_sequences=arrays["n_sequences"].item(), n_rows=int(arrays["n_rows"]),
+                       **{name: arrays[name] for name in cls._ARRAYS})
+
+
+class ProfilePyramid():
+    #Multi-resolution summary of a run's entropy profile for range queries.
+    #Level l has one bucket per 4**l columns holding the lowest and highest
+    #entropy (and calibrated interval bounds, for an approximate profile) of the
+    #windows starting in it and the number of gaps in its columns. A query
+    #reads the finest level that answers it in at most max_points buckets,
+    #so its cost depends on the points asked for, not on the range.
+    FACTOR = 4
+    _SUMMARIES = {"entropy_min": np.fmin, "entropy_max": np.fmax,
+                  "low": np.fmin, "high": np.fmax, "gap_count": np.add}
+
+    #n_rows is the number of sequences (the summed row weights) gap counts
+    #are out of
+    def __init__(self, levels, n_rows, n_cols):
+        self.levels = levels
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+
+    #gaps: the alignment's GapProfile
+    @classmethod
+    def from_profile(cls, entropy_values, gaps, intervals=None):
+        n_rows, n_cols = gaps.n_sequences, gaps.n_cols
+        gap_count = gaps.column_counts
+        def columns(values):
+            padded = np.full(n_cols, np.nan)
+            padded[:len(values)] = values
+            return padded
+        level = {"entropy_min": columns(entropy_values), "entropy_max": columns(entropy_values),
+                 "gap_count": gap_count}
+        if intervals is not None:
+            level["low"] = columns(intervals[0])
+            level["high"] = columns(intervals[1])
+        levels = [level]
+        while len(level["gap_count"]) > 1:
+            coarser = {}
+            for name, values in level.items():
+                fill = 0 if name == "gap_count" else np.nan
+                padded = np.concatenate((values, np.full(-len(values) % cls.FACTOR, fill,
+                                                         dtype=values.dtype)))
+                coarser[name] = cls._SUMMARIES[name].reduce(padded.reshape(-1, cls.FACTOR), axis=1)
+            levels.append(coarser)
+            level = coarser
+        return cls(levels, n_rows, n_cols)
+
+    def save(self, directory):
+        arrays = {"%s_%d" % (name, l): values for l, level in enumerate(self.levels)
+                  for name, values in level.items()}
+        np.savez(os.path.join(directory, "pyramid.npz"), n_rows=self.n_rows, n_cols=self.n_cols,
+                 **arrays)
+
+    @classmethod
+    def load(cls, directory):
+        with np.load(os.path.join(directory, "pyramid.npz")) as arrays:
+            levels = {}
+            for key in arrays.files:
+                name, _, l = key.rpartition("_")
+                if name in cls._SUMMARIES:
+                    levels.setdefault(int(l), {})[name] = arrays[key]
+            return cls([levels[l] for l in range(len(levels))], arrays["n_rows"].item(),
+                       int(arrays["n_cols"]))
+
+    #The buckets covering columns [start, stop) at the finest level with at
+    #most max_points of them: each bucket's first column and width, and its
+    #summaries, with the gap count as a fraction of the bucket's cells.
+    def query(self, start, stop, max_points=1000):
+        start = min(max(start, 0), self.n_cols)
+        stop = min(max(stop, start), self.n_cols)
+        l = 0
+        while l + 1 < len(self.levels) and -(-(stop - start) // self.FACTOR**l) > max_points:
+            l += 1
+        size = self.FACTOR**l
+        lo = start // size
+        hi = -(-stop // size)
+        bucket_starts = np.arange(lo, hi) * size
+        widths = np.minimum(bucket_starts + size, self.n_cols) - bucket_starts
+        summary = {"level": l, "bucket": size, "start": bucket_starts, "width": widths}
+        for name, values in self.levels[l].items():
+            if name == "gap_count":
+                summary["gap_fraction"] = values[lo:hi] / (widths * max(self.n_rows, 1))
+            else:
+                summary[name] = values[lo:hi]
+        return summary
+
+
+class RunReport():
+    #Wall time, CPU time and peak memory of each stage of a PrimerFinder run,
+    #and counters of the work done in it. A stage lasts until the next one
+    #starts or stop() is called; a stage run again adds to its totals.
+    #CPU time is this process's, so work handed to a worker pool only shows
+    #in wall time. Peak memory is the most allocated during the stage when
+    #trace_memory is set (tracemalloc, which slows Python code down),
+    #otherwise the process's resident high-water mark when the stage ends,
+    #where the platform reports it.
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self._current = None
+        self._tracing = False
+
+    def start(self, stage):
+        self._end()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            tracemalloc.reset_peak()
+        self._current = (stage, time.perf_counter(), time.process_time())
+
+    def stop(self):
+        self._end()
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def _end(self):
+        if self._current is None:
+            return
+        stage, wall, cpu = self._current
+        self._current = None
+        totals = self.stages.setdefault(stage, {"wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                "peak_bytes": None, "runs": 0})
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        totals["wall_seconds"] += wall
+        totals["cpu_seconds"] += cpu
+        totals["runs"] += 1
+        peak = self._peak_bytes()
+        if peak is not None:
+            totals["peak_bytes"] = max(totals["peak_bytes"] or 0, peak)
+        logger.debug("stage %s took %.3fs (%.3fs CPU)", stage, wall, cpu)
+
+    def _peak_bytes(self):
+        if self.trace_memory and tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[1]
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        #kilobytes everywhere but macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    #count() of every {name: n} of counts, as prefix_name
+    def count_all(self, prefix, counts):
+        for name, n in counts.items():
+            self.count("%s_%s" % (prefix, name), n)
+
+    #JSON ready: {"memory": "traced" | "max_rss", "stages": {stage: totals},
+    #"counters": {name: n}}
+    def as_dict(self):
+        return {"memory": "traced" if self.trace_memory else "max_rss",
+                "stages": {stage: dict(totals) for stage, totals in self.stages.items()},
+                "counters": dict(self.counters)}
+
+    def log(self, level=logging.INFO):
+        if not logger.isEnabledFor(level):
+            return
+        for stage, totals in self.stages.items():
+            peak = totals["peak_bytes"]
+            logger.log(level, "stage %s: %.3fs wall, %.3fs CPU, peak %s", stage,
+                       totals["wall_seconds"], totals["cpu_seconds"],
+                       "unknown" if peak is None else "%.1f MB" % (peak / 1e6))
+        logger.log(level, "counters: %s", ", ".join("%s=%d" % item for item in self.counters.items()))
+
+
 class PrimerFinder():
     
     ######################
-    def __init__(self):
+    #progress, if given, is called with the name of each stage as it starts
+    #candidate_store (see entropy/cache.py) keeps identify_primers results
+    #between runs on the same alignment
+    #report (a RunReport) times every stage and counts the work done in it;
+    #trace_memory measures each stage's allocations instead of the process's
+    #high-water mark
+    def __init__(self, screen_cache=None, workers=1, outgroup_chunk=1 << 22, progress=None,
+                 candidate_store=None, max_alignment_bytes=None, trace_memory=False):
+       self.workers = workers
+       self.report = RunReport(trace_memory)
+       self.max_alignment_bytes = max_alignment_bytes
+       self.candidate_store = candidate_store
+       self.candidate_key = None
+       #GapProfile of the last identify_primers' alignment
+       self.gaps = None
+       self.outgroup_chunk = outgroup_chunk
+       self.progress = progress
        self.entropy_values = None
        self.entropy_peaks = None
+       self.entropy_intervals = None
+       #{k: entropy of every window} of the last identify_primers
+       self.entropy_profiles = None
        self.primer_pairs = None
        self.sequence_alignment = None
+       self.screen_cache = screen_cache if screen_cache is not None else default_screen_cache
    ######################
+
+    def _report(self, stage):
+        self.report.start(stage)
+        if self.progress is not None:
+            self.progress(stage)
         
+    #alignment is a (sequences x columns) window of the alignment matrix.
+    #Each column becomes the IUPAC symbol for the set of bases present in it.
     def _alignment_to_string(self, alignment):
-        nuc_code_converter = {
-        "A"   :"A",
-        "G"   :"G",
-        "C"   :"C",
-        "T"   :"T",
-        "AG"  :"R",
-        "AC"  :"M",
-        "AT"  :"W",
-        "CG"  :"S",
-        "GT"  :"K",
-        "CT"  :"Y",
-        "ACG" :"V",
-        "AGT" :"D",
-        "ACT" :"H",
-        "CGT" :"B",
-        "ACGT":"N"
-        }
-
-        out = ""
-        for i in alignment:
-            out += nuc_code_converter["".join(sorted(list(set(alignment[i]))))]
-        return out
+        masks = np.bitwise_or.reduce(_CODE_TO_BIT[alignment], axis=0)
+        return _MASK_TO_IUPAC[masks].tobytes().decode("ascii")
     
     
-#- put each sequence of the input sequence alignment into a dataframe (kind of like a table or matrix)
-#- remove any positions in the alignment with null values from considetation
-#- make an empty list 
-#- start at the first position of the alignment
-#-  slide a window of size primer_length down the alignment
-#- for each position of the sliding window, calculate the entropy at that position using the scipy entropy function
-#- save those values to the list
-#- return the list
-    def _kmer_entropy(self, df, k):
-        #have to remove columns with NaN.
-        start = 0
-        end = k
-        entropies = {}
-        while end < len(df.columns):
-            window = df.loc[:, start:end]
-            #Stop if missing values are encountered
-            if window.isnull().values.any():
-                break
-            #don't use primers over gaps
-            if (window=='-').values.any():
-                
-                ######################
-                entropies[start]= (None, None)
-                ######################
-                
-                start += 1
-                end += 1
-                continue
-            kmers = []
-            primer_string = self._alignment_to_string(window)
-            for entry in window.values:
-                kmers.append("".join(entry))
-            kmer_counts = pd.DataFrame(data=kmers).apply(pd.value_counts)
-            kmer_probs = kmer_counts/kmer_counts.sum()
-            
-            entr = entropy(kmer_probs)
-            entropies[start] = (entr, primer_string)
-            start += 1
-            end += 1
-        #print("Entropies: ")
-        #print(entropies)
-        return entropies
+#- hash every sequence's k-mer at every position in one pass over the alignment matrix
+#- count the distinct hashes at each position
+#- stop at the first window with missing data, skip windows with gaps
+#- calculate the entropy at each position using the scipy entropy function
+#- return the dict of (entropy, consensus) by position
+    def _kmer_entropy(self, alignment, k, ragged_ends=False):
+        return KmerEntropyEngine(alignment, ragged_ends).entropies(k)
+
+    #_kmer_entropy for every k in range(min_k, max_k), computed in one sweep
+    #With more than one worker the sweep is split over a process pool.
+    def _kmer_entropy_range(self, alignment, min_k, max_k, ragged_ends=False):
+        if self.workers > 1:
+            from .parallel import parallel_entropies_range
+            return parallel_entropies_range(alignment, min_k, max_k, ragged_ends, self.workers)
+        return KmerEntropyEngine(alignment, ragged_ends).entropies_range(min_k, max_k)
 
     #def _kmer_entropy_export(self, entropies):
        
@@ -334,37 +1876,121 @@ class PrimerFinder():
         return(min_dist)
 
 
-    def identify_primers(self, filename, min_primer_length, max_primer_length, na_conc=None):
-        sequence_alignment = SequenceAlignment(filename)
+    #ragged_ends: keep scanning past sequences that end early, leaving them
+    #out of the windows they don't cover, instead of stopping at the first
+    #missing base.
+    #weights: {sequence id: weight} or a file of them (read_sequence_weights)
+    #approximate: estimate the entropy profile from a random sample of that
+    #many sequences (drawn with seed), with an interval per window in
+    #self.entropy_intervals that holds the exact entropy with probability
+    #confidence, calibrated on the exact entropy of _CALIBRATION_WINDOWS random
+    #windows. With exact_minima the primers found at the sample's minima get
+    #their exact entropy from the whole alignment.
+    def identify_primers(self, filename, min_primer_length, max_primer_length, na_conc=None,
+                         ragged_ends=False, weights=None, approximate=None, seed=0,
+                         confidence=0.95, exact_minima=True):
+        if weights is not None and not isinstance(weights, dict):
+            weights = read_sequence_weights(weights)
+        key = None
+        if self.candidate_store is not None:
+            options = None
+            if approximate:
+                options = {"approximate": approximate, "seed": seed, "confidence": confidence,
+                           "exact_minima": exact_minima}
+            key = self.candidate_store.key(filename, min_primer_length, max_primer_length,
+                                           na_conc, ragged_ends, weights, options)
+            cached = self.candidate_store.get(key)
+            if cached is not None:
+                primers, self.entropy_values, self.entropy_peaks, self.gaps = cached[:4]
+                self.entropy_intervals = cached[4]
+                self.entropy_profiles = self.candidate_store.profiles(key)
+                self.candidate_key = key
+                self.report.count("candidate_cache_hits")
+                self.report.count("candidates", len(primers))
+                return primers
+
+        self._report("alignment")
+        sequence_alignment = SequenceAlignment(filename, allow_ragged=ragged_ends,
+                                               max_bytes=self.max_alignment_bytes,
+                                               weights=weights)
         
         ######################
         self.sequence_alignment=sequence_alignment
         ######################
         
-        primers = []
+        seqs = []
+        positions = []
+        entropies = []
+        degeneracy = []
+        self._report("entropy")
+        self.entropy_intervals = None
+        self.entropy_profiles = {}
+        if approximate and approximate < sequence_alignment.n_sequences:
+            #entropies of a sample of the sequences, bias corrected, and the
+            #exact entropies of a random sample of the windows to calibrate
+            #the interval around each
+            sample = sequence_alignment.matrix.subsample(approximate, seed)
+            self.report.count("sampled_rows", approximate)
+            engine = KmerEntropyEngine(sample, ragged_ends, with_errors=True)
+            entropies_by_k = engine.entropies_range(min_primer_length, max_primer_length)
+            exact = KmerEntropyEngine(sequence_alignment.matrix, ragged_ends)
+            n_windows = len(entropies_by_k.get(min_primer_length, ()))
+            rng = np.random.default_rng(seed)
+            calibration = {k: {} for k in entropies_by_k}
+            for i in rng.choice(n_windows, min(_CALIBRATION_WINDOWS, n_windows), replace=False):
+                for k, window in exact.entropies_range(min_primer_length, max_primer_length,
+                                                       int(i), int(i) + 1).items():
+                    calibration[k].update(window)
+            self.report.count("calibration_windows", min(_CALIBRATION_WINDOWS, n_windows))
+        else:
+            approximate = None
+            entropies_by_k = self._kmer_entropy_range(sequence_alignment.matrix,
+                                                      min_primer_length, max_primer_length,
+                                                      ragged_ends)
         for k in range(min_primer_length, max_primer_length):
-            entropy_peaks = self._kmer_entropy(sequence_alignment.data, k)
-            
-            ######################
-            #primer_indices = self._find_min_entropy_positions(entropy_peaks, show_plot=False)
-            ######################
-            
-            #print("Entropy Peaks (i.e. _kmer_entropy): ",k)
-            #print(entropy_peaks)
-            #print("Entropy Primer Indices (i.e. _find_min_entropy_positions): ",k)
-            #print(primer_indices)
-            
-            ######################
+            entropy_peaks = entropies_by_k[k]
+            if approximate:
+                #the scale of a window's error is its delta-method standard
+                #error plus the sample's resolution 1/n, which keeps it above
+                #0 for windows whose sample shows a single k-mer
+                errors = engine.errors.get(k, {})
+                scale = np.full(len(entropy_peaks), np.nan)
+                for i, (value, consensus) in entropy_peaks.items():
+                    if value is not None:
+                        bias, variance = errors[i]
+                        entropy_peaks[i] = (value + bias, consensus)
+                        scale[i] = np.sqrt(variance) + 1/approximate
+                scores = [(value - entropy_peaks[i][0])/scale[i]
+                          for i, (value, _) in calibration[k].items()
+                          if value is not None and entropy_peaks[i][0] is not None]
+                low, high = _conformal_bounds(scores, confidence)
             primer_indices = self._find_min_entropy_positions(entropy_peaks, show_plot=True)
-            ######################
-            
+            self.entropy_profiles[k] = self.entropy_values
+            self.report.count("windows_scanned", len(self.entropy_values))
+            self.report.count("windows_skipped_gaps", np.count_nonzero(np.isnan(self.entropy_values)))
+            if approximate:
+                #(low, high) of every window of the plotted profile
+                self.entropy_intervals = (np.maximum(self.entropy_values + low*scale, 0),
+                                          np.maximum(self.entropy_values + high*scale, 0))
+                if exact_minima:
+                    for i in primer_indices:
+                        entropy_peaks[i] = exact.entropies(k, i, i + 1)[i]
             for i in primer_indices:
-                #print(entropy_peaks[i][1],'\n')
-                #print('i:',i,' ','entropy_peaks: ',entropy_peaks[i][0],'\n')
-                primer = Primer(seq=entropy_peaks[i][1], pos=i, na_conc=na_conc)
-                primers.append(primer)
-            #print('\n','\n')
-        #print(primers)
+                seqs.append(entropy_peaks[i][1])
+                positions.append(i)
+                entropies.append(entropy_peaks[i][0])
+                degeneracy.append(sequence_alignment.matrix.window_degeneracy(i, i + k + 1))
+        self.gaps = GapProfile.from_matrix(sequence_alignment.matrix)
+        primers = PrimerTable(seqs, positions, na_conc, entropies, degeneracy)
+        self.report.count("sequences", sequence_alignment.n_sequences)
+        self.report.count("distinct_sequences", sequence_alignment.matrix.n_seqs)
+        self.report.count("columns", sequence_alignment.matrix.n_cols)
+        self.report.count("candidates", len(primers))
+        self.candidate_key = key
+        if key is not None:
+            self.candidate_store.put(key, primers, self.entropy_values, self.entropy_peaks,
+                                     self.gaps, self.entropy_intervals, self.entropy_profiles)
+        self.report.stop()
         return primers
 
     def identify_pairs(self, primers,
@@ -377,63 +2003,17 @@ class PrimerFinder():
                        select_gc_clamp=True,
                        omit_gc_clamp=True,
                        max_edit_dist=2, outgroup=None):
-        #First, filter on attributes.
-        
         ######################
-        print("amp_min ", amp_min)
-        print("amp_max ", amp_max)
-        print('max deg ', max_degeneracy)
-        print('min_melting_temp ', min_melting_temp)
-        print('max_melting_temp', max_melting_temp)
-        print("MIN GC: ", min_gc)
-        print("MAX GC: ", max_gc)
+        logger.debug("identify_pairs: amplicon %s-%s, max degeneracy %s, melting temp %s-%s, "
+                     "GC %s-%s", amp_min, amp_max, max_degeneracy, min_melting_temp,
+                     max_melting_temp, min_gc, max_gc)
         ######################
         
-        
-        filtered = list(filter(lambda primer: primer.degeneracy <= max_degeneracy
-                  and primer.melting_temps[1] <= max_melting_temp
-                  and primer.melting_temps[0] >= min_melting_temp
-                  and primer.gc[0] >= min_gc
-                  and primer.gc[1] <= max_gc, primers))
-
-        ######################
-        for p in filtered:
-            print(p)
+        pairs = list(self.iter_pairs(primers, amp_min, amp_max, max_degeneracy,
+                                     min_melting_temp, max_melting_temp, min_gc, max_gc,
+                                     select_gc_clamp, omit_gc_clamp, max_edit_dist, outgroup))
         ######################
-
-        if select_gc_clamp:
-            filtered = list(filter(lambda primer: primer.good_gc_clamp==True, filtered))
-        if omit_gc_clamp:
-            filtered = list(filter(lambda primer: primer.bad_gc_clamp == False, filtered))
-
-        pairs = []
-        for pair in it.combinations(filtered, 2):
-            l = pair[1].pos - pair[0].pos - pair[0].length
-            if l <= amp_max and l >= amp_min:
-                primerPair = PrimerPair(pair[0], pair[1])
-                pairs.append(primerPair)
-
-        #Outgroup Filtering should happen on at least ONE primer of the pairs.
-        #Only one primer need be specific. off-target DNA will be titred out
         if outgroup:
-            selected = []
-            outseqs = [str(x.seq) for x in SeqIO.parse(outgroup, "fasta")]
-            for pair in pairs:
-                f_dist = 10000
-                r_dist = 10000
-                for seq in outseqs:
-                    #pair.forward & pair.reverse for primer pairs
-                    f_current = self._outgroup_distance(pair.forward, seq)
-                    r_current = self._outgroup_distance(pair.reverse, seq)
-                    if f_current < f_dist:
-                        f_dist = f_current
-                    if r_current < r_dist:
-                        r_dist = r_current
-                if f_dist < max_edit_dist or r_dist < max_edit_dist:
-                    selected.append(pair)
-            pairs = selected
-            
-        ######################
             ###
             self.primer_pairs = pairs
             ###
@@ -441,192 +2021,153 @@ class PrimerFinder():
             pairs = -1
         ######################    
             
+        self.report.stop()
         return pairs
 
+    #The pairs of identify_pairs, made one at a time as they are consumed, so
+    #an export of many pairs never holds them all. The outgroup is screened
+    #up front, once per distinct sequence of the primers in some pair.
+    def iter_pairs(self, primers, amp_min=75, amp_max=150, max_degeneracy=2,
+                   min_melting_temp=52, max_melting_temp=58, min_gc=.40, max_gc=.60,
+                   select_gc_clamp=True, omit_gc_clamp=True, max_edit_dist=2, outgroup=None):
+        #First, filter on attributes.
+        self._report("pairing")
+        if not isinstance(primers, PrimerTable):
+            primers = PrimerTable.from_primers(primers)
+        passed = OrderedDict()
+        filtered = np.flatnonzero(primers.attribute_mask(max_degeneracy,
+                                                         min_melting_temp, max_melting_temp,
+                                                         min_gc, max_gc,
+                                                         select_gc_clamp, omit_gc_clamp, passed))
+        self.report.count("pairing_candidates", len(primers))
+        self.report.count_all("passed", passed)
+
+        #Outgroup Filtering should happen on at least ONE primer of the pairs.
+        #Only one primer need be specific. off-target DNA will be titred out
+        near = None
+        if outgroup:
+            self._report("outgroup")
+            if not isinstance(outgroup, OutgroupIndex):
+                outgroup = OutgroupIndex.from_fasta(outgroup)
+            #screen each distinct primer once, then resolve the pairs
+            paired = primers.paired_rows(filtered, amp_min, amp_max)
+            unique = {}
+            for row in paired.tolist():
+                unique.setdefault(primers.seqs[row], row)
+            #same decision as min distance < max_edit_dist
+            screen = None
+            if self.workers > 1 and len(unique) > 1:
+                from .parallel import parallel_screen
+                screen = functools.partial(parallel_screen, outgroup, max_dist=max_edit_dist - 1,
+                                           workers=self.workers, chunk_size=self.outgroup_chunk)
+            screened = {}
+            near_seqs = self.screen_cache.within_many(
+                outgroup, [primers.primer(row) for row in unique.values()], max_edit_dist - 1,
+                screen, screened)
+            self.report.count("outgroup_primers", len(unique))
+            self.report.count_all("outgroup", screened)
+            near = np.zeros(len(primers), dtype=bool)
+            near[paired] = [near_seqs[primers.seqs[row]] for row in paired.tolist()]
+
+        for forward, reverse in primers.iter_pair_indices(filtered, amp_min, amp_max):
+            self.report.count("pairs_enumerated", len(forward))
+            if near is not None:
+                keep = near[forward] | near[reverse]
+                forward, reverse = forward[keep], reverse[keep]
+                self.report.count("pairs_kept", len(forward))
+            for f, r in zip(forward.tolist(), reverse.tolist()):
+                yield PrimerPair(primers.primer(f), primers.primer(r))
+
     ######################
     
-    def saveCSV(self):
-        modifyFile = 'w'
-        script_dir = os.path.dirname(__file__) #<-- absolute dir the script is in
-        rel_path = "templates\\entropy\\entropy_output.csv"
-        abs_file_path = os.path.join(script_dir, rel_path)
-        with open(abs_file_path, mode=modifyFile, newline='') as entropy_file:
-            fieldnames = ['Sequence', 'Entropy']
-            entropy_writer = csv.DictWriter(entropy_file, fieldnames=fieldnames)
-            for i, val in enumerate(self.entropy_values):
-               entropy_writer.writeheader()
-               entropy_writer.writerow({'Sequence': i, 'Entropy':val})
+    #Writes the entropy of every window, for every primer length, as CSV.
+    def saveCSV(self, path):
+        with open(path, mode='w', newline='') as entropy_file:
+            entropy_writer = csv.writer(entropy_file)
+            entropy_writer.writerow(['k', 'position', 'entropy'])
+            for k, values in self.entropy_profiles.items():
+                for i, val in enumerate(values):
+                    entropy_writer.writerow([k, i, val])
     ######################
-    def html_plot(self):
-         #if os.path.exists('entropy_diagram.csv'):
-            #modifyFile = 'a'
-        #else:
-            #modifyFile = 'w'
-        #modifyFile = 'w'
-        #script_dir = os.path.dirname(__file__) #<-- absolute dir the script is in
-        #rel_path = "templates\\entropy\\entropyTxt.txt"
-        #abs_file_path = os.path.join(script_dir, rel_path)
-        #with open(abs_file_path, mode=modifyFile) as entropy_file:
-           #entropy_writer = csv.writer(entropy_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-           #for i in ent_inds[peaks]:
-               #entropy_writer.writerow([entropies[i][0]])
-        #entropyTxt=open(abs_file_path, mode=modifyFile)
-        
-        ######################
+    #The entropy profile, gap coverage and primer pairs as a plotly figure.
+    #Its size is bounded by max_points (columns drawn) and max_rows (rows of
+    #the gap heatmap), not by the depth or width of the alignment: the curve
+    #is decimated keeping each bucket's minimum and maximum, gaps are drawn
+    #as one heatmap of per-bucket gap fractions, and the pairs are batched
+    #into three WebGL traces.
+    def html_plot(self, max_points=4000, max_rows=200):
+        self._report("plot")
         #get primer_pairs
         assert self.primer_pairs
-        #y axis is entropy values (MINIMUM entropy values), get's values from function "_find_min_entropy_positions"
-        y = self.entropy_values
-        #print('Min Entropy Values (y): ',*y,sep=", ")
-        #print('\n','\n')
-        #np.arrange => Return evenly spaced values within a given interval
-        #"len(y)" => Return number of items in an object
-        #So x = array with intervals for each entropy value
+        #y axis is entropy values, from function "_find_min_entropy_positions"
+        y = np.asarray(self.entropy_values, dtype=np.float64)
         x = np.arange(len(y))
-       # print('Array of Evenly Intervaled Min. Entropy Values (x=', x, '): ',*y,sep=", ")
-        #print('\n','\n')
-    
-        #np.array creates an array
-        #dtype => desired output type for the array, so here it's numpy float64
-        #y_nans => array of min. entropy values (y) of type 64bit float (np.float64)
-        y_nans = np.array(y, dtype=np.float64)
-        #print('Array of min. entropy values of type float (y_nans): ',*y_nans,sep=", ")
-        #print('\n','\n')
-            
-        ######################
-        xy={}
-        for key in x:
-            for value in y:
-                xy[key]=value
-        xAndY={'X': [x], 'Y': [y]}
-        #csvDF=pd.DataFrame.from_dict(xy)
-        #print('x: ',type(x))
-        #print('x: ',type(y_nans))
-        x2 = np.array(x).tolist()
-        y2 = np.array(y_nans).tolist()
-        #print('\n','\n')
-        #print('x2: ',type(x2))
-        #print('y2: ',type(y2))
-        
-        csvDF=pd.DataFrame(y_nans)
-        #csvDF=pd.DataFrame(x, y_nans, index=x)
-        #csvDF.out
-        csvDF.to_csv('entropy-out.csv')
-        ######################
-        
-        #np.nanmax Returns max of an array...or min along an axis. Ignores any NaNs!
-        #primer_height => Max value of the y_nans, divided by 5
-        primer_height = np.nanmax(y_nans)/5
-        #print('Max value from Array of Min. Entropy values, divided by 5 (primer_height): ',primer_height)
-        #print('\n','\n')
-        #primer_y => 
-        primer_y = np.nanmax(y_nans) + primer_height
-        #print('6/5*np.nanmax(y_nans) => (primer_y = np.nanmax(y_nans) + primer_height): ',primer_y)
-        #print('\n','\n')
-
-        #go == plotly graph_objects
-        #go.figure => Create a figure, specificly here "Graph Objects"; this provides precise data validation, and can render/export graphs
+        primer_height = np.nanmax(y)/5
+        primer_y = np.nanmax(y) + primer_height
+
         fig = go.Figure()
-        #fig.add_trace => modifies graph property...here, the func accepts a graph object trace (instance of Scatter), and adds to figure
-        #x=array with intervals for each entropy val, y=min entropy values
-        fig.add_trace(go.Scatter(x=x, y=y,
-                                 mode='lines',
-                                 name='Seq. Entropy'))
-        #Basically sets the min points of entropy=good for us, what we want tof ind
-        fig.add_trace(go.Scatter(x=self.entropy_peaks,
-                                 y=y[self.entropy_peaks],
-                                 mode='markers',
-                                 name='Entropy Minima'))
-
-
-        def f(x):
-            if x=='-':
-                return None
-            else:
-                return 1
-            
-        #print('\n','\n')
-        df = self.sequence_alignment.data.applymap(f)
-        df = df.where(pd.notnull(df), None)
-        #print("df: ","\n",df)
-
-        #print('\n','\n')
-        df = df.where(pd.notnull(df), None)
-        for i, row in df.iterrows():
-            y = [(d - (i+1.1))/7 if d else None for d in row.values]
-            #print("y value @ i=",i," in df.iterrows (and before fig.add_trace): ", y,"\n")
-            fig.add_trace(go.Scatter(
-                x=x,
-                y=y,
-                #orientation='h',
-                mode='lines',
-                showlegend=False,
-            ))
-            #print('\n')
-
-        #print('\n','\n')
-        #min and max vals used for colormap
-        f_min = min([p.forward.pos for p in self.primer_pairs ])
-        #print("f_min for colormap values: ", f_min)
-        f_max = max([p.forward.pos for p in self.primer_pairs ])
-        #print("f_max for colormap values: ", f_max)
-
-        #print('\n','\n')
-        norm = matplotlib.colors.Normalize(vmin=f_min, vmax=f_max)
-        cmap = matplotlib.cm.get_cmap('GnBu')
-        cmap_r = matplotlib.cm.get_cmap('GnBu_r')
-
-        i = 1
-        hex_colors_dic = {}
-        rgb_colors_dic = {}
-        hex_colors_only = []
-        for name, hex in matplotlib.colors.cnames.items():
-            hex_colors_only.append(hex)
-            hex_colors_dic[name] = hex
-            rgb_colors_dic[name] = matplotlib.colors.to_rgb(hex)
-
-        for pair in self.primer_pairs:
+        if self.entropy_intervals is not None:
+            low, high = self.entropy_intervals
+            band_x, band_low = _minmax_decimate(x, low, max_points, keep="min")
+            _, band_high = _minmax_decimate(x, high, max_points, keep="max")
+            fig.add_trace(go.Scattergl(x=band_x, y=band_low, mode='lines', line=dict(width=0),
+                                       hoverinfo='skip', showlegend=False))
+            fig.add_trace(go.Scattergl(x=band_x, y=band_high, mode='lines', line=dict(width=0),
+                                       fill='tonexty', fillcolor='rgba(31,119,180,0.2)',
+                                       name='Calibrated Interval'))
+        curve_x, curve_y = _minmax_decimate(x, y, max_points)
+        fig.add_trace(go.Scattergl(x=curve_x, y=curve_y,
+                                   mode='lines',
+                                   name='Seq. Entropy'))
+        #the lowest minimum of every bucket
+        peaks = _bucket_minima(np.asarray(self.entropy_peaks, dtype=np.int64), y, len(y), max_points)
+        fig.add_trace(go.Scattergl(x=peaks,
+                                   y=y[peaks],
+                                   mode='markers',
+                                   name='Entropy Minima'))
+
+        #percentage of the sequences of each row bucket with a gap in each
+        #column bucket, below the curve where the original drew one line per
+        #sequence; a quarter of the curve's resolution is plenty for gaps.
+        row_starts, row_sizes, col_starts, col_sizes, gap_percent = \
+            self.gaps.heatmap(max_rows, max(max_points // 4, 1))
+        fig.add_trace(go.Heatmap(x=col_starts + (col_sizes - 1)/2,
+                                 y=-(row_starts + (row_sizes - 1)/2 + 0.1)/7,
+                                 z=gap_percent, zmin=0, zmax=100,
+                                 colorscale=[[0, 'rgb(200,200,200)'], [1, 'rgb(255,255,255)']],
+                                 showscale=False, name='Gaps',
+                                 hovertemplate='position %{x}<br>gaps %{z}%<extra></extra>'))
+
+        #every distinct forward and reverse primer as a box, and a dashed
+        #line across each pair's amplicon; None separates the shapes
+        box_y = [primer_y, primer_y+primer_height, primer_y+primer_height, primer_y, primer_y, None]
+        boxes = {"forward": {}, "reverse": {}}
+        link_x = []
+        link_text = []
+        for n, pair in enumerate(self.primer_pairs, 1):
             f = pair.forward
             r = pair.reverse
+            boxes["forward"].setdefault((f.pos, f.length), str(f))
+            boxes["reverse"].setdefault((r.pos, r.length), str(r))
+            link_x += [f.pos + f.length/2, r.pos + r.length/2, None]
+            link_text += ["Pair {0}: {1}".format(n, pair)]*2 + [None]
+        for name, color in (("forward", '#1f77b4'), ("reverse", '#ff7f0e')):
+            box_x = []
+            box_text = []
+            for (pos, length), text in boxes[name].items():
+                box_x += [pos, pos, pos+length, pos+length, pos, None]
+                box_text += [text]*5 + [None]
+            fig.add_trace(go.Scattergl(x=box_x, y=box_y*len(boxes[name]),
+                                       fill='toself', text=box_text, hoverinfo='text',
+                                       line=dict(color=color, width=2), fillcolor=color,
+                                       name=name.capitalize() + ' Primers'))
+        link_y = [primer_y + primer_height/2]*2 + [None]
+        fig.add_trace(go.Scattergl(x=link_x, y=link_y*len(self.primer_pairs),
+                                   mode='lines', text=link_text, hoverinfo='text',
+                                   line=dict(color='#2ca02c', width=4, dash='dash'),
+                                   name='Primer Pairs'))
 
-            #all primers have same y
-            y = [primer_y, primer_y+primer_height, primer_y+primer_height, primer_y, primer_y]
-
-            #color = matplotlib.colors.to_hex(cmap(norm(f.pos)))
-            color = random.choice(hex_colors_only)
-            anchor_color = random.choice(hex_colors_only)
-
-            #forward primer
-            fig.add_trace(go.Scatter(x=[f.pos, f.pos, f.pos+f.length, f.pos+f.length, f.pos],
-                                    y= y,
-                                    fill='toself',
-                                    text = str(f),
-                                    line=dict(
-                                    color=color,
-                                    width=2),
-                                    fillcolor=color,
-                                    showlegend=False,))
-            #reverse primer
-            fig.add_trace(go.Scatter(x=[r.pos, r.pos, r.pos+r.length, r.pos+r.length, r.pos],
-                                    y = y,
-                                    fill='toself',
-                                    text = str(r),
-                                    line=dict(
-                                    color=color,
-                                    width=2),
-                                    fillcolor=color,
-                                    showlegend=False,))
-            fig.add_trace(go.Scatter(x=np.arange((f.pos+f.pos+f.length)/2, (r.pos+r.pos+r.length)/2),
-                                     y = [(primer_y + primer_y + primer_height)/2] * x.shape[0],
-                                     line=dict(color=anchor_color, width=4, dash='dash'),
-                                     text=str(pair),
-                                     name="Pair {0}".format(i),
-
-                         ))
-            i +=1
-
-
-
-        #fig.show()
-        return to_html(fig, full_html=False)
+        html = to_html(fig, full_html=False)
+        self.report.stop()
+        return html
     ######################
\ No newline at end of file
@@ -1,56 +1,114 @@
-<script type="text/javascript" src="{{STATIC_URL}}/static/app/d3js_results.js"></script>
+<script type="text/javascript">
+    //Entropy profile of the results, drawn from api/profile: only the
+    //columns in view are fetched, at about one bucket per pixel, again after
+    //every pan or zoom. Each bucket shows the lowest to highest entropy of
+    //its windows, the share of gaps in its columns (the strip below) and the
+    //best candidate primers starting there (the boxes above).
 
     // set the dimensions and margins of the graph
-    var margin = {top: 10, right: 30, bottom: 30, left: 60},
-        width = 460 - margin.left - margin.right,
-        height = 400 - margin.top - margin.bottom;
-    
-    // append the svg object to the body of the page
+    var margin = {top: 30, right: 30, bottom: 50, left: 60},
+        width = document.getElementById("entropy_diagram").clientWidth - margin.left - margin.right,
+        height = 360 - margin.top - margin.bottom,
+        gapHeight = 20;
+
     var svg = d3.select("#entropy_diagram")
       .append("svg")
         .attr("width", width + margin.left + margin.right)
         .attr("height", height + margin.top + margin.bottom)
       .append("g")
-        .attr("transform",
-              "translate(" + margin.left + "," + margin.top + ")");
-    
-    //Read the data
-    d3.csv(entropy_diagram.csv),
-    
-      // When reading the csv, I must format variables:
-      function(d){
-        return { date : d3.timeParse("%Y-%m-%d")(d.date), value : d.value }
-      },
-    
-      // Now I can use this dataset:
-      function(data) {
-    
-        // Add X axis --> it is a date format
-        var x = d3.scaleTime()
-          .domain(d3.extent(data, function(d) { return d.date; }))
-          .range([ 0, width ]);
-        svg.append("g")
-          .attr("transform", "translate(0," + height + ")")
-          .call(d3.axisBottom(x));
-    
-        // Add Y axis
-        var y = d3.scaleLinear()
-          .domain([0, d3.max(data, function(d) { return +d.value; })])
-          .range([ height, 0 ]);
-        svg.append("g")
-          .call(d3.axisLeft(y));
-    
-        // Add the line
-        svg.append("path")
-          .datum(data)
-          .attr("fill", "none")
-          .attr("stroke", "steelblue")
-          .attr("stroke-width", 1.5)
-          .attr("d", d3.line()
-            .x(function(d) { return x(d.date) })
-            .y(function(d) { return y(d.value) })
-            )
-    
-    })
-
-</script>
\ No newline at end of file
+        .attr("transform", "translate(" + margin.left + "," + margin.top + ")");
+
+    svg.append("clipPath").attr("id", "profile_clip")
+      .append("rect").attr("y", -margin.top).attr("width", width).attr("height", height + margin.top);
+
+    var x0 = d3.scaleLinear().range([0, width]),
+        x = x0,
+        y = d3.scaleLinear().range([height - gapHeight - 10, 0]);
+    var xAxis = svg.append("g").attr("transform", "translate(0," + height + ")"),
+        yAxis = svg.append("g");
+    var plot = svg.append("g").attr("clip-path", "url(#profile_clip)");
+    var interval = plot.append("path").attr("fill", "steelblue").attr("opacity", 0.15),
+        band = plot.append("path").attr("fill", "steelblue").attr("stroke", "steelblue"),
+        gaps = plot.append("g").attr("transform", "translate(0," + (height - gapHeight) + ")"),
+        primers = plot.append("g");
+    svg.append("text").attr("x", width / 2).attr("y", height + 40).attr("text-anchor", "middle")
+      .text("Alignment position");
+    svg.append("text").attr("transform", "rotate(-90)").attr("x", -height / 2).attr("y", -45)
+      .attr("text-anchor", "middle").text("Entropy");
+
+    var data = null,
+        requested = 0,
+        pending = null;
+
+    function mid(d) { return x(d.start + d.width / 2); }
+    function defined(name) { return function(d) { return d[name] !== null; }; }
+
+    //rows of the response, one per bucket
+    function buckets(profile) {
+      return profile.start.map(function(start, i) {
+        return {start: start, width: profile.width[i], min: profile.entropy_min[i],
+                max: profile.entropy_max[i], gaps: profile.gap_fraction[i],
+                low: profile.low ? profile.low[i] : null, high: profile.high ? profile.high[i] : null};
+      });
+    }
+
+    function draw() {
+      xAxis.call(d3.axisBottom(x));
+      if (!data) return;
+      var rows = buckets(data);
+      interval.attr("d", d3.area().defined(defined("low"))
+        .x(mid).y0(function(d) { return y(d.low); }).y1(function(d) { return y(d.high); })(rows));
+      band.attr("d", d3.area().defined(defined("min"))
+        .x(mid).y0(function(d) { return y(d.min); }).y1(function(d) { return y(d.max); })(rows));
+
+      var cells = gaps.selectAll("rect").data(rows);
+      cells.exit().remove();
+      cells.enter().append("rect").attr("height", gapHeight).attr("fill", "grey")
+        .append("title");
+      gaps.selectAll("rect")
+        .attr("x", function(d) { return x(d.start); })
+        .attr("width", function(d) { return Math.max(x(d.start + d.width) - x(d.start), 1); })
+        .attr("opacity", function(d) { return d.gaps; })
+        .select("title").text(function(d) { return Math.round(100 * d.gaps) + "% gaps"; });
+
+      var boxes = primers.selectAll("rect").data(data.primers);
+      boxes.exit().remove();
+      boxes.enter().append("rect").attr("y", -20).attr("height", 12).attr("fill", "darkorange")
+        .attr("opacity", 0.6).append("title");
+      primers.selectAll("rect")
+        .attr("x", function(d) { return x(d.pos); })
+        .attr("width", function(d) { return Math.max(x(d.pos + d.length) - x(d.pos), 2); })
+        .select("title").text(function(d) {
+          return d.seq + " at " + d.pos + ", entropy " + d.entropy.toFixed(3);
+        });
+    }
+
+    //fetches the columns in view; responses to superseded requests are dropped
+    function load(start, stop) {
+      var id = ++requested;
+      var url = "{% url 'profile' %}?points=" + Math.ceil(width) + "&start=" + Math.max(0, Math.floor(start));
+      if (stop !== undefined) url += "&stop=" + Math.ceil(stop);
+      d3.json(url, function(error, profile) {
+        if (error || id !== requested) return;
+        if (!data) {
+          x0.domain([0, profile.n_cols]);
+          y.domain([0, d3.max(profile.entropy_max.concat(profile.high || [])) || 1]);
+          yAxis.call(d3.axisLeft(y));
+          svg.call(zoom.scaleExtent([1, Math.max(profile.n_cols / 20, 1)])
+                       .translateExtent([[0, 0], [width, height]])
+                       .extent([[0, 0], [width, height]]));
+        }
+        data = profile;
+        draw();
+      });
+    }
+
+    var zoom = d3.zoom().on("zoom", function() {
+      x = d3.event.transform.rescaleX(x0);
+      draw();
+      clearTimeout(pending);
+      pending = setTimeout(function() { load(x.domain()[0], x.domain()[1]); }, 150);
+    });
+
+    load(0);
+</script>
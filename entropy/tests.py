@@ -1,3 +1,908 @@
-from django.test import TestCase
+import bz2
+import csv
+import gzip
+import io
+import itertools as it
+import json
+import lzma
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+from collections import Counter
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from scipy.stats import entropy
+from . import cache, export, views
+from .cache import CandidateStore, DiskStore, OutgroupIndexStore, TableCache
+from .forms import PrimerForm
+from .jobs import (_Heartbeat, claim_next_job, job_error_message, new_finder, pair_record,
+                   refilter_state, requeue_stale_jobs, run_pipeline)
+from .models import PrimerJob
+from .primer_finder_classes import (_conformal_bounds, _decompressed_chunks, AlignmentMatrix, GapProfile, KmerEntropyEngine, OutgroupIndex,
+                                    OutgroupScreenCache, Primer, PrimerFinder, PrimerTable, ProfilePyramid, GAP, MISSING)
 
-# Create your tests here.
+#The engines are checked against the plain definitions they replace, on
+#small random alignments.
+
+
+def random_alignment(rng, n_seqs, length, gap_rate=0.05, ragged=False):
+    seqs = []
+    for i in range(n_seqs):
+        seq = "".join(rng.choice(list("ACGT"), length))
+        seq = "".join("-" if rng.random() < gap_rate else base for base in seq)
+        if ragged:
+            seq = seq[:rng.integers(1, length + 1)]
+        seqs.append(seq)
+    return seqs
+
+
+#{start: entropy or None} of every window of k+1 columns, one window at a
+#time: None when any sequence has a gap there; with ragged_ends only the
+#sequences that reach the end of the window are counted, otherwise the scan
+#stops at the first column any sequence is missing.
+def brute_force_entropies(matrix, k, ragged_ends=False):
+    width = k + 1
+    codes = matrix.codes
+    weights = matrix.weights if matrix.weights is not None else np.ones(matrix.n_seqs)
+    missing = (codes == MISSING).any(axis=0)
+    n_cols = matrix.n_cols if ragged_ends or not missing.any() else int(np.argmax(missing))
+    results = {}
+    for start in range(max(n_cols - width + 1, 0)):
+        if (codes[:, start:start + width] == GAP).any():
+            results[start] = None
+            continue
+        counts = Counter()
+        for row, weight in zip(codes, weights):
+            window = row[start:start + width]
+            if (window == MISSING).any():
+                continue
+            counts[window.tobytes()] += weight
+        results[start] = entropy(list(counts.values()))
+    return results
+
+
+def write_fasta(directory, seqs):
+    path = os.path.join(directory, "msa.fa")
+    with open(path, "w") as f:
+        for i, seq in enumerate(seqs):
+            f.write(">s%d\n%s\n" % (i, seq))
+    return path
+
+
+class KmerEntropyTests(SimpleTestCase):
+    def assertMatchesBruteForce(self, matrix, min_k, max_k, ragged_ends=False, block_cells=1 << 22):
+        found = KmerEntropyEngine(matrix, ragged_ends, block_cells).entropies_range(min_k, max_k)
+        for k in range(min_k, max_k):
+            expected = brute_force_entropies(matrix, k, ragged_ends)
+            self.assertEqual(sorted(found[k]), sorted(expected))
+            for start, value in expected.items():
+                if value is None:
+                    self.assertIsNone(found[k][start][0])
+                else:
+                    self.assertAlmostEqual(found[k][start][0], value, places=12)
+
+    def test_entropies_by_k(self):
+        rng = np.random.default_rng(2)
+        for n in range(100):
+            seqs = random_alignment(rng, int(rng.integers(1, 8)), int(rng.integers(1, 40)),
+                                    ragged=rng.random() < 0.3)
+            matrix = AlignmentMatrix.from_sequences(seqs)
+            self.assertMatchesBruteForce(matrix, 1, 6, block_cells=int(rng.integers(1, 200)))
+
+    #one weighted row per distinct sequence counts the same k-mers as the
+    #copies it replaces, and user weights count each sequence that many times
+    def test_weighted_deduplication(self):
+        rng = np.random.default_rng(18)
+        for n in range(50):
+            distinct = random_alignment(rng, int(rng.integers(1, 5)), 12)
+            seqs = [distinct[i] for i in rng.integers(0, len(distinct), 12)]
+            matrix = AlignmentMatrix.from_sequences(seqs, ["s%d" % i for i in range(len(seqs))])
+            unique = matrix.deduplicate()
+            self.assertEqual(unique.n_seqs, len(set(seqs)))
+            expected = KmerEntropyEngine(matrix).entropies_range(2, 6)
+            found = KmerEntropyEngine(unique).entropies_range(2, 6)
+            for k in expected:
+                for start, (value, consensus) in expected[k].items():
+                    self.assertEqual(found[k][start][1], consensus)
+                    if value is not None:
+                        self.assertAlmostEqual(found[k][start][0], value, places=12)
+            weights = {seq_id: float(rng.integers(0, 4)) for seq_id in matrix.ids}
+            if any(weights.values()):
+                weighted = matrix.with_weights(weights)
+                self.assertMatchesBruteForce(weighted, 2, 6)
+                self.assertMatchesBruteForce(weighted.deduplicate(), 2, 6)
+
+    #nothing to collapse: the matrix itself; otherwise compacting in place
+    #gives what copying the kept rows gives, without a second matrix
+    def test_deduplicate_without_copying(self):
+        rng = np.random.default_rng(181)
+        seqs = random_alignment(rng, 300, 2000)
+        matrix = AlignmentMatrix.from_sequences(seqs, ["s%d" % i for i in range(300)])
+        self.assertIs(matrix.deduplicate(), matrix)
+        self.assertIs(matrix.deduplicate(in_place=True), matrix)
+        copies = [seqs[i] for i in rng.integers(0, 300, 600)]
+        ids = ["c%d" % i for i in range(600)]
+        weights = {seq_id: float(rng.integers(0, 3)) for seq_id in ids}
+        for weighted in (False, True):
+            expected = AlignmentMatrix.from_sequences(copies, ids)
+            if weighted:
+                expected = expected.with_weights(weights)
+            expected = expected.deduplicate()
+            matrix = AlignmentMatrix.from_sequences(copies, ids)
+            if weighted:
+                matrix = matrix.with_weights(weights)
+            tracemalloc.start()
+            unique = matrix.deduplicate(in_place=True)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.assertLess(peak, matrix.codes.nbytes // 4)
+            np.testing.assert_array_equal(unique.codes, expected.codes)
+            np.testing.assert_array_equal(unique.weights, expected.weights)
+            self.assertEqual(unique.ids, expected.ids)
+
+    def test_ragged_ends(self):
+        rng = np.random.default_rng(4)
+        for n in range(100):
+            seqs = random_alignment(rng, int(rng.integers(2, 8)), int(rng.integers(4, 16)),
+                                    ragged=True)
+            matrix = AlignmentMatrix.from_sequences(seqs)
+            #small blocks, so every block boundary is crossed
+            self.assertMatchesBruteForce(matrix, 2, 6, ragged_ends=True,
+                                         block_cells=int(rng.integers(1, 40)))
+
+    def test_ragged_row_ending_below_every_kmer(self):
+        matrix = AlignmentMatrix.from_sequences(["CCCCCCCCCC", "AAA"])
+        self.assertMatchesBruteForce(matrix, 1, 7, ragged_ends=True)
+
+
+class CompressedAlignmentTests(SimpleTestCase):
+    #a redundant alignment compresses a thousandfold; it must still come out
+    #a chunk at a time, whatever the format, including files of several
+    #concatenated streams
+    def test_decompressed_in_bounded_chunks(self):
+        text = "".join(">s%d\n%s\n" % (i, "ACGT-"*400) for i in range(300)).encode("ascii")
+        formats = {"gzip": gzip.compress, "xz": lzma.compress, "bzip2": bz2.compress,
+                   "gzip members": lambda data: gzip.compress(data[:1000]) + gzip.compress(data[1000:]),
+                   "xz streams": lambda data: lzma.compress(data[:5000]) + lzma.compress(data[5000:])}
+        expected = AlignmentMatrix.from_fasta(io.BytesIO(text))
+        for name, compress in formats.items():
+            for chunk_size in (777, 1 << 16):
+                chunks = list(_decompressed_chunks(io.BytesIO(compress(text)), chunk_size))
+                self.assertLessEqual(max(len(chunk) for chunk in chunks), chunk_size, name)
+                self.assertEqual(b"".join(chunks), text, name)
+            matrix = AlignmentMatrix.from_fasta(io.BytesIO(compress(text)), chunk_size=4096)
+            np.testing.assert_array_equal(matrix.codes, expected.codes)
+            with self.assertRaisesRegex(ValueError, "truncated"):
+                AlignmentMatrix.from_fasta(io.BytesIO(compress(text)[:-20]))
+
+
+class EmptyAlignmentTests(SimpleTestCase):
+    EMPTY = [b"", b"\n\n", b">s0\n", b">s0 first\n>s1\n\n>s2"]
+
+    def test_reader_rejects_alignment_without_sequences(self):
+        for text in self.EMPTY:
+            for source in (io.BytesIO(text), io.BytesIO(gzip.compress(text))):
+                with self.assertRaisesRegex(ValueError, "alignment contains no sequences"):
+                    AlignmentMatrix.from_fasta(source)
+                source.seek(0)
+                with self.assertRaisesRegex(ValueError, "alignment contains no sequences"):
+                    AlignmentMatrix.check_fasta(source, chunk_size=3)
+
+    #a header longer than a chunk, then the first sequence
+    def test_check_reads_past_long_header(self):
+        source = io.BytesIO(b">" + b"x"*50 + b"\nAC-GT\n>s1\nACAGT\n")
+        AlignmentMatrix.check_fasta(source, chunk_size=7)
+        self.assertEqual(AlignmentMatrix.from_fasta(source).n_seqs, 2)
+
+    def test_form_error(self):
+        data = {"min_primer_len": 19, "max_primer_len": 23, "na_conc": 0.05, "amplicon_lower": 75,
+                "amplicon_upper": 150, "max_degeneracy": 1, "min_melting_temp": 56,
+                "max_melting_temp": 62, "min_gc": 0.3, "max_gc": 0.6, "find_gc_clamp": True,
+                "filter_gc_clamp": True, "max_edit_distance": 1}
+        for text, valid in ((b">s0\n>s1\n", False), (b">s0\nACGT\n", True)):
+            form = PrimerForm(data, {"msa_file": SimpleUploadedFile("msa.fa", text),
+                                     "outgroup_file": SimpleUploadedFile("out.fa", b">o\nACGT\n")})
+            self.assertEqual(form.is_valid(), valid, form.errors)
+            if not valid:
+                self.assertEqual(form.errors["msa_file"], ["alignment contains no sequences"])
+
+
+#Sequences of a few clades of uneven size around a common root, each with
+#its own mutations plus some of every sequence's own: rare k-mers a row
+#sample mostly misses, which is what biases its entropy low.
+def clade_alignment(rng, n_seqs, length, n_clades=20):
+    root = rng.integers(0, 4, length)
+    seqs = []
+    for size in rng.multinomial(n_seqs, rng.dirichlet(np.full(n_clades, 0.7))):
+        clade = np.where(rng.random(length) < 0.01, rng.integers(0, 4, length), root)
+        for i in range(size):
+            seq = np.where(rng.random(length) < 0.003, rng.integers(0, 4, length), clade)
+            seqs.append("".join(np.array(list("ACGT"))[seq]))
+    return seqs
+
+
+class ApproximateProfileTests(SimpleTestCase):
+    #the intervals of a sampled profile hold the exact entropy of about the
+    #nominal share of windows (the uncalibrated normal interval held ~80%)
+    def test_interval_coverage(self):
+        coverage = []
+        for seed in range(8):
+            rng = np.random.default_rng(seed)
+            seqs = clade_alignment(rng, 500, 300)
+            with tempfile.TemporaryDirectory() as directory:
+                finder = PrimerFinder()
+                finder.identify_primers(write_fasta(directory, seqs), 18, 19,
+                                        approximate=100, seed=seed, confidence=0.95)
+            exact = KmerEntropyEngine(AlignmentMatrix.from_sequences(seqs)).entropies(18)
+            exact = np.array([exact[i][0] for i in sorted(exact)], dtype=np.float64)
+            low, high = finder.entropy_intervals
+            self.assertEqual(len(low), len(exact))
+            coverage.append(np.mean((low - 1e-9 <= exact) & (exact <= high + 1e-9)))
+        self.assertGreaterEqual(np.mean(coverage), 0.93, coverage)
+        self.assertGreaterEqual(min(coverage), 0.88, coverage)
+
+    def test_conformal_bounds(self):
+        scores = np.arange(99.0)
+        self.assertEqual(_conformal_bounds(scores, 0.9), (4.0, 94.0))
+        #too few scores for the quantiles: the extremes
+        self.assertEqual(_conformal_bounds([3.0, -1.0, 2.0], 0.95), (-1.0, 3.0))
+        self.assertTrue(np.isnan(_conformal_bounds([], 0.95)).all())
+
+
+#Candidate primers of a random alignment: the consensus of windows of
+#random lengths, as identify_primers takes them.
+def random_candidates(rng, n_seqs, length, n_primers):
+    matrix = AlignmentMatrix.from_sequences(random_alignment(rng, n_seqs, length, 0))
+    seqs, positions = [], []
+    for i in range(n_primers):
+        start = int(rng.integers(0, length - 4))
+        seqs.append(matrix.window_consensus(start, min(start + int(rng.integers(4, 26)), length)))
+        positions.append(start)
+    return seqs, positions
+
+
+class PrimerTableTests(SimpleTestCase):
+    #the columns are what a Primer computes for each row on its own, and the
+    #mask is the baseline's filter over those Primers, with and without the
+    #sorted index
+    def test_attributes_match_primers(self):
+        rng = np.random.default_rng(6)
+        for n in range(40):
+            seqs, positions = random_candidates(rng, int(rng.integers(1, 4)), 60, 50)
+            na_conc = [None, 0.05, 0.2][n % 3]
+            table = PrimerTable(seqs, positions, na_conc)
+            primers = [Primer(seq, pos, na_conc) for seq, pos in zip(seqs, positions)]
+            for i, primer in enumerate(primers):
+                self.assertEqual(table.degeneracy[i], primer.degeneracy)
+                self.assertAlmostEqual(table.min_melting_temps[i], primer.melting_temps[0], places=9)
+                self.assertAlmostEqual(table.max_melting_temps[i], primer.melting_temps[1], places=9)
+                self.assertAlmostEqual(table.min_gc[i], primer.gc[0], places=12)
+                self.assertAlmostEqual(table.max_gc[i], primer.gc[1], places=12)
+                self.assertEqual(table.good_gc_clamp[i], primer.good_gc_clamp)
+                self.assertEqual(table.bad_gc_clamp[i], primer.bad_gc_clamp)
+            for m in range(10):
+                #thresholds halfway between values, so rounding cannot decide
+                temps = np.unique(np.concatenate([table.min_melting_temps, table.max_melting_temps]))
+                gcs = np.unique(np.concatenate([table.min_gc, table.max_gc, [0, 1]]))
+                midpoint = lambda values: float(np.mean(rng.choice(values, 2)))
+                t_lo, t_hi = sorted([midpoint(temps), midpoint(temps)])
+                gc_lo, gc_hi = sorted([midpoint(gcs), midpoint(gcs)])
+                thresholds = (int(rng.integers(0, 30)), t_lo, t_hi, gc_lo, gc_hi,
+                              bool(rng.random() < 0.5), bool(rng.random() < 0.5))
+                expected = [p.degeneracy <= thresholds[0]
+                            and p.melting_temps[1] <= t_hi and p.melting_temps[0] >= t_lo
+                            and p.gc[0] >= gc_lo and p.gc[1] <= gc_hi
+                            and (p.good_gc_clamp or not thresholds[5])
+                            and (not p.bad_gc_clamp or not thresholds[6]) for p in primers]
+                self.assertEqual(table.attribute_mask(*thresholds).tolist(), expected)
+                indexed = PrimerTable(seqs, positions, na_conc).build_index()
+                self.assertEqual(indexed.attribute_mask(*thresholds).tolist(), expected)
+
+
+class PairSweepTests(SimpleTestCase):
+    #(forward, reverse) rows the baseline's it.combinations loop pairs: each
+    #row with every later row of the list whose amplicon length fits
+    def combinations(self, table, rows, amp_min, amp_max):
+        pairs = set()
+        for a, b in it.combinations(rows, 2):
+            length = table.positions[b] - table.positions[a] - table.lengths[a]
+            if amp_min <= length <= amp_max:
+                pairs.add((a, b))
+        return pairs
+
+    def test_sweep_matches_combinations(self):
+        rng = np.random.default_rng(7)
+        for n in range(200):
+            n_primers = int(rng.integers(0, 40))
+            positions = rng.integers(0, 120, n_primers)
+            lengths = rng.integers(3, 12, n_primers)
+            table = PrimerTable(["A"*length for length in lengths], positions)
+            #in position order, as the baseline relied on
+            rows = np.lexsort((lengths, positions))
+            rows = rows[rng.random(n_primers) < 0.8]
+            amplicons = (positions[:, None] - positions - lengths)[rows][:, rows].ravel()
+            amplicons = amplicons[amplicons >= 0]
+            if len(amplicons) and rng.random() < 0.7:
+                #bounds equal to amplicon lengths that occur, to test both edges
+                amp_min, amp_max = sorted(rng.choice(amplicons, 2).tolist())
+            else:
+                amp_min = int(rng.integers(0, 30))
+                amp_max = amp_min + int(rng.integers(0, 60))
+            expected = self.combinations(table, rows.tolist(), amp_min, amp_max)
+            forward, reverse = table.pair_indices(rows, amp_min, amp_max)
+            found = list(zip(forward.tolist(), reverse.tolist()))
+            self.assertEqual(len(found), len(set(found)))
+            self.assertEqual(set(found), expected)
+            batches = list(table.iter_pair_indices(rows, amp_min, amp_max, batch_pairs=5))
+            self.assertEqual([pair for f, r in batches for pair in zip(f.tolist(), r.tolist())],
+                             found)
+            self.assertEqual(sorted(table.paired_rows(rows, amp_min, amp_max).tolist()),
+                             sorted({row for pair in expected for row in pair}))
+            #in any other order the sweep still finds every pair the loop did
+            shuffled = rng.permutation(rows).tolist()
+            self.assertLessEqual(self.combinations(table, shuffled, amp_min, amp_max), expected)
+
+
+class OutgroupScreenTests(SimpleTestCase):
+    #seed-and-verify against the original scan: the least Levenshtein
+    #distance of any expansion of the primer to any window of a sequence
+    def test_matches_levenshtein_scan(self):
+        rng = np.random.default_rng(8)
+        finder = PrimerFinder()
+        for n in range(300):
+            records = ["".join(rng.choice(list("ACGTACGTN"), int(rng.integers(0, 20))))
+                       for i in range(int(rng.integers(1, 5)))]
+            primer = Primer("".join(rng.choice(list("ACGTACGTRYKMSWBDHVN"), int(rng.integers(4, 9)))), 0)
+            best = min([finder._outgroup_distance(primer, record) for record in records])
+            for q in (4, 12):
+                index = OutgroupIndex.from_sequences(records, q)
+                for max_dist in range(3):
+                    self.assertEqual(index.within(primer, max_dist), best <= max_dist,
+                                     (records, primer.seq, max_dist, q))
+
+    def test_seed_at_start_of_later_record(self):
+        index = OutgroupIndex.from_sequences(["CGTCAA", "TCCG", "GGACGCCCGCNGGT"])
+        self.assertEqual(index.occurrences("GGAC").tolist(), [10])
+        self.assertTrue(index.within(Primer("GDRCDACH", 0), 1))
+
+
+class OutgroupScreenCacheTests(SimpleTestCase):
+    #a result at one distance answers every query it decides (within at d is
+    #within at any larger distance, outside at d is outside at any smaller
+    #one) without screening, and every answer is the screen's
+    def test_bounds_answer_other_distances(self):
+        rng = np.random.default_rng(10)
+        records = ["".join(rng.choice(list("ACGT"), 300)) for i in range(3)]
+        index = OutgroupIndex.from_sequences(records)
+        for n in range(60):
+            record = records[int(rng.integers(0, 3))]
+            start = int(rng.integers(0, 290))
+            seq = list(record[start:start + 10])
+            for i in rng.integers(0, 10, int(rng.integers(0, 4))):
+                seq[i] = str(rng.choice(list("ACGT")))
+            primer = Primer("".join(seq), 0)
+            truth = [index.within(primer, d) for d in range(4)]
+            cache = OutgroupScreenCache()
+            first = int(rng.integers(0, 4))
+            self.assertEqual(cache.within(index, primer, first), truth[first])
+            for d in rng.permutation(4).tolist():
+                hits = cache.hits
+                decided = d >= first if truth[first] else d <= first
+                self.assertEqual(cache.within(index, primer, d), truth[d])
+                if decided:
+                    self.assertEqual(cache.hits, hits + 1)
+
+    def test_least_recently_used_are_evicted(self):
+        index = OutgroupIndex.from_sequences(["ACGTACGTACGTAAAA"])
+        cache = OutgroupScreenCache(maxsize=3)
+        seqs = ["ACGTACGT", "CCCCCCCC", "GGGGGGGG", "TTTTTTTT"]
+        for seq in seqs[:3]:
+            cache.within(index, Primer(seq, 0), 1)
+        #touching the oldest makes the second oldest the next to go
+        self.assertIsNotNone(cache.lookup(index, seqs[0], 1))
+        cache.within(index, Primer(seqs[3], 0), 1)
+        self.assertEqual(len(cache._entries), 3)
+        self.assertIsNone(cache.lookup(index, seqs[1], 1))
+        for seq in (seqs[0], seqs[2], seqs[3]):
+            self.assertIsNotNone(cache.lookup(index, seq, 1))
+        self.assertTrue(cache.lookup(index, seqs[0], 1))
+
+
+class DiskStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    #an entry of `size` bytes whose only file holds `text`
+    def writer(self, text, size=100):
+        def write(directory):
+            with open(os.path.join(directory, "data"), "w") as f:
+                f.write(text.ljust(size))
+        return write
+
+    def read(self, store, key):
+        with open(os.path.join(store.entry_path(key), "data")) as f:
+            return f.read().strip()
+
+    def test_round_trip_and_first_writer_wins(self):
+        store = DiskStore(self.directory.name, 10000)
+        self.assertFalse(store.has("a"))
+        store.write("a", self.writer("first"))
+        store.write("a", self.writer("second"))
+        self.assertTrue(store.has("a"))
+        self.assertEqual(self.read(store, "a"), "first")
+        self.assertEqual(os.listdir(self.directory.name), ["a"])
+
+    #a writer that fails leaves neither an entry nor its temporary directory
+    def test_failed_write_leaves_nothing(self):
+        store = DiskStore(self.directory.name, 10000)
+
+        def failing(directory):
+            self.writer("partial")(directory)
+            raise ValueError("disk trouble")
+        with self.assertRaises(ValueError):
+            store.write("a", failing)
+        self.assertFalse(store.has("a"))
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_least_recently_used_are_evicted(self):
+        store = DiskStore(self.directory.name, 350)
+        for age, key in enumerate("abc"):
+            store.write(key, self.writer(key))
+            os.utime(store.entry_path(key), (1000 + age, 1000 + age))
+        store.touch("a")
+        #over the cap: the oldest untouched entry goes
+        store.write("d", self.writer("d"))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["a", "c", "d"])
+        #the entry just written stays even when it alone is over the cap
+        store.write("e", self.writer("e", 1000))
+        self.assertEqual(os.listdir(self.directory.name), ["e"])
+
+
+class OutgroupIndexStoreTests(SimpleTestCase):
+    RECORDS = ["ACGTACGTTTGACCAGTACGATTACGA", "GGGATTACAGATTACCANNACGTAGCA"]
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def assertSameIndex(self, index, expected):
+        self.assertEqual(index.fingerprint, expected.fingerprint)
+        for name in OutgroupIndex._ARRAYS:
+            np.testing.assert_array_equal(getattr(index, name), getattr(expected, name))
+
+    #the same content is indexed once and memory-mapped back, under any name
+    def test_round_trip_is_memory_mapped(self):
+        store = OutgroupIndexStore(self.directory.name, 1 << 20)
+        expected = OutgroupIndex.from_sequences(self.RECORDS)
+        index = store.from_sequences(self.RECORDS)
+        self.assertSameIndex(index, expected)
+        self.assertIsInstance(index.keys, np.memmap)
+        fasta = io.StringIO("".join(">r%d\n%s\n" % (i, seq) for i, seq in enumerate(self.RECORDS)))
+        again = store.from_fasta(fasta)
+        self.assertEqual(again.directory, index.directory)
+        self.assertEqual(len(os.listdir(self.directory.name)), 1)
+        self.assertTrue(again.within(Primer("GATTACAG", 0), 0))
+
+    def test_references_survive_eviction(self):
+        store = OutgroupIndexStore(self.directory.name, 0)
+        fasta = io.StringIO(">r\n%s\n" % self.RECORDS[0])
+        registered = store.register("first", fasta)
+        #over a cap of nothing, only the entry just written and references stay
+        store.from_sequences(self.RECORDS[1:])
+        other = store.from_sequences(self.RECORDS)
+        self.assertSameIndex(store.reference("first"), registered)
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         sorted([".references.json", store.key(registered.fingerprint),
+                                 store.key(other.fingerprint)]))
+        with self.assertRaisesRegex(ValueError, "Unknown reference outgroup"):
+            store.reference("second")
+        store.unregister("first")
+        self.assertEqual(store.references(), {})
+
+    #an entry saved in an older format is rebuilt in place on load
+    def test_older_format_is_rebuilt(self):
+        store = OutgroupIndexStore(self.directory.name, 1 << 20)
+        index = store.from_sequences(self.RECORDS)
+        key = store.key(index.fingerprint)
+        meta_path = os.path.join(store.entry_path(key), "index.json")
+        with open(meta_path) as f:
+            meta = json.load(f)
+        del meta["format"]
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+        rebuilt = store.load(key)
+        self.assertEqual(rebuilt.format, OutgroupIndex.FORMAT)
+        self.assertSameIndex(rebuilt, OutgroupIndex.from_sequences(self.RECORDS))
+        self.assertEqual(OutgroupIndex.load(store.entry_path(key)).format, OutgroupIndex.FORMAT)
+
+
+class TableCacheTests(SimpleTestCase):
+    #a miss reads the candidate table of the entry and nothing else of it
+    def test_miss_loads_only_the_table(self):
+        seqs, positions = random_candidates(np.random.default_rng(16), 3, 60, 30)
+        table = PrimerTable(seqs, positions, 0.05, np.arange(30.0))
+        with tempfile.TemporaryDirectory() as directory:
+            store = CandidateStore(directory, 1 << 20)
+            store.write("key", table.save)
+            cache = TableCache(store, maxsize=1)
+            loaded = cache.get("key")
+            self.assertIsNone(cache.get("other"))
+            self.assertIs(cache.get("key"), loaded)
+        self.assertEqual(list(loaded.seqs), seqs)
+        np.testing.assert_array_equal(loaded.entropies, table.entropies)
+        mask = loaded.attribute_mask(20, 0, 100, 0, 1, False, False)
+        np.testing.assert_array_equal(mask, table.attribute_mask(20, 0, 100, 0, 1, False, False))
+
+
+#Views read the module's stores; these tests give them fresh ones.
+class TemporaryStoresMixin():
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.saved_stores = (cache._outgroup_store, cache._candidate_store, cache._table_cache)
+        cache._outgroup_store = OutgroupIndexStore(os.path.join(self.directory.name, "outgroups"),
+                                                   1 << 26)
+        cache._candidate_store = CandidateStore(os.path.join(self.directory.name, "candidates"),
+                                                1 << 26)
+        cache._table_cache = None
+        self.addCleanup(self.restore_stores)
+
+    def restore_stores(self):
+        cache._outgroup_store, cache._candidate_store, cache._table_cache = self.saved_stores
+
+
+class ProfileApiTests(TemporaryStoresMixin, SimpleTestCase):
+    #every bucket the api returns, at any zoom, holds the min/max of the raw
+    #profile's windows starting in it and the gaps of its columns
+    def test_buckets_match_raw_profile(self):
+        rng = np.random.default_rng(21)
+        seqs = random_alignment(rng, 12, 3000, 0.02)
+        matrix = AlignmentMatrix.from_sequences(seqs)
+        values = rng.random(2980)
+        values[rng.random(2980) < 0.1] = np.nan
+        values[1000:1200] = np.nan
+        intervals = (values - rng.random(2980), values + rng.random(2980))
+        primer_seqs, positions = random_candidates(rng, 3, 3000, 200)
+        primers = PrimerTable(primer_seqs, positions, 0.05, rng.random(200))
+        cache.candidate_store().put("run", primers, values, np.arange(0, 2980, 7),
+                                    GapProfile.from_matrix(matrix), intervals)
+        gap_counts = (matrix.codes == GAP).sum(axis=0)
+        raw = {"entropy_min": values, "entropy_max": values,
+               "low": intervals[0], "high": intervals[1]}
+        reduce = {"entropy_min": np.nanmin, "entropy_max": np.nanmax, "low": np.nanmin,
+                  "high": np.nanmax}
+        request_factory = RequestFactory()
+        for start, stop, points in ((0, None, 1000), (0, None, 50), (0, None, 3), (123, 2711, 100),
+                                    (995, 1010, 1000), (1001, 1199, 10), (2970, 3000, 5)):
+            query = {"start": start, "points": points, "primers": 20}
+            if stop is not None:
+                query["stop"] = stop
+            request = request_factory.get("/api/profile", query)
+            request.session = {"refilter": {"candidates": "run"}}
+            profile = json.loads(views.profile_api(request).content)
+            stop = 3000 if stop is None else stop
+            self.assertEqual((profile["n_cols"], profile["n_rows"]), (3000, 12))
+            size = profile["bucket"]
+            #the finest level with at most points buckets
+            self.assertLessEqual(len(profile["start"]), points)
+            if size > 1:
+                self.assertGreater(-(-(stop - start) // (size // 4)), points)
+            self.assertLessEqual(profile["start"][0], start)
+            self.assertGreaterEqual(profile["start"][-1] + profile["width"][-1], stop)
+            for i, (bucket_start, width) in enumerate(zip(profile["start"], profile["width"])):
+                self.assertEqual(bucket_start % size, 0)
+                columns = slice(bucket_start, bucket_start + width)
+                for name, values_of in raw.items():
+                    window_values = values_of[columns]
+                    if np.isnan(window_values).all():
+                        self.assertIsNone(profile[name][i])
+                    else:
+                        self.assertAlmostEqual(profile[name][i], reduce[name](window_values))
+                self.assertAlmostEqual(profile["gap_fraction"][i],
+                                       gap_counts[columns].sum() / (width*12))
+            in_range = [i for i in range(200) if start <= positions[i] < stop]
+            self.assertEqual(profile["n_primers"], len(in_range))
+            lowest = sorted(in_range, key=lambda i: primers.entropies[i])[:20]
+            self.assertEqual([p["pos"] for p in profile["primers"]], [positions[i] for i in lowest])
+            self.assertEqual([p["entropy"] for p in profile["primers"]],
+                             [primers.entropies[i] for i in lowest])
+
+    def test_evicted_run(self):
+        request = RequestFactory().get("/api/profile")
+        request.session = {"refilter": {"candidates": "gone"}}
+        self.assertEqual(views.profile_api(request).status_code, 410)
+
+
+#Rows of a csv/tsv or jsonl export read back into values of its columns'
+#types, with empty cells as None; None for a header of other columns, and
+#any other keys of a jsonl record at the end of its row.
+def parse_export(columns, text, fmt):
+    names = [name for name, kind in columns]
+    if fmt == "jsonl":
+        records = [json.loads(line) for line in text.splitlines()]
+        return [[record.pop(name) for name in names] + sorted(record) for record in records]
+    reader = csv.reader(io.StringIO(text, newline=""), delimiter="," if fmt == "csv" else "\t")
+    if next(reader) != names:
+        return None
+    types = {"int64": int, "float64": float, "bool_": lambda cell: cell == "True", "string": str}
+    return [[None if cell == "" else types[kind](cell) for cell, (name, kind) in zip(row, columns)]
+            for row in reader]
+
+
+class ExportTests(TemporaryStoresMixin, SimpleTestCase):
+    PARAMETERS = {"min_primer_len": 18, "max_primer_len": 21, "na_conc": 0.05,
+                  "amplicon_lower": 75, "amplicon_upper": 300, "max_degeneracy": 3,
+                  "min_melting_temp": 40, "max_melting_temp": 75, "min_gc": 0.2, "max_gc": 0.8,
+                  "find_gc_clamp": False, "filter_gc_clamp": False, "ragged_ends": False,
+                  "max_edit_distance": 2, "approximate_rows": None}
+
+    def setUp(self):
+        super().setUp()
+        rng = np.random.default_rng(22)
+        seqs = clade_alignment(rng, 40, 600, n_clades=3)
+        outgroup = cache.outgroup_store().from_fasta(io.StringIO(">o0\n%s\n>o1\n%s\n" % tuple(seqs[:2])))
+        finder = new_finder()
+        primerpairs, plot = run_pipeline(finder, self.PARAMETERS,
+                                         write_fasta(self.directory.name, seqs), outgroup)
+        self.assertNotEqual(primerpairs, -1)
+        #what the results page shows, and the profile of every k
+        self.pair_records = [pair_record(pair) for pair in primerpairs]
+        self.profiles = sorted(finder.entropy_profiles.items())
+        self.state = refilter_state(finder, outgroup, self.PARAMETERS)
+
+    def export(self, what, fmt):
+        request = RequestFactory().get("/export/%s.%s" % (what, fmt))
+        request.session = {"refilter": self.state}
+        return views.export_results(request, what, fmt)
+
+    #a download parses back to the rows of the results table, whatever the
+    #format, however it is cut into chunks
+    def test_streamed_exports_parse_back(self):
+        expected = {"pairs": list(export.pair_rows(self.pair_records)),
+                    "profile": list(export.profile_rows(self.profiles))}
+        self.assertEqual(len(expected["pairs"]), len(self.pair_records))
+        for what, columns in (("pairs", export.PAIR_COLUMNS), ("profile", export.PROFILE_COLUMNS)):
+            for fmt in ("csv", "tsv", "jsonl"):
+                response = self.export(what, fmt)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.streaming)
+                self.assertEqual(response["Content-Type"], export.FORMATS[fmt][0])
+                text = b"".join(response.streaming_content).decode()
+                self.assertEqual(parse_export(columns, text, fmt), expected[what], (what, fmt))
+                #the writers alone, in batches of a few rows
+                chunks = list(export.stream(columns, iter(expected[what]), fmt, batch_rows=7))
+                self.assertGreater(len(chunks), 2)
+                self.assertEqual(parse_export(columns, "".join(chunks), fmt), expected[what])
+
+    #cells that need quoting, missing values and extreme floats
+    def test_awkward_values(self):
+        columns = [("name", "string"), ("n", "int64"), ("x", "float64"), ("ok", "bool_")]
+        rows = [['a,b', 1, 1e-300, True], ['c\td "e"', -2, None, False], ["f\ng", 0, 0.1 + 0.2, None],
+                ["", 3, 1.7976931348623157e308, True]]
+        for fmt in ("csv", "tsv", "jsonl"):
+            parsed = parse_export(columns, "".join(export.stream(columns, iter(rows), fmt, 2)), fmt)
+            #an empty string and a missing value are one empty cell
+            self.assertEqual(parsed[:3], rows[:3], fmt)
+            self.assertEqual(parsed[3][1:], rows[3][1:], fmt)
+
+    def test_bad_format_and_evicted_run(self):
+        self.assertEqual(self.export("pairs", "xlsx").status_code, 400)
+        self.state = dict(self.state, candidates="gone")
+        self.assertEqual(self.export("profile", "csv").status_code, 410)
+        self.assertEqual(self.export("pairs", "csv").status_code, 410)
+
+
+class BatchResumeTests(TemporaryStoresMixin, SimpleTestCase):
+    def run_batch(self, *args):
+        out = io.StringIO()
+        call_command("run_primer_batch", self.manifest, self.results, "--workers", "2", *args,
+                     stdout=out, stderr=io.StringIO())
+        return out.getvalue().splitlines()
+
+    def result_lines(self):
+        with open(self.results) as f:
+            return f.read().splitlines()
+
+    #a second run over the same manifest runs only what did not finish, and
+    #once everything has, nothing at all
+    def test_resume_runs_nothing_twice(self):
+        directory = self.directory.name
+        seqs = clade_alignment(np.random.default_rng(23), 40, 600, n_clades=3)
+        outgroup = os.path.join(directory, "outgroup.fa")
+        with open(outgroup, "w") as f:
+            f.write(">o0\n%s\n>o1\n%s\n" % tuple(seqs[:2]))
+        later = os.path.join(directory, "later.fa")
+        entries = [dict(ExportTests.PARAMETERS, id="a", msa=write_fasta(directory, seqs), outgroup=outgroup),
+                   dict(ExportTests.PARAMETERS, id="b", msa=write_fasta(directory, seqs), outgroup=outgroup,
+                        amplicon_upper=200),
+                   dict(ExportTests.PARAMETERS, id="c", msa=later, outgroup=outgroup)]
+        self.manifest = os.path.join(directory, "manifest.jsonl")
+        self.results = os.path.join(directory, "results.jsonl")
+        with open(self.manifest, "w") as f:
+            f.writelines(json.dumps(entry) + "\n" for entry in entries)
+
+        self.assertEqual(self.run_batch()[0], "3 searches, 0 already done")
+        first = self.result_lines()
+        self.assertEqual(sorted((json.loads(line)["id"], json.loads(line)["status"]) for line in first),
+                         [("a", "done"), ("b", "done"), ("c", "failed")])
+
+        #only the failed search again, after everything already written
+        self.assertEqual(self.run_batch()[0], "3 searches, 2 already done")
+        second = self.result_lines()
+        self.assertEqual(second[:3], first)
+        self.assertEqual([(json.loads(line)["id"], json.loads(line)["status"]) for line in second[3:]],
+                         [("c", "failed")])
+
+        #a result cut short by a crash is not a finished search
+        with open(later, "w") as f:
+            f.write(">s0\n%s\n>s1\n%s\n" % (seqs[0], seqs[5]))
+        with open(self.results, "a") as f:
+            f.write('{"id": "c", "status": "do')
+        self.assertEqual(self.run_batch()[0], "3 searches, 2 already done")
+        third = self.result_lines()
+        self.assertEqual(third[:5], second + ['{"id": "c", "status": "do'])
+        self.assertEqual([(json.loads(line)["id"], json.loads(line)["status"]) for line in third[5:]],
+                         [("c", "done")])
+
+        self.assertEqual(self.run_batch(), ["3 searches, 3 already done"])
+        self.assertEqual(self.result_lines(), third)
+        #finished searches kept their results
+        done = {json.loads(line)["id"]: json.loads(line) for line in third[:2] + third[5:]}
+        self.assertEqual(sorted(done), ["a", "b", "c"])
+        self.assertTrue(all(result["status"] == "done" for result in done.values()))
+
+        self.assertEqual(self.run_batch("--rerun")[0], "3 searches, 0 already done")
+        self.assertEqual(len(self.result_lines()), len(third) + 3)
+
+
+class GapCoverageTests(SimpleTestCase):
+    #gaps are counted per sequence, however many identical copies were
+    #collapsed into one row
+    def test_deduplicated_rows_count_every_copy(self):
+        seqs = ["ACGTACGTAC"]*9 + ["ACG-ACGTAC"]
+        with tempfile.TemporaryDirectory() as directory:
+            finder = PrimerFinder()
+            finder.identify_primers(write_fasta(directory, seqs), 2, 4)
+        self.assertEqual(finder.gaps.n_rows, 2)
+        pyramid = ProfilePyramid.from_profile(finder.entropy_values, finder.gaps)
+        self.assertEqual(pyramid.n_rows, 10)
+        self.assertAlmostEqual(pyramid.query(3, 4)["gap_fraction"][0], 0.1)
+
+
+    #the counts kept in place of the gap mask are the mask's, reduced the
+    #way the plot reduced it, at the stored resolution and coarser
+    def test_gap_profile_matches_mask(self):
+        rng = np.random.default_rng(15)
+        for n in range(30):
+            seqs = random_alignment(rng, int(rng.integers(1, 40)), int(rng.integers(1, 300)), 0.2)
+            matrix = AlignmentMatrix.from_sequences(seqs, ["s%d" % i for i in range(len(seqs))])
+            if n % 2:
+                matrix = matrix.with_weights({i: float(rng.integers(0, 4)) for i in matrix.ids})
+            weights = matrix.weights if matrix.weights is not None else np.ones(matrix.n_seqs)
+            mask = matrix.codes == GAP
+            rows, columns = int(rng.integers(1, 12)), int(rng.integers(1, 80))
+            gaps = GapProfile.from_matrix(matrix, rows, columns, block_rows=int(rng.integers(1, 9)))
+            np.testing.assert_allclose(gaps.column_counts, weights @ mask)
+            self.assertEqual(gaps.n_sequences, weights.sum())
+            for max_rows, max_columns in ((rows, columns), (rows + 5, columns + 50),
+                                          (int(rng.integers(1, rows + 1)),
+                                           int(rng.integers(1, columns + 1)))):
+                row_starts, row_sizes, col_starts, col_sizes, percent = \
+                    gaps.heatmap(max_rows, max_columns)
+                self.assertLessEqual(len(row_starts), max_rows)
+                self.assertLessEqual(len(col_starts), max_columns)
+                self.assertEqual(row_sizes.sum(), matrix.n_seqs)
+                self.assertEqual(col_sizes.sum(), matrix.n_cols)
+                for i, (r, height) in enumerate(zip(row_starts, row_sizes)):
+                    for j, (c, width) in enumerate(zip(col_starts, col_sizes)):
+                        cell_weights = weights[r:r + height]
+                        count = cell_weights @ mask[r:r + height, c:c + width].sum(axis=1)
+                        cells = cell_weights.sum()*width
+                        self.assertEqual(percent[i, j], np.rint(100*count/cells) if cells else 0)
+
+    def test_gap_profile_round_trip(self):
+        matrix = AlignmentMatrix.from_sequences(["AC-T-A", "A--TGA", "ACGT-A"], "abc")
+        gaps = GapProfile.from_matrix(matrix.with_weights({"a": 2.5, "b": 1, "c": 0}))
+        with tempfile.TemporaryDirectory() as directory:
+            gaps.save(directory)
+            loaded = GapProfile.load(directory)
+        self.assertEqual((loaded.n_sequences, loaded.n_rows, loaded.n_cols), (3.5, 3, 6))
+        for name in GapProfile._ARRAYS:
+            np.testing.assert_array_equal(getattr(loaded, name), getattr(gaps, name))
+
+
+class ParallelTests(SimpleTestCase):
+    #the process pools give what the serial engine and screen give
+    def test_parallel_entropies_match_serial(self):
+        from .parallel import parallel_entropies_range
+        rng = np.random.default_rng(12)
+        for ragged_ends in (False, True):
+            matrix = AlignmentMatrix.from_sequences(random_alignment(rng, 20, 300, 0.01, ragged_ends))
+            serial = KmerEntropyEngine(matrix, ragged_ends).entropies_range(3, 7)
+            self.assertEqual(parallel_entropies_range(matrix, 3, 7, ragged_ends, workers=2,
+                                                      block_columns=37), serial)
+
+    def test_parallel_screen_matches_serial(self):
+        from .parallel import parallel_screen
+        rng = np.random.default_rng(13)
+        records = ["".join(rng.choice(list("ACGT"), 200)) for i in range(5)]
+        index = OutgroupIndex.from_sequences(records)
+        seqs = [records[i][j:j + 10] for i, j in zip(rng.integers(0, 5, 10), rng.integers(0, 190, 10))]
+        seqs += ["".join(rng.choice(list("ACGTRYN"), 10)) for i in range(20)]
+        for max_dist in range(3):
+            serial = {seq for seq in seqs if index.seq_within(seq, max_dist)}
+            self.assertEqual(parallel_screen(index, seqs, max_dist, workers=2, chunk_size=150),
+                             serial)
+
+
+@override_settings(PRIMER_FINDER_JOB_TIMEOUT=300, PRIMER_FINDER_JOB_ATTEMPTS=3)
+class JobQueueTests(TestCase):
+    def running_job(self, heartbeat_age, attempts=1):
+        beat = timezone.now() - timedelta(seconds=heartbeat_age)
+        return PrimerJob.objects.create(parameters="{}", status=PrimerJob.RUNNING, started=beat,
+                                        heartbeat=beat, attempts=attempts)
+
+    def test_job_is_claimed_once(self):
+        job = PrimerJob.objects.create(parameters="{}")
+        claimed = claim_next_job()
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual(claimed.status, PrimerJob.RUNNING)
+        self.assertEqual(claimed.attempts, 1)
+        self.assertIsNotNone(claimed.heartbeat)
+        self.assertIsNone(claim_next_job())
+
+    def test_oldest_queued_job_first(self):
+        first = PrimerJob.objects.create(parameters="{}")
+        second = PrimerJob.objects.create(parameters="{}")
+        PrimerJob.objects.filter(pk=second.pk).update(created=first.created - timedelta(seconds=1))
+        self.assertEqual(claim_next_job().pk, second.pk)
+        self.assertEqual(claim_next_job().pk, first.pk)
+
+    def test_stale_job_is_requeued_and_claimed_again(self):
+        job = self.running_job(600)
+        claimed = claim_next_job()
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual(claimed.attempts, 2)
+        self.assertGreater(claimed.heartbeat, job.heartbeat)
+
+    def test_live_job_is_left_alone(self):
+        job = self.running_job(10)
+        self.assertEqual(requeue_stale_jobs(), 0)
+        self.assertIsNone(claim_next_job())
+        after = PrimerJob.objects.get(pk=job.pk)
+        self.assertEqual((after.status, after.heartbeat, after.attempts),
+                         (PrimerJob.RUNNING, job.heartbeat, 1))
+
+    def test_stale_job_fails_after_its_last_attempt(self):
+        job = self.running_job(600, attempts=3)
+        self.assertEqual(requeue_stale_jobs(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, PrimerJob.FAILED)
+        self.assertIn("3 workers stopped responding", job.message)
+
+    def test_error_message(self):
+        self.assertEqual(job_error_message(ValueError("alignment contains no sequences")),
+                         "alignment contains no sequences")
+        self.assertNotIn("/", job_error_message(FileNotFoundError("/srv/jobs/x/msa.fa")))
+
+
+#the heartbeat is written from a thread of its own, on its own connection
+class HeartbeatTests(TransactionTestCase):
+    @override_settings(PRIMER_FINDER_JOB_HEARTBEAT=0.05)
+    def test_heartbeat_is_refreshed_while_running(self):
+        PrimerJob.objects.create(parameters="{}")
+        job = claim_next_job()
+        with _Heartbeat(job):
+            time.sleep(0.3)
+        beat = PrimerJob.objects.get(pk=job.pk).heartbeat
+        self.assertGreater(beat, job.heartbeat)
+        time.sleep(0.15)
+        #stopped with the job
+        self.assertEqual(PrimerJob.objects.get(pk=job.pk).heartbeat, beat)
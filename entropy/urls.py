@@ -6,5 +6,12 @@ from . import views
 urlpatterns = [
     path('', views.PrimerFinderView.as_view(), name='index'),
     path('api/results', views.PrimerFinderView.as_view(), name='primer_results'),
+    path('api/refilter', views.refilter_api, name='refilter'),
+    path('api/profile', views.profile_api, name='profile'),
     path('download/', views.PrimerFinderView.downloadURL, name="downloadURL"),
+    path('export/<str:what>.<str:fmt>', views.export_results, name='export'),
+    path('jobs/<uuid:job_id>/', views.job_page, name='job'),
+    path('jobs/<uuid:job_id>/status', views.job_status, name='job_status'),
+    path('jobs/<uuid:job_id>/results', views.job_results_api, name='job_results'),
+    path('jobs/<uuid:job_id>/export/<str:what>.<str:fmt>', views.export_results, name='job_export'),
 ]
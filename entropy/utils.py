@@ -1,6 +1,85 @@
+import hashlib
+import json
+import os
+import time
+import traceback
 from .primer_finder_classes import *
+from .cache import outgroup_store
+from .jobs import PARAMETERS, new_finder, run_pipeline, pair_record
 
-def find_primers(**kwargs):
-    primerFinder = new PrimerFinder()
-    #primers = primerFinder
-    pass
+#Searches outside the web form: one alignment at a time (find_primers) or a
+#manifest of them (run_batch_job, used by manage.py run_primer_batch).
+
+#parameters a search can leave out, with the value the form gives them
+OPTIONAL_PARAMETERS = {'find_gc_clamp': False, 'filter_gc_clamp': False, 'ragged_ends': False,
+                       'approximate_rows': None}
+
+
+#The pairs (pair_record dicts) for one alignment. outgroup is a FASTA path,
+#an OutgroupIndex or the name of a registered reference outgroup; the other
+#keyword arguments are the PrimerForm parameters. report, if given, is
+#filled with the search's RunReport.as_dict().
+def find_primers(msa_file, outgroup, weights=None, progress=None, workers=None, report=None,
+                 **kwargs):
+    parameters = dict(OPTIONAL_PARAMETERS)
+    parameters.update(kwargs)
+    missing = [name for name in PARAMETERS if name not in parameters]
+    if missing:
+        raise ValueError("Missing parameters: %s" % ", ".join(missing))
+    if isinstance(outgroup, str):
+        if outgroup in outgroup_store().references():
+            outgroup = outgroup_store().reference(outgroup)
+        else:
+            with open(outgroup) as outgroup_file:
+                outgroup = outgroup_store().from_fasta(outgroup_file)
+    primerFinder = new_finder(progress, workers)
+    try:
+        primerpairs, plot = run_pipeline(primerFinder, parameters, msa_file, outgroup, weights)
+    finally:
+        if report is not None:
+            report.update(primerFinder.report.as_dict())
+    if primerpairs == -1:
+        return []
+    return [pair_record(pair) for pair in primerpairs]
+
+
+#Id of a manifest entry: its own "id", or else a digest of its content, so
+#the same entry keeps its id when the manifest is edited or reordered.
+def batch_job_id(entry):
+    if entry.get('id') is not None:
+        return str(entry['id'])
+    return hashlib.sha256(json.dumps(entry, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+#Runs one manifest entry ({"msa": path, "outgroup": path or reference name,
+#"weights": optional path, and the form parameters}) and returns its result
+#line: status, pairs, the seconds spent in each stage and the search's run
+#report. Never raises; a failed entry reports its error instead.
+def run_batch_job(entry, workers=1):
+    timings = {}
+    last = {'stage': None, 'at': time.perf_counter()}
+
+    def progress(stage):
+        now = time.perf_counter()
+        if last['stage'] is not None:
+            timings[last['stage']] = now - last['at']
+        last.update(stage=stage, at=now)
+
+    started = time.perf_counter()
+    result = {'id': batch_job_id(entry), 'msa': entry.get('msa'), 'outgroup': entry.get('outgroup')}
+    report = {}
+    try:
+        parameters = {name: value for name, value in entry.items()
+                      if name not in ('id', 'msa', 'outgroup', 'weights')}
+        pairs = find_primers(entry['msa'], entry['outgroup'], entry.get('weights'), progress,
+                             workers, report, **parameters)
+        result.update(status='done', n_pairs=len(pairs), pairs=pairs)
+    except Exception as e:
+        result.update(status='failed', error='%s: %s' % (type(e).__name__, e),
+                      traceback=traceback.format_exc(limit=-3))
+    progress(None)
+    timings['total'] = time.perf_counter() - started
+    result['timings'] = timings
+    result['report'] = report
+    result['pid'] = os.getpid()
+    return result
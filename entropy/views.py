@@ -1,8 +1,16 @@
-from django.shortcuts import render
-from django.http import HttpResponse, Http404
+from django.shortcuts import render, redirect, get_object_or_404
+from django.http import HttpResponse, Http404, JsonResponse
 from django.views.generic.edit import FormView
 from .forms import *
 from .primer_finder_classes import *
+from .cache import outgroup_store
+from .jobs import (submit_job, run_pipeline, new_finder, job_results, iter_job_results,
+                   job_plot, STAGES, refilter_state, job_refilter_state, refilter, pair_record,
+                   profile_range, export_rows, job_report, show_report, requeue_stale_jobs,
+                   spawn_worker)
+from . import export
+from django.http import StreamingHttpResponse
+from .models import PrimerJob
 import io
 import os
 import logging
@@ -12,7 +20,7 @@ from django.conf import settings
 
 
 # Get an instance of a logger
-#logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
 """
 def index(request):
@@ -43,28 +51,27 @@ class PrimerFinderView(FormView):
     
     def form_valid(self, form):
         form_data = form.cleaned_data
-        msa_bytesIO = self.request.FILES['msa_file'].file
-        msa_file = io.TextIOWrapper(msa_bytesIO)
-        outgroup_bytesIO = self.request.FILES['outgroup_file'].file
-        outgroup_file = io.TextIOWrapper(outgroup_bytesIO)
-        primerFinder = PrimerFinder()
-        primers = primerFinder.identify_primers(filename=msa_file,
-                                                min_primer_length=form_data['min_primer_len'],
-                                                max_primer_length=form_data['max_primer_len'],
-                                                na_conc=form_data['na_conc'])
-
-        primerpairs = primerFinder.identify_pairs(primers=primers,
-                                                  amp_min=form_data['amplicon_lower'],
-                                                  amp_max=form_data['amplicon_upper'],
-                                                  max_degeneracy=form_data['max_degeneracy'],
-                                                  min_melting_temp=form_data['min_melting_temp'],
-                                                  max_melting_temp=form_data['max_melting_temp'],
-                                                  min_gc=form_data['min_gc'],
-                                                  max_gc=form_data['max_gc'],
-                                                  select_gc_clamp=form_data['find_gc_clamp'],
-                                                  omit_gc_clamp=form_data['filter_gc_clamp'],
-                                                  max_edit_dist=form_data['max_edit_distance'],
-                                                  outgroup=outgroup_file)
+        if getattr(settings, 'PRIMER_FINDER_ASYNC_JOBS', True):
+            job = submit_job(form_data, self.request.FILES)
+            return redirect('job', job_id=job.id)
+        #read as bytes; compressed uploads are recognised by the loader
+        msa_file = self.request.FILES['msa_file'].file
+        if form_data['reference_outgroup']:
+            outgroup = outgroup_store().reference(form_data['reference_outgroup'])
+        else:
+            outgroup_bytesIO = self.request.FILES['outgroup_file'].file
+            outgroup = outgroup_store().from_fasta(io.TextIOWrapper(outgroup_bytesIO))
+        primerFinder = new_finder()
+        weights = self.request.FILES.get('sequence_weights')
+        try:
+            primerpairs, plot = run_pipeline(primerFinder, form_data, msa_file, outgroup,
+                                             weights.file if weights else None)
+        except ValueError as e:
+            #a malformed alignment or weights file
+            logger.info("rejected upload: %s", e)
+            form.add_error(None, str(e))
+            return self.form_invalid(form)
+        self.request.session['refilter'] = refilter_state(primerFinder, outgroup, form_data)
         self.items = primerpairs
         #file_path = os.path.join(settings.TEMPLATE_URL, 'entropy-out.csv')
         #if os.path.exists(file_path):        
@@ -77,17 +84,17 @@ class PrimerFinderView(FormView):
         #########################################################################################################################
         ##################################################### ^ OLD #############################################################
         no_results = False
-        plot = None
         if primerpairs == -1:
-            print("NO resutls found")
+            logger.info("no primer pairs found")
             no_results = True
             primerpairs = None
-        if not no_results:
-            print("Results Found")
+        else:
             #primerFinder.saveCSV()
-            plot = primerFinder.html_plot()
-        print(len([pair for pair in primerpairs]))
-        return render(self.request, 'entropy/index.html', {'primerpairs': primerpairs, 'action': self.action, 'no_results': no_results, 'form': self.form_class, 'plot':plot})
+            logger.info("%d primer pairs found", len(primerpairs))
+        return render(self.request, 'entropy/index.html', {'primerpairs': primerpairs, 'action': self.action, 'no_results': no_results, 'form': self.form_class, 'plot':plot,
+                                                           'profile': bool(primerFinder.candidate_key),
+                                                           'export_formats': list(export.FORMATS),
+                                                           'report': primerFinder.report.as_dict() if show_report(self.request) else None})
     
     def download(request, path):
         file_path = os.path.join(settings.TEMPLATE_URL, path)
@@ -98,12 +105,124 @@ class PrimerFinderView(FormView):
                 return response
         raise Http404
     
-    def downloadURL(self, request, *args, **kwargs):
-        response=HttpResponse(content_type="text/csv")
-        response['Content-Disposition'] = 'attachment; filename="entropy-out-new.csv"'
-        writer = csv.writer(response, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        for i in self.items:
-            writer.writerow(i)
-        return response
-        
-            
\ No newline at end of file
+    #kept for the old download/ link: the pairs of the session's run as CSV
+    @staticmethod
+    def downloadURL(request, *args, **kwargs):
+        return export_results(request, 'pairs', 'csv')
+
+
+#Page of a submitted job: the results once it is done, otherwise its progress,
+#polled from job_status.
+def job_page(request, job_id):
+    job = get_object_or_404(PrimerJob, pk=job_id)
+    if job.status != PrimerJob.DONE:
+        return render(request, 'entropy/job_status.html', {'job': job, 'stages': STAGES})
+    primerpairs = job_results(job)
+    request.session['refilter'] = job_refilter_state(job)
+    return render(request, 'entropy/index.html', {'primerpairs': primerpairs,
+                                                  'no_results': not primerpairs,
+                                                  'form': PrimerForm(),
+                                                  'plot': job_plot(job),
+                                                  'profile': bool(request.session['refilter']),
+                                                  'export_formats': list(export.FORMATS),
+                                                  'report': job_report(job) if show_report(request) else None,
+                                                  'job': job})
+
+
+#A running job whose worker has died is queued again here too, and a
+#queued job gets a worker if a worker slot is free, so it is picked up even
+#when no other job is submitted.
+def job_status(request, job_id):
+    job = get_object_or_404(PrimerJob, pk=job_id)
+    if job.status == PrimerJob.RUNNING and requeue_stale_jobs():
+        job.refresh_from_db()
+    if job.status == PrimerJob.QUEUED and getattr(settings, 'PRIMER_FINDER_SPAWN_WORKER', True):
+        spawn_worker()
+    return JsonResponse({'id': str(job.id), 'status': job.status, 'stage': job.stage,
+                         'progress': job.progress, 'message': job.message,
+                         'n_pairs': job.n_pairs, 'created': job.created,
+                         'started': job.started, 'finished': job.finished})
+
+
+#The pairs of a finished job, with its run report (stage timings and work
+#counters) when show_report() asks for it.
+def job_results_api(request, job_id):
+    job = get_object_or_404(PrimerJob, pk=job_id)
+    if job.status != PrimerJob.DONE:
+        return JsonResponse({'id': str(job.id), 'status': job.status}, status=409)
+    results = {'id': str(job.id), 'status': job.status, 'pairs': job_results(job)}
+    if show_report(request):
+        results['report'] = job_report(job)
+    return JsonResponse(results)
+
+
+#The pairs of the session's last run with some filters changed, e.g.
+#?min_melting_temp=55&max_gc=0.55. Works on the cached candidate table, so
+#the alignment is not read again.
+def refilter_api(request):
+    state = request.session.get('refilter')
+    if not state:
+        return JsonResponse({'error': 'no results in this session'}, status=404)
+    form = RefilterForm(request.GET if request.method == 'GET' else request.POST)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors}, status=400)
+    overrides = dict(form.cleaned_data)
+    offset = overrides.pop('offset') or 0
+    limit = overrides.pop('limit')
+    if limit is None:
+        limit = 1000
+    primerpairs = refilter(state, overrides)
+    if primerpairs is None:
+        return JsonResponse({'error': 'the candidates of this run are no longer cached'}, status=410)
+    return JsonResponse({'n_pairs': len(primerpairs),
+                         'pairs': [pair_record(pair) for pair in primerpairs[offset:offset + limit]]})
+
+
+#The entropy profile of the session's last run over ?start=&stop= columns,
+#summarised to about ?points= buckets (min/max entropy and gap fraction per
+#bucket), with the ?primers= lowest entropy candidates starting in the range.
+#The results page fetches it again whenever the chart is panned or zoomed.
+def profile_api(request):
+    state = request.session.get('refilter')
+    if not state:
+        return JsonResponse({'error': 'no results in this session'}, status=404)
+    form = ProfileForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'error': form.errors}, status=400)
+    query = form.cleaned_data
+    profile = profile_range(state, query['start'] or 0, query['stop'], query['points'] or 1000,
+                            200 if query['primers'] is None else query['primers'])
+    if profile is None:
+        return JsonResponse({'error': 'the candidates of this run are no longer cached'}, status=410)
+    return JsonResponse(profile)
+
+
+#Downloads a run's primer pairs or its entropy profile for every k
+#(what = pairs | profile) as csv, tsv, jsonl, parquet or arrow, streamed as it
+#is written. The run is the job's, or else the session's last one.
+def export_results(request, what, fmt, job_id=None):
+    if what not in ('pairs', 'profile'):
+        raise Http404
+    records = None
+    if job_id is not None:
+        job = get_object_or_404(PrimerJob, pk=job_id, status=PrimerJob.DONE)
+        state = job_refilter_state(job)
+        if what == 'pairs':
+            records = iter_job_results(job)
+    else:
+        state = request.session.get('refilter')
+    if not state:
+        return JsonResponse({'error': 'no results to export'}, status=404)
+    rows = export_rows(state, what, records)
+    if rows is None:
+        return JsonResponse({'error': 'the candidates of this run are no longer cached'}, status=410)
+    columns = export.PAIR_COLUMNS if what == 'pairs' else export.PROFILE_COLUMNS
+    try:
+        chunks = export.stream(columns, rows, fmt)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    content_type, extension = export.FORMATS[fmt]
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    name = 'primer-pairs' if what == 'pairs' else 'entropy-profile'
+    response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (name, extension)
+    return response